@@ -0,0 +1,131 @@
+"""
+
+Upload of the attachments of a message to the user's volume
+
+    uploads = schedule_upload(nfs, volume_name, request.query[-1].attachments)
+    ...  # the model writes the code in the meantime
+    await uploads
+
+The attachments are downloaded concurrently over one pooled HTTP client. Each one is
+streamed into a temporary file that stays in memory up to SPOOL_SIZE and spills to
+disk beyond, so a large CSV is never held in memory whole, and concurrent requests
+never share a local file. NetworkFileSystem.write_file hashes the file before it
+uploads it and so needs a seekable file, which is why the chunks are not sent to the
+volume as they arrive.
+
+The URL, sha256 and size of every uploaded file are kept in a modal.Dict. An
+attachment whose URL was uploaded before is not downloaded again, and one whose content
+is already on the volume under the same name is not uploaded again, as long as the
+file on the volume still has the size that was uploaded. The code run in the sandbox
+can overwrite the file, and a file that changed size is uploaded again.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import tempfile
+import time
+
+import httpx
+import modal
+
+SPOOL_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+MAX_CONNECTIONS = 16
+
+ATTACHMENT_INDEX = modal.Dict.from_name("dict-attachment-index", create_if_missing=True)
+
+HTTP_CLIENT = None
+
+# uploads are not cancelled when the response ends early, see schedule_upload
+BACKGROUND_TASKS = set()
+
+
+def get_http_client():
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None:
+        HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS),
+            timeout=httpx.Timeout(30, read=300),
+            follow_redirects=True,
+        )
+    return HTTP_CLIENT
+
+
+async def get_size_on_volume(nfs, path):
+    """Returns None if the file is not on the volume."""
+    try:
+        entries = await nfs.listdir.aio(path)
+    except Exception:
+        return None  # the file is uploaded again if it cannot be listed
+    return entries[0].size if len(entries) == 1 else None
+
+
+async def upload_attachment(nfs, volume_name, attachment, index=ATTACHMENT_INDEX):
+    """Returns "cached", "unchanged" or "uploaded"."""
+    index_key = f"{volume_name}/{attachment.name}"
+    entry = await index.get.aio(index_key)
+    # the file on the volume may have been overwritten by the user's code since
+    size_on_volume = await get_size_on_volume(nfs, attachment.name)
+    if (
+        entry is not None
+        and entry["url"] == attachment.url
+        and size_on_volume is not None
+        and entry.get("size") == size_on_volume
+    ):
+        return "cached"
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+        async with get_http_client().stream("GET", attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+
+        digest = sha256.hexdigest()
+        if (
+            entry is not None
+            and entry["sha256"] == digest
+            and entry.get("size") == size_on_volume == size
+        ):
+            status = "unchanged"
+        else:
+            f.seek(0)
+            await nfs.write_file.aio(attachment.name, f)
+            status = "uploaded"
+    await index.put.aio(
+        index_key, {"url": attachment.url, "sha256": digest, "size": size}
+    )
+    return status
+
+
+async def upload_attachments(nfs, volume_name, attachments):
+    """Uploads the attachments concurrently, a failed upload does not stop the others."""
+
+    async def upload(attachment):
+        start = time.perf_counter()
+        try:
+            status = await upload_attachment(nfs, volume_name, attachment)
+        except Exception as e:
+            status = f"failed {e!r}"
+        print(
+            "attachment_upload",
+            attachment.name,
+            status,
+            "seconds",
+            round(time.perf_counter() - start, 3),
+        )
+        return status
+
+    return await asyncio.gather(*[upload(attachment) for attachment in attachments])
+
+
+def schedule_upload(nfs, volume_name, attachments):
+    task = asyncio.create_task(upload_attachments(nfs, volume_name, attachments))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
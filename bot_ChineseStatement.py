@@ -10,60 +10,24 @@ There are three states in the conversation
 
 from __future__ import annotations
 
-import random
-import re
 from typing import AsyncIterable
 
 import fastapi_poe as fp
 from fastapi_poe.types import PartialResponse
 from modal import App, Dict, Image, asgi_app
 
+from response_cache import ResponseCache
+from state_session import StateSession
+from statement_corpus import load_corpus
+
 app = App("poe-bot-ChineseStatement")
 my_dict = Dict.from_name("dict-ChineseStatement", create_if_missing=True)
+RESPONSE_CACHE = ResponseCache(
+    "ChineseStatement", Dict.from_name("dict-response-cache", create_if_missing=True)
+)
 
-with open("chinese_sentences.txt") as f:
-    srr = f.readlines()
-
-pattern = r"A\.\d\s"  # e.g. "A.1 "
-
-level_to_statements_and_context = []
-
-context = {}
-
-for line in srr:
-    line = line.strip()
-    if re.match(pattern, line):
-        level_to_statements_and_context.append([])
-        continue
-    if line == "":
-        continue
-    if "A." in line:
-        depth = line.count(".")
-        context[f"{depth}"] = line
-        context.pop("【", None)
-        context.pop("（", None)
-        for nex_depth in range(depth + 1, 10):
-            context.pop(f"{nex_depth}", None)
-        continue
-    if "【" in line:
-        context["【"] = line
-        context.pop("（", None)
-        continue
-    if "（" in line:
-        context["（"] = line
-        continue
-
-    # statement matching
-    if "。" not in line and "？" not in line:
-        continue
-    if "甲" in line or "乙" in line:
-        continue
-    if "/" in line:
-        continue
-    if len(line) > 50:
-        continue
-
-    level_to_statements_and_context[-1].append((line.strip(), list(context.values())))
+# sentences and their contexts, memory-mapped from the compiled corpus
+STATEMENT_CORPUS = load_corpus("chinese_sentences.txt", "chinese_sentences.corpus")
 
 
 TEMPLATE_STARTING_REPLY = """
@@ -110,9 +74,27 @@ def get_conversation_submitted_key(conversation_id):
     return f"ChineseVocab-submitted-{conversation_id}"
 
 
+def get_request_keys(request):
+    # every key that get_response reads or writes, loaded in one round trip
+    return [
+        get_user_level_key(request.user_id),
+        get_conversation_info_key(request.conversation_id),
+        get_conversation_submitted_key(request.conversation_id),
+    ]
+
+
 class ChineseStatementBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
+    ) -> AsyncIterable[fp.PartialResponse]:
+        async with StateSession(
+            my_dict, get_request_keys(request), name="ChineseStatement"
+        ) as state:
+            async for msg in self.get_response_with_state(request, state):
+                yield msg
+
+    async def get_response_with_state(
+        self, request: fp.QueryRequest, state: StateSession
     ) -> AsyncIterable[fp.PartialResponse]:
         user_level_key = get_user_level_key(request.user_id)
         conversation_info_key = get_conversation_info_key(request.conversation_id)
@@ -124,31 +106,29 @@ class ChineseStatementBot(fp.PoeBot):
 
         # reset if the user passes or asks for the next statement
         if last_user_reply in (NEXT_STATEMENT, PASS_STATEMENT):
-            if conversation_info_key in my_dict:
-                my_dict.pop(conversation_info_key)
-            if conversation_submitted_key in my_dict:
-                my_dict.pop(conversation_submitted_key)
+            if conversation_info_key in state:
+                state.pop(conversation_info_key)
+            if conversation_submitted_key in state:
+                state.pop(conversation_submitted_key)
 
         # retrieve the level of the user
         # TODO(when conversation starter is ready): jump to a specific level
         if last_user_reply in "1234567":
             level = int(last_user_reply)
-            my_dict[user_level_key] = level
-        elif user_level_key in my_dict:
-            level = my_dict[user_level_key]
+            state[user_level_key] = level
+        elif user_level_key in state:
+            level = state[user_level_key]
             level = max(1, level)
             level = min(7, level)
         else:
             level = 1
-            my_dict[user_level_key] = level
+            state[user_level_key] = level
 
         # for new conversations, sample a problem
-        if conversation_info_key not in my_dict:
-            statement, context = random.choice(
-                level_to_statements_and_context[level - 1]  # leveling is one indexed
-            )
+        if conversation_info_key not in state:
+            statement, context = STATEMENT_CORPUS.sample(level)
             statement_info = {"statement": statement, "context": context}
-            my_dict[conversation_info_key] = statement_info
+            state[conversation_info_key] = statement_info
             yield self.text_event(
                 TEMPLATE_STARTING_REPLY.format(
                     statement=statement_info["statement"], level=level
@@ -158,11 +138,11 @@ class ChineseStatementBot(fp.PoeBot):
             return
 
         # retrieve the previously cached word
-        statement_info = my_dict[conversation_info_key]
+        statement_info = state[conversation_info_key]
         statement = statement_info["statement"]  # so that this can be used in f-string
 
         # if the submission is already made, continue as per normal
-        if conversation_submitted_key in my_dict:
+        if conversation_submitted_key in state:
             request.query = [
                 {
                     "role": "system",
@@ -197,16 +177,16 @@ class ChineseStatementBot(fp.PoeBot):
         request.logit_bias = {"2746": -5, "36821": -10}  # "If"  # " |\n\n"
 
         bot_reply = ""
-        async for msg in fp.stream_request(request, "Claude-3.5-Sonnet", request.access_key):
+        async for msg in RESPONSE_CACHE.stream_request(request, "Claude-3.5-Sonnet"):
             bot_reply += msg.text
             yield msg.model_copy()
 
         # make a judgement on correctness
-        my_dict[conversation_submitted_key] = True
+        state[conversation_submitted_key] = True
         if "has captured the full meaning" in bot_reply:
-            my_dict[user_level_key] = level + 1
+            state[user_level_key] = level + 1
         else:
-            my_dict[user_level_key] = level - 1
+            state[user_level_key] = level - 1
 
         # deliver suggsted replies
         yield PartialResponse(
@@ -220,4 +200,3 @@ class ChineseStatementBot(fp.PoeBot):
             server_bot_dependencies={"Claude-3.5-Sonnet": 1, "GPT-3.5-Turbo": 1},
             introduction_message="Say 'start' to get the sentence to translate.",
         )
-
@@ -10,7 +10,9 @@ There are three states in the conversation
 
 from __future__ import annotations
 
+import asyncio
 import re
+import time
 from typing import AsyncIterable
 
 import fastapi_poe as fp
@@ -18,10 +20,21 @@ import pandas as pd
 from fastapi_poe.types import PartialResponse, ProtocolMessage
 from modal import App, Dict, Image, asgi_app
 
+from learner_state import SparseLearnerState, load_learner_state, store_learner_state
+from response_cache import ResponseCache
+from state_session import StateSession
+from vocab_scheduler import SCHEDULE_INITIAL_VALUES, VocabScheduler, get_current_hours
+from word_store import WordStore
+
 app = App("poe-bot-ChineseVocab")
 my_dict = Dict.from_name("my-dict", create_if_missing=True)
+RESPONSE_CACHE = ResponseCache(
+    "ChineseVocab", Dict.from_name("dict-response-cache", create_if_missing=True)
+)
 
-df = pd.read_csv("chinese_words.csv")
+# compiled once per container into per-level index arrays, see word_store.py
+WORD_STORE = WordStore(pd.read_csv("chinese_words.csv"))
+SCHEDULER = VocabScheduler(WORD_STORE)
 # using https://github.com/krmanik/HSK-3.0-words-list/tree/main/HSK%20List
 # see also https://www.mdbg.net/chinese/dictionary?page=cedict
 
@@ -199,6 +212,46 @@ def stringify_conversation(messages: list[ProtocolMessage]) -> str:
     return stringified_messages
 
 
+# the suggested replies are generated from the first part of a long answer,
+# while the rest of the answer is still streaming
+SUGGESTED_REPLIES_PREFIX_LENGTH = 400
+
+
+def get_complete_table(reply: str) -> str | None:
+    """Returns the reply up to the separator and the two table rows after it, the
+    answer and the reference, once they have fully streamed."""
+    complete_lines = reply.split("\n")[:-1]  # the last line may still be streaming
+    for i, line in enumerate(complete_lines):
+        if "-----" in line:
+            rows = []
+            for row in complete_lines[i + 1 :]:
+                if not row.strip().startswith("|"):
+                    break
+                rows.append(row)
+            if len(rows) >= 2:
+                return "\n".join(complete_lines[: i + 1] + rows[:2])
+            return None
+    return None
+
+
+async def collect_reply(request: fp.QueryRequest, bot_name: str) -> str:
+    reply = ""
+    async for msg in RESPONSE_CACHE.stream_request(request, bot_name):
+        reply += msg.text
+    return reply
+
+
+class StageTimings:
+    """Seconds from the start of the request to each stage, printed for monitoring."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def mark(self, stage):
+        self.stages.setdefault(stage, round(time.perf_counter() - self.start, 3))
+
+
 def get_user_format_key(user_id):
     assert user_id.startswith("u")
     # simplified or traditional
@@ -210,6 +263,12 @@ def get_user_level_key(user_id):
     return f"ChineseVocab-level-{user_id}"
 
 
+def get_user_schedule_key(user_id):
+    # spaced-repetition state of the words the user has reviewed
+    assert user_id.startswith("u")
+    return f"ChineseVocab-schedule-{user_id}"
+
+
 def get_conversation_info_key(conversation_id):
     assert conversation_id.startswith("c")
     return f"ChineseVocab-word-{conversation_id}"
@@ -220,12 +279,35 @@ def get_conversation_submitted_key(conversation_id):
     return f"ChineseVocab-submitted-{conversation_id}"
 
 
+def get_request_keys(request):
+    # every key that get_response reads or writes, loaded in one round trip
+    return [
+        get_user_format_key(request.user_id),
+        get_user_level_key(request.user_id),
+        *SparseLearnerState.get_keys(
+            get_user_schedule_key(request.user_id), SCHEDULER.item_index
+        ),
+        get_conversation_info_key(request.conversation_id),
+        get_conversation_submitted_key(request.conversation_id),
+    ]
+
+
 class ChineseVocabBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
+    ) -> AsyncIterable[fp.PartialResponse]:
+        async with StateSession(
+            my_dict, get_request_keys(request), name="ChineseVocab"
+        ) as state:
+            async for msg in self.get_response_with_state(request, state):
+                yield msg
+
+    async def get_response_with_state(
+        self, request: fp.QueryRequest, state: StateSession
     ) -> AsyncIterable[fp.PartialResponse]:
         user_level_key = get_user_level_key(request.user_id)
         user_format_key = get_user_format_key(request.user_id)
+        user_schedule_key = get_user_schedule_key(request.user_id)
         conversation_info_key = get_conversation_info_key(request.conversation_id)
         conversation_submitted_key = get_conversation_submitted_key(
             request.conversation_id
@@ -234,26 +316,26 @@ class ChineseVocabBot(fp.PoeBot):
         print(last_user_reply)
 
         def change_to_simplified_chinese(*args):
-            my_dict[user_format_key] = "simplified"
+            state[user_format_key] = "simplified"
             print(f"Changed to simplified Chinese")
 
         def change_to_traditional_chinese(*args):
-            my_dict[user_format_key] = "traditional"
+            state[user_format_key] = "traditional"
             print(f"Changed to traditional Chinese")
 
         def move_on_to_next_word(*args):
-            if conversation_info_key in my_dict:
-                my_dict.pop(conversation_info_key)
-            if conversation_submitted_key in my_dict:
-                my_dict.pop(conversation_submitted_key)
+            if conversation_info_key in state:
+                state.pop(conversation_info_key)
+            if conversation_submitted_key in state:
+                state.pop(conversation_submitted_key)
             print(f"Provided a new word")
 
         # def change_level(level, *args):
-        #     my_dict[user_level_key] = level
-        #     if conversation_info_key in my_dict:
-        #         my_dict.pop(conversation_info_key)
-        #     if conversation_submitted_key in my_dict:
-        #         my_dict.pop(conversation_submitted_key)
+        #     state[user_level_key] = level
+        #     if conversation_info_key in state:
+        #         state.pop(conversation_info_key)
+        #     if conversation_submitted_key in state:
+        #         state.pop(conversation_submitted_key)
         #     print(f"The user level has been changed to {level}")
 
         # tools_executables = [
@@ -281,29 +363,38 @@ class ChineseVocabBot(fp.PoeBot):
         if last_user_reply in (NEXT_STATEMENT, PASS_STATEMENT):
             move_on_to_next_word()
 
-        if user_format_key in my_dict:
-            format = my_dict[user_format_key]
+        if user_format_key in state:
+            format = state[user_format_key]
         else:
-            my_dict[user_format_key] = "simplified"
-            format = my_dict[user_format_key]
+            state[user_format_key] = "simplified"
+            format = state[user_format_key]
 
         # retrieve the level of the user
-        if user_level_key in my_dict:
-            level = my_dict[user_level_key]
+        if user_level_key in state:
+            level = state[user_level_key]
             level = max(1, level)
             level = min(7, level)
         else:
             level = 1
-            my_dict[user_level_key] = level
-
-        # for new conversations, sample a problem
-        if conversation_info_key not in my_dict:
-            word_info = (
-                df[(df["level"] == level) & (df["exclude"] == False)]
-                .sample(n=1)
-                .to_dict(orient="records")[0]
+            state[user_level_key] = level
+
+        schedule = await load_learner_state(
+            my_dict,
+            SCHEDULER.item_index,
+            state,
+            user_schedule_key,
+            SCHEDULE_INITIAL_VALUES,
+            state_class=SparseLearnerState,
+        )
+
+        # for new conversations, pick a word that is due or a new word
+        if conversation_info_key not in state:
+            word_index, is_review = SCHEDULER.next_word(
+                schedule, level, get_current_hours()
             )
-            my_dict[conversation_info_key] = word_info
+            word_info = WORD_STORE.get_record(word_index)
+            word_info["index"] = word_index
+            state[conversation_info_key] = word_info
             yield self.text_event(
                 TEMPLATE_STARTING_REPLY.format(
                     word=word_info[format], level=word_info["level"]
@@ -324,7 +415,7 @@ class ChineseVocabBot(fp.PoeBot):
             return
 
         # retrieve the previously cached word
-        word_info = my_dict[conversation_info_key]
+        word_info = state[conversation_info_key]
         word = word_info[format]  # so that this can be used in f-string
 
         if last_user_reply in (TRADITIONAL_STATEMENT, SIMPLIFIED_STATEMENT):
@@ -337,7 +428,7 @@ class ChineseVocabBot(fp.PoeBot):
             return
 
         # if the submission is already made, continue as per normal
-        if conversation_submitted_key in my_dict:
+        if conversation_submitted_key in state:
             format_repeat = (
                 "请使用简体中文。" if format == "simplified" else "請使用繁體中文。"
             )
@@ -354,30 +445,66 @@ class ChineseVocabBot(fp.PoeBot):
                 + [ProtocolMessage(role="system", content=format_repeat)]
                 + request.query
             )
+            timings = StageTimings()
+
+            def make_suggested_replies_request(bot_reply):
+                current_conversation_string = stringify_conversation(
+                    request.query + [ProtocolMessage(role="bot", content=bot_reply)]
+                )
+                return request.model_copy(
+                    update={
+                        "query": [
+                            ProtocolMessage(
+                                role="system", content=SUGGESTED_REPLIES_SYSTEM_PROMPT
+                            ),
+                            ProtocolMessage(
+                                role="user", content=current_conversation_string
+                            ),
+                            ProtocolMessage(
+                                role="user",
+                                content=SUGGESTED_REPLIES_USER_PROMPT.format(word=word),
+                            ),
+                        ]
+                    }
+                )
+
             bot_reply = ""
-            async for msg in fp.stream_request(request, "ChatGPT", request.access_key):
-                bot_reply += msg.text
-                yield msg.model_copy()
-            print(bot_reply)
-
-            request.query = request.query + [
-                ProtocolMessage(role="bot", content=bot_reply)
-            ]
-            current_conversation_string = stringify_conversation(request.query)
-
-            request.query = [
-                ProtocolMessage(role="system", content=SUGGESTED_REPLIES_SYSTEM_PROMPT),
-                ProtocolMessage(role="user", content=current_conversation_string),
-                ProtocolMessage(
-                    role="user", content=SUGGESTED_REPLIES_USER_PROMPT.format(word=word)
-                ),
-            ]
-            response_text = ""
-            async for msg in fp.stream_request(
-                request, "Claude-3-Haiku", request.access_key
-            ):
-                response_text += msg.text
+            suggested_replies_task = None
+            try:
+                async for msg in fp.stream_request(
+                    request, "ChatGPT", request.access_key
+                ):
+                    timings.mark("answer_first_token")
+                    bot_reply += msg.text
+                    yield msg.model_copy()
+                    if (
+                        suggested_replies_task is None
+                        and len(bot_reply) >= SUGGESTED_REPLIES_PREFIX_LENGTH
+                    ):
+                        timings.mark("suggested_replies_start")
+                        suggested_replies_task = asyncio.create_task(
+                            collect_reply(
+                                make_suggested_replies_request(bot_reply),
+                                "Claude-3-Haiku",
+                            )
+                        )
+                timings.mark("answer_done")
+                print(bot_reply)
+
+                if suggested_replies_task is None:
+                    timings.mark("suggested_replies_start")
+                    suggested_replies_task = asyncio.create_task(
+                        collect_reply(
+                            make_suggested_replies_request(bot_reply), "Claude-3-Haiku"
+                        )
+                    )
+                response_text = await suggested_replies_task
+                timings.mark("suggested_replies_done")
+            finally:
+                if suggested_replies_task is not None:
+                    suggested_replies_task.cancel()
             print("suggested_reply", response_text)
+            print("stage_timings", timings.stages)
 
             suggested_replies = extract_suggested_replies(response_text)
 
@@ -396,57 +523,91 @@ class ChineseVocabBot(fp.PoeBot):
         )
 
         # tabluate the user's submission
+        timings = StageTimings()
         request.query = [
-            {
-                "role": "system",
-                "content": SYSTEM_TABULATION_PROMPT.format(
+            ProtocolMessage(
+                role="system",
+                content=SYSTEM_TABULATION_PROMPT.format(
                     word=word_info["simplified"],
                     pinyin=word_info["numerical_pinyin"],
                     meaning=word_info["translation"],
                 ),
-            }
+            )
         ] + request.query
         request.temperature = 0
         request.logit_bias = {"2746": -5, "36821": -10}  # "If"  # " |\n\n"
 
-        bot_reply = ""
-        async for msg in fp.stream_request(
-            request, "Llama-3-8b-Groq", request.access_key
-        ):
-            bot_reply += msg.text
-            yield msg.model_copy()
+        def make_judge_request(table):
+            return request.model_copy(
+                update={
+                    "query": [
+                        ProtocolMessage(
+                            role="user",
+                            content=JUDGE_SYSTEM_PROMPT.format(reply=table, word=word),
+                        )
+                    ]
+                }
+            )
 
-        yield self.text_event("\n\n")
+        # the judge starts as soon as the table rows have streamed
+        bot_reply = ""
+        judge_task = None
+        try:
+            async for msg in RESPONSE_CACHE.stream_request(request, "Llama-3-8b-Groq"):
+                timings.mark("tabulation_first_token")
+                bot_reply += msg.text
+                yield msg.model_copy()
+                if judge_task is None:
+                    table = get_complete_table(bot_reply)
+                    if table is not None:
+                        timings.mark("judge_start")
+                        judge_task = asyncio.create_task(
+                            collect_reply(make_judge_request(table), "Llama-3-8b-Groq")
+                        )
+            timings.mark("tabulation_done")
+
+            yield self.text_event("\n\n")
+
+            if judge_task is None and "-----" in bot_reply:
+                timings.mark("judge_start")
+                judge_task = asyncio.create_task(
+                    collect_reply(make_judge_request(bot_reply), "Llama-3-8b-Groq")
+                )
+            judge_reply = None
+            if judge_task is not None:
+                judge_reply = await judge_task
+                timings.mark("judge_done")
+        finally:
+            if judge_task is not None:
+                judge_task.cancel()
+        print("stage_timings", timings.stages)
 
         # make a judgement on correctness
-        if "-----" in bot_reply:
-            my_dict[conversation_submitted_key] = True
-            request.query = [
-                {
-                    "role": "user",
-                    "content": JUDGE_SYSTEM_PROMPT.format(reply=bot_reply, word=word),
-                }
-            ]
-            request.temperature = 0
-            judge_reply = ""
-            async for msg in fp.stream_request(
-                request, "Llama-3-8b-Groq", request.access_key
-            ):
-                judge_reply += msg.text
-                # yield self.text_event(msg.text)
-
+        if judge_reply is not None:
+            state[conversation_submitted_key] = True
             print(judge_reply, judge_reply.count(" correct"))
+            quality = 3  # partially correct, for the spaced-repetition schedule
             if (
                 "pinyin is correct" in judge_reply
                 and "tone is correct" in judge_reply
                 and "meaning is correct" in judge_reply
                 and word_info["numerical_pinyin"] in last_user_reply
             ):
-                my_dict[user_level_key] = level + 1
+                state[user_level_key] = level + 1
+                quality = 5
             elif (
                 judge_reply.count(" correct") == 0
             ):  # NB: note the space otherwise it matches incorrect
-                my_dict[user_level_key] = level - 1
+                state[user_level_key] = level - 1
+                quality = 1
+
+            # schedule the next review of the word
+            if "index" in word_info:  # not set for words sampled before scheduling
+                SCHEDULER.review(
+                    schedule, word_info["index"], quality, get_current_hours()
+                )
+                store_learner_state(state, user_schedule_key, schedule)
+                await SCHEDULER.item_index.register(my_dict)
 
             # deliver suggested replies
             yield PartialResponse(
@@ -469,4 +630,3 @@ class ChineseVocabBot(fp.PoeBot):
             },
             introduction_message="Say 'start' to get the Chinese word.",
         )
-
@@ -6,13 +6,18 @@ Test message:
 echo z > a.txt
 cat a.txt
 
+python bot_CmdLine.py benchmark  # per-command latency, new sandbox vs leased sandbox
+
 """
 
 from __future__ import annotations
 
+import asyncio
 import os
 import re
 import stat
+import sys
+import time
 from typing import AsyncIterable
 
 import fastapi_poe as fp
@@ -21,6 +26,9 @@ from fastapi_poe import PoeBot, make_app
 from fastapi_poe.types import PartialResponse, QueryRequest, SettingsResponse, SettingsRequest
 from modal import App, Image, asgi_app, Sandbox
 
+from output_stream import OutputBuffer, merge_streams, stream_output
+from sandbox_pool import SandboxPool, get_sandbox_pool, get_volume_name
+
 
 def extract_codes(reply):
     pattern = r"```(?:bash|sh)\n([\s\S]*?)\n```"
@@ -42,7 +50,55 @@ pwd
 
 Try copying the above, paste it, and reply."""
 
+class CommandKilled(Exception):
+    pass
+
+
+class CommandTimedOut(Exception):
+    pass
+
+
+async def with_deadline(events, timeout, timed_out):
+    """Yields the events until timeout seconds have passed, then a stderr event.
+
+    timed_out is a list, True is appended to it when the events are cut short.
+    """
+    start = time.perf_counter()
+    try:
+        while True:
+            remaining = timeout - (time.perf_counter() - start)
+            try:
+                event = await asyncio.wait_for(
+                    events.__anext__(), timeout=max(0, remaining)
+                )
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                timed_out.append(True)
+                yield "stderr", f"\nCommand timed out after {timeout} seconds.\n"
+                return
+            yield event
+    finally:
+        await events.aclose()
+
+
 class CmdLineBot(PoeBot):
+    # warm sandboxes kept for each user, see sandbox_pool.py
+    sandbox_pool_min_size = 1
+    sandbox_pool_max_size = 16
+    sandbox_idle_ttl = 300
+    # the pooled sandboxes live for an hour, a command is stopped well before that
+    command_timeout = 300
+
+    def get_sandbox_pool(self):
+        return get_sandbox_pool(
+            image_exec,
+            self.__class__.__name__,
+            min_size=self.sandbox_pool_min_size,
+            max_size=self.sandbox_pool_max_size,
+            idle_ttl=self.sandbox_idle_ttl,
+        )
+
     async def get_response(
         self, request: QueryRequest
     ) -> AsyncIterable[PartialResponse]:
@@ -64,44 +120,85 @@ class CmdLineBot(PoeBot):
         print("check")
         print(commands)
 
-        for command in commands:
-            nfs = modal.NetworkFileSystem.from_name(
-                f"vol-{hash(request.user_id)}", create_if_missing=True
-            )
+        # CmdLine has its own volume, its files are not mixed with those of PythonAgent
+        volume_name = get_volume_name(request.user_id, "vol-cmdline")
+        # the commands of a message run one after another in one leased sandbox
+        pool = self.get_sandbox_pool()
+        try:
+            async with pool.lease(volume_name) as sb:
+                for index, command in enumerate(commands):
+                    start = time.perf_counter()
+                    process = await sb.exec.aio(
+                        "bash",
+                        "-c",
+                        f"cd /cache && {command}",
+                        timeout=self.command_timeout,
+                    )
 
-            sb = Sandbox.create(
-                "bash",
-                "-c",
-                f"cd /cache && {command}",
-                image=image_exec,
-                network_file_systems={"/cache": nfs},
-            )
-            sb.wait()
+                    killed = False
 
-            print("sb.returncode", sb.returncode)
+                    async def kill():
+                        nonlocal killed
+                        killed = True
 
-            output = sb.stdout.read()
-            error = sb.stderr.read()
+                    # the output is streamed as it is produced
+                    output = OutputBuffer()
+                    error = OutputBuffer()
+                    timed_out = []
+                    async for text in stream_output(
+                        with_deadline(
+                            merge_streams(
+                                {"stdout": process.stdout, "stderr": process.stderr}
+                            ),
+                            self.command_timeout,
+                            timed_out,
+                        ),
+                        output,
+                        error,
+                        kill=kill,
+                    ):
+                        yield PartialResponse(text=text)
 
-            print("len(output)", len(output))
-            print("len(error)", len(error))
-            if error:  # for monitoring
-                print("error")
-                print(error)
+                    if killed:
+                        raise CommandKilled(command)
+                    if timed_out:
+                        # background processes of the command must not stay in the
+                        # sandbox, so it is terminated instead of returned to the pool
+                        raise CommandTimedOut(command)
 
-            nothing_returned = True
+                    # the command may close its output and keep running
+                    remaining = self.command_timeout - (time.perf_counter() - start)
+                    try:
+                        returncode = await asyncio.wait_for(
+                            process.wait.aio(), timeout=max(0, remaining)
+                        )
+                    except asyncio.TimeoutError:
+                        yield PartialResponse(
+                            text=f"\n\n```error\nCommand timed out after {self.command_timeout} seconds.\n```\n\n"
+                        )
+                        raise CommandTimedOut(command)
+                    print(
+                        "cmdline_command",
+                        index,
+                        "returncode",
+                        returncode,
+                        "seconds",
+                        round(time.perf_counter() - start, 3),
+                    )
 
-            if output:
-                yield PartialResponse(text=f"""```output\n{output}\n```\n""")
-                nothing_returned = False
-            if output and error:
-                yield PartialResponse(text="""\n\n""")
-            if error:
-                yield PartialResponse(text=f"""```error\n{error}\n```\n""")
-                nothing_returned = False
+                    print("len(output)", output.total)
+                    print("len(error)", error.total)
+                    if error.total:  # for monitoring
+                        print("error")
+                        print(error.getvalue())
 
-            if nothing_returned:
-                yield PartialResponse(text="""No output or error returned.""")
+                    if not output.total and not error.total and not returncode:
+                        yield PartialResponse(text="""No output or error returned.""")
+                    if returncode:
+                        yield PartialResponse(text=f"\n\nExit code {returncode}\n\n")
+        except (CommandKilled, CommandTimedOut) as e:
+            # the lease terminates the sandbox, which stops the command
+            print("cmdline_command stopped", repr(e))
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
@@ -109,3 +206,76 @@ class CmdLineBot(PoeBot):
             allow_attachments=False,  # to update when ready
             introduction_message=INTRODUCTION_MESSAGE,
         )
+
+
+BENCHMARK_COMMANDS = ["pwd", "echo z > a.txt", "cat a.txt", "ls", "rg --version"]
+
+
+def benchmark(commands=BENCHMARK_COMMANDS, num_messages=3):
+    """Runs the commands of a message num_messages times, with each approach.
+
+    "sandbox per command" creates a sandbox for each command, as the bot used to.
+    "leased sandbox" runs the commands of a message in one sandbox from the pool, the
+    first message waits for a cold sandbox and the later ones find a warm one. The
+    wait for the sandbox is counted in the latency of the first command.
+    """
+    app = modal.App.lookup("cmdline-benchmark", create_if_missing=True)
+    volume_name = "vol-cmdline-benchmark"
+
+    async def run_in_new_sandbox(command):
+        nfs = modal.NetworkFileSystem.from_name(volume_name, create_if_missing=True)
+        sb = await Sandbox.create.aio(
+            "bash",
+            "-c",
+            f"cd /cache && {command}",
+            image=image_exec,
+            network_file_systems={"/cache": nfs},
+            app=app,
+        )
+        await sb.stdout.read.aio()
+        await sb.wait.aio()
+
+    async def main():
+        latencies = {"sandbox per command": [], "leased sandbox": []}
+        for _ in range(num_messages):
+            message_latencies = []
+            for command in commands:
+                start = time.perf_counter()
+                await run_in_new_sandbox(command)
+                message_latencies.append(time.perf_counter() - start)
+            latencies["sandbox per command"].append(message_latencies)
+
+        pool = SandboxPool(image_exec, "CmdLineBenchmark", app=app)
+        try:
+            for _ in range(num_messages):
+                message_latencies = []
+                start = time.perf_counter()
+                async with pool.lease(volume_name) as sb:
+                    for command in commands:
+                        process = await sb.exec.aio(
+                            "bash", "-c", f"cd /cache && {command}"
+                        )
+                        await process.stdout.read.aio()
+                        await process.wait.aio()
+                        message_latencies.append(time.perf_counter() - start)
+                        start = time.perf_counter()
+                latencies["leased sandbox"].append(message_latencies)
+                await asyncio.sleep(5)  # the pool refills in the background
+        finally:
+            await pool.close()
+        return latencies
+
+    latencies = asyncio.run(main())
+    print("seconds per command, by message")
+    print(f"{'':>20} {'message':>8} " + " ".join(f"{c[:12]:>12}" for c in commands))
+    for name, by_message in latencies.items():
+        for message, message_latencies in enumerate(by_message):
+            print(
+                f"{name:>20} {message:>8} "
+                + " ".join(f"{latency:>12.3f}" for latency in message_latencies)
+            )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
@@ -20,18 +20,19 @@ from bot_PythonAgent import PythonAgentBot
 modal.app._is_container_app = False
 
 PYTHON_AGENT_SYSTEM_PROMPT = """
-You have access to the H-1B dataset in h1b.csv.
+You have access to the H-1B dataset in h1b.parquet.
 You write the Python code to answer my queries, whenever possible.
 
 When you return Python code
 - Encapsulate all Python code within triple backticks (i.e ```python) with newlines.
 - The Python code should either print something or plot something
 - When filtering rows by <class 'str'> columns, always use .str.contains(<string>, case=False) instead of ==
-- The Python code should start with `df = pd.read_csv('/h1b.csv')` (NOTE: this is in the root directory /)
+- The Python code should start with `df = pd.read_parquet('/h1b.parquet')` (NOTE: this is in the root directory /)
+- When you only need some columns, read only those with pd.read_parquet('/h1b.parquet', columns=[...])
 
-h1b.csv contains information about Labor application information from H-1B, H-1B1, and E-3 Programs.
+h1b.parquet contains information about Labor application information from H-1B, H-1B1, and E-3 Programs.
 
-h1b.csv contains the following columns
+h1b.parquet contains the following columns
 - 'CASE_NUMBER'
 - 'CASE_STATUS',
 - 'RECEIVED_DATE'
@@ -71,26 +72,26 @@ Withdrawn                  47581
 Denied                     13921
 Name: CASE_STATUS, type: <class 'str'>
 
-2020-10-07 00:00:00    30757
-2020-12-09 00:00:00    14006
-2020-12-10 00:00:00     9146
-2020-12-14 00:00:00     6610
-2020-12-11 00:00:00     6436
-Name: RECEIVED_DATE, type: <class 'str'>
-
-2020-10-15 00:00:00    29251
-2020-12-16 00:00:00    13401
-2020-12-17 00:00:00     9003
-2020-11-25 00:00:00     8926
-2021-02-22 00:00:00     6950
-Name: DECISION_DATE, type: <class 'str'>
-
-2020-10-15 00:00:00    1257
-2020-12-16 00:00:00     548
-2021-06-25 00:00:00     534
-2020-05-13 00:00:00     406
-2021-04-22 00:00:00     381
-Name: ORIGINAL_CERT_DATE, type: <class 'float'>
+2020-10-07    30757
+2020-12-09    14006
+2020-12-10     9146
+2020-12-14     6610
+2020-12-11     6436
+Name: RECEIVED_DATE, type: <class 'pandas.Timestamp'>
+
+2020-10-15    29251
+2020-12-16    13401
+2020-12-17     9003
+2020-11-25     8926
+2021-02-22     6950
+Name: DECISION_DATE, type: <class 'pandas.Timestamp'>
+
+2020-10-15    1257
+2020-12-16     548
+2021-06-25     534
+2020-05-13     406
+2021-04-22     381
+Name: ORIGINAL_CERT_DATE, type: <class 'pandas.api.typing.NaTType'>
 
 H-1B               2481378
 E-3 Australian       51029
@@ -116,19 +117,19 @@ Y    2506698
 N      39693
 Name: FULL_TIME_POSITION, type: <class 'str'>
 
-2022-10-01 00:00:00    102403
-2020-10-01 00:00:00     89445
-2021-10-01 00:00:00     85991
-2023-10-01 00:00:00     71318
-2021-01-01 00:00:00     14035
-Name: BEGIN_DATE, type: <class 'str'>
+2022-10-01    102403
+2020-10-01     89445
+2021-10-01     85991
+2023-10-01     71318
+2021-01-01     14035
+Name: BEGIN_DATE, type: <class 'pandas.Timestamp'>
 
-2025-09-30 00:00:00    100715
-2024-09-30 00:00:00     87862
-2023-09-30 00:00:00     86452
-2026-09-30 00:00:00     69101
-2024-06-30 00:00:00     13131
-Name: END_DATE, type: <class 'str'>
+2025-09-30    100715
+2024-09-30     87862
+2023-09-30     86452
+2026-09-30     69101
+2024-06-30     13131
+Name: END_DATE, type: <class 'pandas.Timestamp'>
 
 COGNIZANT TECHNOLOGY SOLUTIONS US CORP    74619
 AMAZON.COM SERVICES LLC                   54156
@@ -195,13 +196,13 @@ Name: WAGE_UNIT_OF_PAY, type: <class 'str'>
 2022    626084
 2020    577334
 2023    516668
-Name: YEAR, type: <class 'numpy.int64'>
+Name: YEAR, type: <class 'numpy.int16'>
 
 3    1018294
 2     753801
 1     411680
 4     362616
-Name: QUARTER, type: <class 'numpy.int64'>
+Name: QUARTER, type: <class 'numpy.int8'>
 """
 
 # To print the statistics
@@ -211,31 +212,23 @@ Name: QUARTER, type: <class 'numpy.int64'>
 #         "type: " + str(type(df[column][0]))
 #     ))
 #     print()
+# or, in the image, python /h1b_dataset.py statistics /h1b.parquet
 
 
-CODE_WITH_WRAPPERS = """\
+CODE_WITH_WRAPPERS = (
+    """\
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import savefig
 import warnings
 import pandas as pd
 
 pd.set_option('display.max_columns', None)
 warnings.simplefilter(action='ignore', category=pd.errors.DtypeWarning)
-
-def save_image(filename):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            savefig(filename)
-        return wrapper
-    return decorator
-
-plt.show = save_image('image.png')(plt.show)
-plt.savefig = save_image('image.png')(plt.savefig)
-
+"""
+    + bot_PythonAgent.ARTIFACTS_WRAPPER
+    + """
 {code}
 """
+)
 
 SIMULATED_USER_SUFFIX_PROMPT = """
 If there is an issue, you will fix the Python code.
@@ -274,10 +267,13 @@ IMAGE_EXEC = (
         "openpyxl",
         "cartopy",
         "wordcloud",
+        "pyarrow",
     )
     .copy_local_file(
         "h1b.csv", "h1b.csv"
     )
+    .copy_local_file("h1b_dataset.py", "/h1b_dataset.py")
+    .run_commands("python /h1b_dataset.py /h1b.csv /h1b.parquet")  # see h1b_dataset.py
 )
 
 
@@ -29,55 +29,59 @@ There are no LLM calls for this bot.
 
 from __future__ import annotations
 
-import math
 import random
 import re
-from collections import defaultdict
 from typing import AsyncIterable
 
 import fastapi_poe as fp
-import pandas as pd
+import numpy as np
 from modal import App, Dict, Image, asgi_app
 
+from kana_index import load_kana_index
+from learner_state import (
+    ItemIndex,
+    LearnerState,
+    load_learner_state,
+    store_learner_state,
+)
+from state_session import StateSession
+
 app = App("poe-bot-JapaneseKana")
 my_dict = Dict.from_name("dict-JapaneseKana", create_if_missing=True)
 
-df = pd.read_csv("japanese_kana.csv")
-# using https://github.com/krmanik/HSK-3.0-words-list/tree/main/HSK%20List
-# see also https://www.mdbg.net/chinese/dictionary?page=cedict
-
-records = df.to_dict(orient="records")
-records = [{k: v for k, v in record.items() if pd.notna(v)} for record in records]
-
-QUESTION_TUPLE_TO_CORRECT_ANSWERS = defaultdict(list)
-QUESTION_TUPLE_TO_WRONG_ANSWERS = defaultdict(list)
-QUESTION_TUPLE_TO_QUESTION_TUPLE = defaultdict(set)
-
-for row in records:
-    for k, v in row.items():
-        if "answer" in k:
-            QUESTION_TUPLE_TO_CORRECT_ANSWERS[
-                row["question"], row["type"], row["class"]
-            ].append(v)
-        if "wrong" in k:
-            QUESTION_TUPLE_TO_WRONG_ANSWERS[
-                row["question"], row["type"], row["class"]
-            ].append(v)
-    del row
-
-for row1 in records:
-    for row2 in records:
-        for k1, v1 in row1.items():
-            if "answer" in k1 or "wrong" in k1:
-                if v1 == row2["question"]:
-                    QUESTION_TUPLE_TO_QUESTION_TUPLE[
-                        row1["question"], row1["type"], row1["class"]
-                    ].add((row2["question"], row2["type"], row2["class"]))
-                    QUESTION_TUPLE_TO_QUESTION_TUPLE[
-                        row2["question"], row2["type"], row2["class"]
-                    ].add((row1["question"], row1["type"], row1["class"]))
-        del row2
-    del row1
+# the relations between questions are precomputed by kana_index.py at image build time
+(
+    QUESTION_TUPLE_TO_CORRECT_ANSWERS,
+    QUESTION_TUPLE_TO_WRONG_ANSWERS,
+    QUESTION_TUPLE_TO_QUESTION_TUPLE,
+) = load_kana_index("japanese_kana.csv", "japanese_kana_index.json")
+
+# the per-user attempts and failures are arrays aligned to this ordering
+QUESTION_TUPLES = list(QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys())
+QUESTION_TUPLE_TO_INDEX = {
+    question_tuple: index for index, question_tuple in enumerate(QUESTION_TUPLES)
+}
+QUESTION_TYPES = np.array([question_tuple[1] for question_tuple in QUESTION_TUPLES])
+QUESTION_CLASSES = np.array([question_tuple[2] for question_tuple in QUESTION_TUPLES])
+QUESTION_INDEX_TO_RELATED_INDICES = [
+    np.array(
+        sorted(
+            QUESTION_TUPLE_TO_INDEX[question_tuple_related]
+            for question_tuple_related in QUESTION_TUPLE_TO_QUESTION_TUPLE[
+                question_tuple
+            ]
+        ),
+        dtype=np.int64,
+    )
+    for question_tuple in QUESTION_TUPLES
+]
+QUESTION_ITEM_INDEX = ItemIndex(
+    "JapaneseKana", ["\t".join(question_tuple) for question_tuple in QUESTION_TUPLES]
+)
+LEARNER_STATE_INITIAL_VALUES = {
+    "attempts": 3 / len(QUESTION_TUPLES),
+    "failures": 1.5 / len(QUESTION_TUPLES),
+}
 
 # print("QUESTION_TUPLE_TO_CORRECT_ANSWERS", QUESTION_TUPLE_TO_CORRECT_ANSWERS)
 # print("QUESTION_TUPLE_TO_WRONG_ANSWERS", QUESTION_TUPLE_TO_WRONG_ANSWERS)
@@ -123,12 +127,20 @@ def get_user_options_key(user_id):
     return f"JapaneseKana-options-{user_id}"
 
 
+def get_user_learner_key(user_id):
+    # versioned by the header of the learner state rather than by VERSION
+    assert user_id.startswith("u")
+    return f"JapaneseKana-learner-{user_id}"
+
+
 def get_user_attempts_key(user_id):
+    # legacy, replaced by get_user_learner_key
     assert user_id.startswith("u")
     return f"JapaneseKana-attempts-{VERSION}-{user_id}"
 
 
 def get_user_failures_key(user_id):
+    # legacy, replaced by get_user_learner_key
     assert user_id.startswith("u")
     return f"JapaneseKana-failures-{VERSION}-{user_id}"
 
@@ -143,6 +155,35 @@ def get_conversation_answers_key(conversation_id):
     return f"JapaneseKana-answers-{VERSION}-{conversation_id}"
 
 
+def get_request_keys(request):
+    # every key that get_response reads or writes, loaded in one round trip
+    return [
+        get_user_options_key(request.user_id),
+        *LearnerState.get_keys(
+            get_user_learner_key(request.user_id), QUESTION_ITEM_INDEX
+        ),
+        get_user_attempts_key(request.user_id),
+        get_user_failures_key(request.user_id),
+        get_conversation_question_key(request.conversation_id),
+        get_conversation_answers_key(request.conversation_id),
+    ]
+
+
+def load_user_counts(stored, initial_value):
+    # legacy counts were stored as an array aligned to QUESTION_TUPLES
+    # or as a dict keyed by question tuple
+    if stored is None:
+        return np.full(len(QUESTION_TUPLES), initial_value)
+    if isinstance(stored, dict):
+        return np.array(
+            [
+                stored.get(question_tuple, initial_value)
+                for question_tuple in QUESTION_TUPLES
+            ]
+        )
+    return np.asarray(stored, dtype=np.float64)
+
+
 # Pattern to keep lowercase, uppercase alphabets and Hiragana characters
 pattern = r"[^a-zA-Z\u3040-\u309F\u30A0-\u30FF]+"
 
@@ -156,6 +197,15 @@ def compare_answer(submission, reference):
 class JapaneseKanaBot(fp.PoeBot):
     async def get_response(
         self, request: fp.QueryRequest
+    ) -> AsyncIterable[fp.PartialResponse]:
+        async with StateSession(
+            my_dict, get_request_keys(request), name="JapaneseKana"
+        ) as state:
+            async for msg in self.get_response_with_state(request, state):
+                yield msg
+
+    async def get_response_with_state(
+        self, request: fp.QueryRequest, state: StateSession
     ) -> AsyncIterable[fp.PartialResponse]:
         user_options_key = get_user_options_key(request.user_id)
         conversation_answers_key = get_conversation_answers_key(request.conversation_id)
@@ -164,15 +214,16 @@ class JapaneseKanaBot(fp.PoeBot):
         )
         user_failures_key = get_user_failures_key(request.user_id)
         user_attempts_key = get_user_attempts_key(request.user_id)
+        user_learner_key = get_user_learner_key(request.user_id)
 
         last_message = request.query[-1].content
 
         if last_message == DISABLE_OPTIONS_COMMAND:
-            my_dict[user_options_key] = False
-            del my_dict[conversation_answers_key]
+            state[user_options_key] = False
+            del state[conversation_answers_key]
         elif last_message == ENABLE_OPTIONS_COMMAND:
-            my_dict[user_options_key] = True
-            del my_dict[conversation_answers_key]
+            state[user_options_key] = True
+            del state[conversation_answers_key]
 
         # disable suggested replies by default
         yield fp.MetaResponse(
@@ -183,48 +234,42 @@ class JapaneseKanaBot(fp.PoeBot):
             suggested_replies=False,
         )
 
-        user_failures = {
-            k: 1.5 / len(QUESTION_TUPLE_TO_CORRECT_ANSWERS)
-            for k in QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys()
-        }
-        if user_failures_key in my_dict:
-            user_failures = my_dict[user_failures_key]
-
-        user_attempts = {
-            k: 3 / len(QUESTION_TUPLE_TO_CORRECT_ANSWERS)
-            for k in QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys()
-        }
-        # print("user_attempts", user_attempts)
-        if user_attempts_key in my_dict:
-            user_attempts = my_dict[user_attempts_key]
+        learner_state = await load_learner_state(
+            my_dict,
+            QUESTION_ITEM_INDEX,
+            state,
+            user_learner_key,
+            LEARNER_STATE_INITIAL_VALUES,
+        )
+        if user_learner_key not in state and user_attempts_key in state:
+            # carry over the history stored in the legacy format
+            for field, key in (
+                ("attempts", user_attempts_key),
+                ("failures", user_failures_key),
+            ):
+                learner_state[field][:] = load_user_counts(
+                    state.get(key), LEARNER_STATE_INITIAL_VALUES[field]
+                )
+        # views into learner_state, updated in place
+        user_attempts = learner_state["attempts"]
+        user_failures = learner_state["failures"]
 
         old_question = None
-        if conversation_answers_key in my_dict and conversation_question_key in my_dict:
-            question_tuple = my_dict[conversation_question_key]
-            answers = my_dict[conversation_answers_key]
+        if conversation_answers_key in state and conversation_question_key in state:
+            question_tuple = state[conversation_question_key]
+            answers = state[conversation_answers_key]
             old_question = question_tuple
-            # print(user_attempts)
+            question_index = QUESTION_TUPLE_TO_INDEX[question_tuple]
+            related_indices = QUESTION_INDEX_TO_RELATED_INDICES[question_index]
             for answer in answers:
                 if compare_answer(last_message, answer):
                     # actions if correct
                     print("correct")
                     yield self.text_event(STATEMENT_CORRECT)
-                    user_attempts[question_tuple] += 1
-
-                    for question_tuple_related in QUESTION_TUPLE_TO_QUESTION_TUPLE[
-                        question_tuple
-                    ]:
-                        print(question_tuple_related)
-                        user_attempts[question_tuple_related] += 0.1
-
-                    for (
-                        question_tuple_related
-                    ) in QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys():
-                        if (
-                            question_tuple_related[1] == question_tuple[1]
-                        ):  # same question type
-                            user_attempts[question_tuple_related] += 0.01
-
+                    user_attempts[question_index] += 1
+                    user_attempts[related_indices] += 0.1
+                    # same question type
+                    user_attempts[QUESTION_TYPES == question_tuple[1]] += 0.01
                     break
             else:
                 # actions if wrong
@@ -233,57 +278,46 @@ class JapaneseKanaBot(fp.PoeBot):
                 yield self.text_event(
                     STATEMENT_WRONG.format(answers=" / ".join(answers))
                 )
-                user_failures[question_tuple] += 1
-                user_attempts[question_tuple] += 1
-
-                for question_tuple_related in QUESTION_TUPLE_TO_QUESTION_TUPLE[
-                    question_tuple
-                ]:
-                    user_failures[question_tuple_related] += 0.1
-                    user_attempts[question_tuple_related] += 0.1
-
-                for question_tuple_related in QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys():
-                    if (
-                        question_tuple_related[-1] == question_tuple[-1]
-                    ):  # same question class
-                        user_failures[question_tuple_related] += 0.01
-                        user_attempts[question_tuple_related] += 0.01
-
-            my_dict[user_failures_key] = user_failures
-            my_dict[user_attempts_key] = user_attempts
+                user_failures[question_index] += 1
+                user_attempts[question_index] += 1
+                user_failures[related_indices] += 0.1
+                user_attempts[related_indices] += 0.1
+                # same question class
+                same_class = QUESTION_CLASSES == question_tuple[-1]
+                user_failures[same_class] += 0.01
+                user_attempts[same_class] += 0.01
+
+            # the state is one record, written back once per answer
+            store_learner_state(state, user_learner_key, learner_state)
+            state.pop(user_attempts_key)
+            state.pop(user_failures_key)
+            await QUESTION_ITEM_INDEX.register(my_dict)
             yield self.text_event("\n\n---\n\n---\n\n---\n\n")
 
         # selection with upper confidence bound
-        maxscore = 0
-        maxquestion = 0
-
-        t = sum(user_attempts.values()) - 1
-        for question_tuple in QUESTION_TUPLE_TO_CORRECT_ANSWERS.keys():
-            # TODO: apply filtering logic here
-            if old_question == question_tuple:
-                continue
-            mean = user_failures[question_tuple] / user_attempts[question_tuple]
-            c = 0.01
-            # mean + c * sqrt(ln(t) / attempts)
-            score = (
-                mean
-                + c * math.sqrt(math.log(t) / user_attempts[question_tuple])
-                + random.randint(0, 1) / 10
-            )
-            if score > maxscore:
-                maxscore = score
-                maxquestion = question_tuple
-
-        question_tuple = maxquestion
+        # mean + c * sqrt(ln(t) / attempts)
+        # TODO: apply filtering logic here
+        t = user_attempts.sum() - 1
+        c = 0.01
+        scores = (
+            user_failures / user_attempts
+            + c * np.sqrt(np.log(t) / user_attempts)
+            + np.random.randint(0, 2, size=len(QUESTION_TUPLES)) / 10
+        )
+        if old_question is not None:
+            scores[QUESTION_TUPLE_TO_INDEX[old_question]] = -np.inf
+        question_index = int(np.argmax(scores))
+        maxscore = scores[question_index]
+        question_tuple = QUESTION_TUPLES[question_index]
 
         yield self.text_event(
-            f"{user_attempts[question_tuple] - user_failures[question_tuple]:.2f} / {user_attempts[question_tuple]:.2f} | {maxscore:.4f}\n\n"
+            f"{user_attempts[question_index] - user_failures[question_index]:.2f} / {user_attempts[question_index]:.2f} | {maxscore:.4f}\n\n"
         )
 
-        my_dict[conversation_answers_key] = QUESTION_TUPLE_TO_CORRECT_ANSWERS[
+        state[conversation_answers_key] = QUESTION_TUPLE_TO_CORRECT_ANSWERS[
             question_tuple
         ]
-        my_dict[conversation_question_key] = question_tuple
+        state[conversation_question_key] = question_tuple
 
         question_content, question_type, question_class = question_tuple
         if question_type == "hiragana_to_romaji_base":
@@ -307,12 +341,12 @@ class JapaneseKanaBot(fp.PoeBot):
             )
             yield self.text_event(question_text)
 
-        if user_options_key not in my_dict:
-            my_dict[user_options_key] = True
+        if user_options_key not in state:
+            state[user_options_key] = True
 
         options = [x for x in QUESTION_TUPLE_TO_WRONG_ANSWERS[question_tuple]]
 
-        if my_dict[user_options_key]:
+        if state[user_options_key]:
             options = set(options)
             options = list(options)[:3] + [
                 random.choice(QUESTION_TUPLE_TO_CORRECT_ANSWERS[question_tuple])
@@ -323,7 +357,7 @@ class JapaneseKanaBot(fp.PoeBot):
                 yield self.suggested_reply_event(text=option)
 
         if len(request.query) == 2:
-            if my_dict[user_options_key]:
+            if state[user_options_key]:
                 yield self.suggested_reply_event(text=DISABLE_OPTIONS_COMMAND)
             else:
                 yield self.suggested_reply_event(text=ENABLE_OPTIONS_COMMAND)
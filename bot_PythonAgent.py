@@ -10,12 +10,14 @@ list directory
 
 from __future__ import annotations
 
+import asyncio
+import json
+import os
 import re
 import textwrap
 from typing import AsyncIterable, Optional
 
 import modal
-import requests
 from fastapi_poe import PoeBot
 from fastapi_poe.client import MetaMessage, stream_request
 from fastapi_poe.types import (
@@ -25,7 +27,14 @@ from fastapi_poe.types import (
     SettingsRequest,
     SettingsResponse,
 )
-from modal import Image, Sandbox
+from modal import Image
+
+from attachment_upload import schedule_upload
+from context_budget import compact_messages
+from fence_scanner import FenceScanner
+from output_stream import OutputBuffer, stream_output
+from python_kernel import get_kernel_manager
+from sandbox_pool import get_sandbox_pool, get_volume_name
 
 
 PYTHON_AGENT_SYSTEM_PROMPT = """
@@ -60,39 +69,92 @@ sympy
 yfinance
 """
 
-# probably there is a better method to retain memory than to pickle
-CODE_WITH_WRAPPERS = """\
-import numpy as np
+# the wrappers are installed once per kernel, they look up _artifacts of the current run
+ARTIFACTS_WRAPPER = """\
+import builtins
+import json
+import os
+import uuid
+
 import matplotlib.pyplot as plt
-from matplotlib.pyplot import savefig
-
-def save_image(filename):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            savefig(filename)
-        return wrapper
-    return decorator
-
-plt.show = save_image('image.png')(plt.show)
-plt.savefig = save_image('image.png')(plt.savefig)
-
-import dill, os, pickle
-if os.path.exists("{conversation_id}.dill"):
-    try:
-        with open("{conversation_id}.dill", 'rb') as f:
-            dill.load_session(f)
-    except:
-        pass
 
-{code}
+# figures of the previous run are still open in the kernel
+plt.close('all')
+
+# the manifest lists the files written by this run, the bot uploads the files it lists
+_artifacts_manifest = '/cache/.artifacts/{conversation_id}.json'
+_artifacts = []
+_artifact_figures = set()  # numbers of the figures already saved in this run
+
+def _write_artifacts_manifest():
+    os.makedirs(os.path.dirname(_artifacts_manifest), exist_ok=True)
+    with getattr(builtins.open, 'original', builtins.open)(_artifacts_manifest, 'w') as f:
+        json.dump(_artifacts, f)
+
+def _add_artifact(path):
+    path = os.path.relpath(os.path.abspath(path), '/cache')
+    # only files on the volume can be fetched by the bot
+    if not path.startswith('..') and path not in _artifacts:
+        _artifacts.append(path)
+        # written for every file, so it is complete even if the code fails later
+        _write_artifacts_manifest()
+
+def _record_open(open):
+    def wrapper(file, mode='r', *args, **kwargs):
+        f = open(file, mode, *args, **kwargs)
+        if isinstance(file, (str, os.PathLike)) and set(mode) & set('wax+'):
+            _add_artifact(os.fspath(file))
+        return f
+    wrapper.original = open
+    return wrapper
+
+def _record_savefig(savefig):
+    def wrapper(*args, **kwargs):
+        fname = args[0] if args else kwargs.get('fname')
+        # a figure saved to a file is not saved again by plt.show
+        if isinstance(fname, (str, os.PathLike)) and plt.get_fignums():
+            _artifact_figures.add(plt.gcf().number)
+        return savefig(*args, **kwargs)
+    wrapper.records_artifacts = True
+    return wrapper
+
+def _save_figures(show):
+    def wrapper(*args, **kwargs):
+        for number in plt.get_fignums():
+            if number not in _artifact_figures:
+                _artifact_figures.add(number)
+                plt.figure(number).savefig(f'/cache/.artifacts/{{uuid.uuid4().hex}}.png')
+        return show(*args, **kwargs)
+    wrapper.records_artifacts = True
+    return wrapper
+
+# the functions are already wrapped if an earlier run in the kernel wrapped them
+if not hasattr(builtins.open, 'original'):
+    builtins.open = _record_open(builtins.open)
+if not getattr(plt.show, 'records_artifacts', False):
+    plt.show = _save_figures(plt.show)
+    plt.savefig = _record_savefig(plt.savefig)
+
+_write_artifacts_manifest()
+"""
 
-try:
-    with open('{conversation_id}.dill', 'wb') as f:
-        dill.dump_session(f)
-except:
-    pass
+# the code runs in a kernel that keeps the variables of the conversation, see python_kernel.py
+CODE_WITH_WRAPPERS = (
+    """\
+import numpy as np
+"""
+    + ARTIFACTS_WRAPPER
+    + """
+{code}
 """
+)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+
+def is_image(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
 
 SIMULATED_USER_REPLY_OUTPUT_ONLY = """\
 Your code was executed and this is the output.
@@ -203,6 +265,96 @@ class PythonAgentBot(PoeBot):
     code_with_wrappers = CODE_WITH_WRAPPERS
     simulated_user_suffix_prompt = SIMULATED_USER_SUFFIX_PROMPT
     image_exec = IMAGE_EXEC
+    # warm sandboxes kept for each user, see sandbox_pool.py
+    sandbox_pool_min_size = 1
+    sandbox_pool_max_size = 16
+    sandbox_idle_ttl = 300
+    # kernels that keep the variables of each conversation, see python_kernel.py
+    kernel_idle_timeout = 600
+    max_kernels = 8
+    run_timeout = 300
+    # files written by a run that are uploaded to the chat
+    max_artifacts = 10
+    max_artifact_bytes = 10 * 1024 * 1024
+    # tokens of the conversation sent to the prompt bot, see context_budget.py
+    context_token_budget = 32000
+
+    def get_sandbox_pool(self):
+        return get_sandbox_pool(
+            self.image_exec,
+            self.__class__.__name__,
+            min_size=self.sandbox_pool_min_size,
+            max_size=self.sandbox_pool_max_size,
+            idle_ttl=self.sandbox_idle_ttl,
+        )
+
+    def get_kernel_manager(self):
+        return get_kernel_manager(
+            self.get_sandbox_pool(),
+            idle_timeout=self.kernel_idle_timeout,
+            max_kernels=self.max_kernels,
+            run_timeout=self.run_timeout,
+        )
+
+    async def read_artifact(self, nfs, path):
+        """Returns the content of the file, or None if it is larger than max_artifact_bytes."""
+        chunks = []
+        size = 0
+        async for chunk in nfs.read_file.aio(path):
+            size += len(chunk)
+            if size > self.max_artifact_bytes:
+                return None
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def get_artifacts(self, nfs, conversation_id):
+        """Returns the paths in the artifacts manifest of the last run, and removes it."""
+        manifest_path = f".artifacts/{conversation_id}.json"
+        try:
+            manifest = await self.read_artifact(nfs, manifest_path)
+        except Exception as e:  # e.g. the wrapper did not run
+            print("could not read artifacts manifest", e)
+            return []
+        # a run that fails before the wrapper, e.g. on a SyntaxError, writes no
+        # manifest, and must not find the one of the previous run
+        try:
+            await nfs.remove_file.aio(manifest_path)
+        except Exception as e:
+            print("could not remove artifacts manifest", e)
+        if manifest is None:
+            print("artifacts manifest too large")
+            return []
+        return json.loads(manifest)[: self.max_artifacts]
+
+    async def upload_artifacts(self, nfs, artifacts, message_id):
+        """Uploads the artifacts concurrently, returns [(path, attachment upload response)]."""
+
+        async def upload(path):
+            file_data = await self.read_artifact(nfs, path)
+            if file_data is None:
+                print("artifact too large", path)
+                return None
+            attachment_upload_response = await self.post_message_attachment(
+                message_id=message_id,
+                file_data=file_data,
+                filename=os.path.basename(path),
+                is_inline=is_image(path),
+            )
+            # the figures saved by the wrapper are not kept on the volume
+            if path.startswith(".artifacts/"):
+                await nfs.remove_file.aio(path)
+            return attachment_upload_response
+
+        responses = await asyncio.gather(
+            *[upload(path) for path in artifacts], return_exceptions=True
+        )
+        uploaded = []
+        for path, response in zip(artifacts, responses):
+            if isinstance(response, Exception):
+                print("could not upload artifact", path, repr(response))
+            elif response is not None:
+                uploaded.append((path, response))
+        return uploaded
 
     def extract_code(self, text):
         pattern = r"\n```python([\s\S]*?)\n```"
@@ -235,18 +387,15 @@ class PythonAgentBot(PoeBot):
         for query in request.query:
             query.message_id = ""
 
-        nfs = modal.NetworkFileSystem.from_name(f"vol-{request.user_id[::-1][:32][::-1]}", create_if_missing=True)
+        volume_name = get_volume_name(request.user_id)
+        nfs = modal.NetworkFileSystem.from_name(volume_name, create_if_missing=True)
 
         for query in request.query:
             for attachment in query.attachments:
                 query.content += f"\n\nThe user has provided {attachment.name} in the current directory."
 
-        # upload files in latest user message
-        for attachment in request.query[-1].attachments:
-            r = requests.get(attachment.url)
-            with open(attachment.name, "wb") as f:
-                f.write(r.content)
-            nfs.add_local_file(attachment.name, attachment.name)
+        # upload files in latest user message, while the model writes the code
+        uploads = schedule_upload(nfs, volume_name, request.query[-1].attachments)
 
         # for query in request.query:
         # bot calling doesn't allow attachments
@@ -255,9 +404,13 @@ class PythonAgentBot(PoeBot):
         for code_iteration_count in range(self.code_iteration_limit - 1):
             print("code_iteration_count", code_iteration_count)
 
+            # earlier replies and outputs are truncated to fit the budget
+            request.query = compact_messages(request.query, self.context_token_budget)
+
             print(request)
 
             current_bot_reply = ""
+            fence_scanner = FenceScanner("python")
             async for msg in stream_request(request, self.prompt_bot, request.api_key):
                 if isinstance(msg, MetaMessage):
                     continue
@@ -268,7 +421,7 @@ class PythonAgentBot(PoeBot):
                 else:
                     current_bot_reply += msg.text
                     yield self.text_event(msg.text)
-                    if self.extract_code(current_bot_reply):
+                    if fence_scanner.feed(msg.text):
                         # break when a Python code block is detected
                         break
 
@@ -285,92 +438,65 @@ class PythonAgentBot(PoeBot):
             print(code)
             wrapped_code = self.code_with_wrappers.format(code=code, conversation_id=request.conversation_id)
 
-            # upload python script
-            with open(f"{request.conversation_id}.py", "w") as f:
-                f.write(wrapped_code)
-            nfs.add_local_file(
-                f"{request.conversation_id}.py", f"{request.conversation_id[::-1][:32][::-1]}.py"
-            )
-
-            # execute code
-            sb = Sandbox.create(
-                "bash",
-                "-c",
-                f"cd /cache && python {request.conversation_id[::-1][:32][::-1]}.py",
-                image=self.image_exec,
-                network_file_systems={"/cache": nfs},
-            )
-            sb.wait()
-
-            print("sb.returncode", sb.returncode)
-
-            output = sb.stdout.read()
-            error = sb.stderr.read()
-
-            print("len(output)", len(output))
-            print("len(error)", len(error))
+            # the code may read the attachments
+            await uploads
+
+            # execute code in the kernel of the conversation, streaming the output
+            kernels = self.get_kernel_manager()
+            output_buffer = OutputBuffer()
+            error_buffer = OutputBuffer()
+            async for text in stream_output(
+                kernels.run(volume_name, request.conversation_id, wrapped_code),
+                output_buffer,
+                error_buffer,
+                kill=lambda: kernels.kill(request.conversation_id),
+                # the kernel stops the code at its output limit, this is the backstop
+                kill_size=2 * kernels.output_limit,
+            ):
+                yield PartialResponse(text=text)
+            output = output_buffer.getvalue()
+            error = error_buffer.getvalue()
+
+            print("len(output)", output_buffer.total)
+            print("len(error)", error_buffer.total)
             if error:  # for monitoring
                 print("error")
                 print(error)
 
             current_user_simulated_reply = ""
             if output and error:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
-                )
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
-                )
                 current_user_simulated_reply = (
                     SIMULATED_USER_REPLY_OUTPUT_AND_ERROR.format(
                         output=output, error=error
                     )
                 )
             elif output:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
-                )
                 current_user_simulated_reply = SIMULATED_USER_REPLY_OUTPUT_ONLY.format(
                     output=output
                 )
             elif error:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
-                )
                 current_user_simulated_reply = SIMULATED_USER_REPLY_ERROR_ONLY.format(
                     error=error
                 )
             else:
                 current_user_simulated_reply = SIMULATED_USER_REPLY_NO_OUTPUT_OR_ERROR
 
-            # upload image and get image url
-            image_data = None
-            if any("image.png" in str(entry) for entry in nfs.listdir("*")):
-                # some roundabout way to check if image file is in directory
-                with open("image.png", "wb") as f:
-                    for chunk in nfs.read_file("image.png"):
-                        f.write(chunk)
-
-                image_data = None
-                with open("image.png", "rb") as f:
-                    image_data = f.read()
-
-                if image_data:
-                    attachment_upload_response = await self.post_message_attachment(
-                        message_id=original_message_id,
-                        file_data=image_data,
-                        filename="image.png",
-                        is_inline=True,
-                    )
-                    print("inline_ref", attachment_upload_response.inline_ref)
+            # upload the figures and files that the code wrote
+            image_found = False
+            artifacts = await self.get_artifacts(nfs, request.conversation_id)
+            for path, attachment_upload_response in await self.upload_artifacts(
+                nfs, artifacts, original_message_id
+            ):
+                print("artifact", path, attachment_upload_response.inline_ref)
+                if is_image(path):
+                    image_found = True
                     yield PartialResponse(
                         text=f"\n\n![plot][{attachment_upload_response.inline_ref}]\n\n"
                     )
-                    nfs.remove_file("image.png")
 
             yield self.text_event("\n")
 
-            if image_data is not None:
+            if image_found:
                 current_user_simulated_reply += SIMULATED_USER_SUFFIX_IMAGE_FOUND
             else:
                 if "matplotlib" in code:
@@ -7,6 +7,7 @@ assert False
 
 """
 
+import io
 import re
 from typing import AsyncIterable
 
@@ -17,6 +18,8 @@ from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Sandbox
 from sse_starlette.sse import ServerSentEvent
 
+from output_stream import OutputBuffer, merge_streams, stream_output
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 # https://modalbetatesters.slack.com/archives/C031Z7H15DG/p1675177408741889?thread_ts=1675174647.477169&cid=C031Z7H15DG
@@ -49,20 +52,6 @@ Try copying the above, paste it, and reply.
 """.strip()
 
 
-def format_output(captured_output, captured_error="") -> str:
-    lines = []
-
-    if captured_output:
-        line = f"\n```output\n{captured_output}\n```"
-        lines.append(line)
-
-    if captured_error:
-        line = f"\n```error\n{captured_error}\n```"
-        lines.append(line)
-
-    return "\n".join(lines)
-
-
 def extract_code(reply):
     pattern = r"```python([\s\S]*?)```"
     matches = re.findall(pattern, reply)
@@ -155,49 +144,42 @@ class RunPythonCodeBot(PoeBot):
 
         nfs = modal.NetworkFileSystem.from_name(f"vol-{request.user_id[::-1][:32][::-1]}", create_if_missing=True)
         # upload python script
-        with open(f"{request.conversation_id}.py", "w") as f:
-            f.write(code)
-        nfs.add_local_file(
-            f"{request.conversation_id}.py", f"{request.conversation_id[::-1][:32][::-1]}.py"
+        await nfs.write_file.aio(
+            f"{request.conversation_id[::-1][:32][::-1]}.py", io.BytesIO(code.encode())
         )
 
-        # execute code
-        sb = Sandbox.create(
+        # execute code, the output is streamed as it is produced
+        sb = await Sandbox.create.aio(
             "bash",
             "-c",
             f"cd /cache && python {request.conversation_id[::-1][:32][::-1]}.py",
             image=IMAGE_EXEC,
             network_file_systems={"/cache": nfs},
         )
-        sb.wait()
 
-        print("sb.returncode", sb.returncode)
+        killed = False
 
-        output = sb.stdout.read()
-        error = sb.stderr.read()
+        async def kill():
+            nonlocal killed
+            killed = True
+            await sb.terminate.aio()
 
-        if not output and not error:
-            yield self.text_event("No output or error recorded.")
-            return
+        output = OutputBuffer()
+        error = OutputBuffer()
+        async for text in stream_output(
+            merge_streams({"stdout": sb.stdout, "stderr": sb.stderr}),
+            output,
+            error,
+            kill=kill,
+        ):
+            yield self.text_event(text)
 
-        if output:
-            if len(output) > 5000:
-                yield self.text_event(
-                    "There is too much output, this is the partial output."
-                )
-                output = output[:5000]
-            reply_string = format_output(output)
-            yield self.text_event(reply_string)
-
-        if error:
-            if len(error) > 5000:
-                yield self.text_event(
-                    "There is too much error, this is the partial error."
-                )
-                error = error[:5000]
-            reply_string = format_output(error)
-            yield self.text_event(reply_string)
+        if not killed:
+            await sb.wait.aio()
+            print("sb.returncode", sb.returncode)
 
+        if not output.total and not error.total:
+            yield self.text_event("No output or error recorded.")
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
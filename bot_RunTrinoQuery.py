@@ -8,24 +8,17 @@ SELECT nationkey, name FROM tpch.sf1.nation
 """
 
 import re
-import os
 import textwrap
 from typing import AsyncIterable
 
-import trino
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 from trino.exceptions import TrinoUserError
 
-
-def format_output(columns, rows) -> str:
-    output = " | " + "|".join(column.name for column in columns) + " | "
-    output += "\n" + " | " + " | ".join("-" for _ in columns) + " | "
-    for row in rows:
-        output += "\n" + " | " + " | ".join(str(value) for value in row) + " | "
-    return output
+from result_table import stream_table
+from trino_pool import QueryTimeout, get_trino_pool
 
 
 def strip_code(code):
@@ -36,29 +29,20 @@ def strip_code(code):
     return code
 
 
-conn = trino.dbapi.connect(
-    host=os.environ["TRINO_HOST_URL"],
-    port=443,
-    http_scheme="https",
-    auth=trino.auth.BasicAuthentication(
-        os.environ["TRINO_USERNAME"], os.environ["TRINO_PASSWORD"]
-    ),
-)
-cur = conn.cursor()
-
-
-def make_query(query):
+async def stream_query(query, max_rows, max_bytes):
+    streamed = False
     try:
-        cur.execute(query)
-    except TrinoUserError as e:
-        return "```python\n" + str(e) + "\n```"
-    rows = cur.fetchall()
-    columns = cur.description
-    output = format_output(columns, rows)
-    return output
+        async for text in stream_table(get_trino_pool(), query, max_rows, max_bytes):
+            streamed = True
+            yield text
+    except (TrinoUserError, QueryTimeout) as e:
+        yield ("\n\n" if streamed else "") + "```python\n" + str(e) + "\n```"
 
 
 class RunTrinoQueryBot(PoeBot):
+    max_output_rows = 1000
+    max_output_bytes = 100_000
+
     async def get_response(
         self, request: QueryRequest
     ) -> AsyncIterable[ServerSentEvent]:
@@ -66,8 +50,10 @@ class RunTrinoQueryBot(PoeBot):
         print("user_statement")
         print(user_statement)
         user_statement = strip_code(user_statement)
-        output = make_query(user_statement)
-        yield self.text_event(output)
+        async for text in stream_query(
+            user_statement, self.max_output_rows, self.max_output_bytes
+        ):
+            yield self.text_event(text)
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
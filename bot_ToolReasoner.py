@@ -8,9 +8,10 @@ list directory
 
 """
 
+import ast
+import functools
 import re
 import textwrap
-import keyword
 from bot_PythonAgent import PythonAgentBot
 
 
@@ -21,20 +22,68 @@ Directly execute the calculations in the main scope, dot no wrap in a function.
 """.strip()
 
 
+PRINT_ASSIGNED = """
+def _print_assigned(**values):
+    for name, value in values.items():
+        try:
+            print(f"{name}={repr(value)[:100]}")
+        except Exception:
+            pass
+""".strip()
+
+
+def get_target_names(target):
+    if isinstance(target, ast.Name):
+        yield target.id
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        for element in target.elts:
+            yield from get_target_names(element)
+    elif isinstance(target, ast.Starred):
+        yield from get_target_names(target.value)
+
+
+def get_assigned_names(node):
+    if isinstance(node, ast.Assign):
+        return [name for target in node.targets for name in get_target_names(target)]
+    if isinstance(node, ast.AugAssign) or (
+        isinstance(node, ast.AnnAssign) and node.value is not None
+    ):
+        return list(get_target_names(node.target))
+    return []
+
+
+def get_start_line(node):
+    # a decorated definition starts at its first decorator
+    return min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+
+
+@functools.lru_cache(maxsize=256)
 def process_python_code(query):
     # Add import statements
-    # Also print variables if they are not inside any indentation
+    # Also print the variables assigned in the main scope, after their statement
     query = "import math\nimport numpy as np\nimport sympy as sp\n" + query
-    current_rows = query.strip().split("\n")
-    new_rows = []
-    for row in current_rows:
+    try:
+        tree = ast.parse(query)
+    except SyntaxError:
+        return query  # the error is shown when the code runs
+
+    line_to_names = {}  # line after which the names are printed -> names
+    names = []
+    for node, next_node in zip(tree.body, tree.body[1:] + [None]):
+        names += get_assigned_names(node)
+        # names are printed after a line that no other statement continues
+        if names and (next_node is None or get_start_line(next_node) > node.end_lineno):
+            line_to_names[node.end_lineno] = list(dict.fromkeys(names))
+            names = []
+
+    new_rows = [PRINT_ASSIGNED]
+    for line_number, row in enumerate(query.split("\n"), 1):
         new_rows.append(row)
-        if not row.startswith(" ") and "=" in row:
-            variables_to_print = row.split("=")[0].strip()
-            for variable_to_print in variables_to_print.split(","):
-                variable_to_print = variable_to_print.strip()
-                if variable_to_print.isidentifier() and not keyword.iskeyword(variable_to_print):
-                    new_rows.append(f'\ntry:\n    print(f"{variable_to_print}={{str({variable_to_print})[:100]}}")\nexcept:\n    pass\n')
+        if line_number in line_to_names:
+            arguments = ", ".join(
+                f"{name}={name}" for name in line_to_names[line_number]
+            )
+            new_rows.append(f"_print_assigned({arguments})")
     return "\n".join(new_rows)
 
 
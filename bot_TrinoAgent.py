@@ -7,12 +7,13 @@ How to NVL
 
 """
 
-import os
+import asyncio
+import json
 import re
 import textwrap
+import time
 from typing import AsyncIterable
 
-import trino
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, ProtocolMessage, stream_request
 from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
@@ -20,6 +21,11 @@ from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 from trino.exceptions import TrinoUserError
 
+from fence_scanner import BlockReader
+from query_cache import QueryCache
+from result_table import stream_table
+from trino_pool import QueryTimeout, get_trino_pool
+
 SYSTEM_PROMPT = """
 You are an assistant that helps to write Trino queries.
 
@@ -55,45 +61,63 @@ Otherwise, provide a concise comment. Do not repeat the output. Do not mention t
 """.strip()
 
 
-def format_output(columns, rows) -> str:
-    output = " | " + "|".join(column.name for column in columns) + " | "
-    output += "\n" + " | " + " | ".join("-" for _ in columns) + " | "
-    for row in rows:
-        output += "\n" + " | " + " | ".join(str(value) for value in row) + " | "
-    return output
-
-
 def extract_code(reply):
     pattern = r"```sql([\s\S]*?)```"
     matches = re.findall(pattern, reply)
     return "\n\n".join(matches)
 
 
-conn = trino.dbapi.connect(
-    host=os.environ["TRINO_HOST_URL"],
-    port=443,
-    http_scheme="https",
-    auth=trino.auth.BasicAuthentication(
-        os.environ["TRINO_USERNAME"], os.environ["TRINO_PASSWORD"]
-    ),
-)
-cur = conn.cursor()
+QUERY_CACHE = QueryCache()
 
 
-def make_query(query):
+async def stream_query(query, max_rows, max_bytes, cache_statuses, index):
+    """Yields the output of the query, sets cache_statuses[index] to "hit", "miss" or
+    "uncacheable"."""
+    cache_key, chunks = QUERY_CACHE.get(query, max_rows, max_bytes)
+    if chunks is not None:
+        cache_statuses[index] = "hit"
+        for chunk in chunks:
+            yield chunk
+        return
+    cache_statuses[index] = "uncacheable" if cache_key is None else "miss"
+
+    chunks = []
     try:
-        cur.execute(query)
+        async for text in stream_table(get_trino_pool(), query, max_rows, max_bytes):
+            chunks.append(text)
+            yield text
     except TrinoUserError as e:
-        return "```error\n" + e.error_name + "\n" + e.message + "\n```"
-    rows = cur.fetchall()
-    columns = cur.description
-    output = format_output(columns, rows)
-    return output
+        error = "```error\n" + e.error_name + "\n" + e.message + "\n```"
+        yield ("\n\n" if chunks else "") + error
+    except QueryTimeout as e:
+        error = "```error\n" + str(e) + "\n```"
+        yield ("\n\n" if chunks else "") + error
+    else:
+        # errors are not cached, the query may work on a retry
+        if cache_key is not None:
+            QUERY_CACHE.put(cache_key, chunks)
+
+
+async def collect_query(query, max_rows, max_bytes, cache_statuses, index):
+    """Returns (output, seconds)."""
+    start = time.perf_counter()
+    chunks = [
+        text
+        async for text in stream_query(
+            query, max_rows, max_bytes, cache_statuses, index
+        )
+    ]
+    return "".join(chunks), time.perf_counter() - start
 
 
 class TrinoAgentBot(PoeBot):
     prompt_bot = "GPT-4o-mini"
     iteration_count = 3
+    # the output goes back to the prompt bot
+    max_output_rows = 100
+    max_output_bytes = 16_000
+    # the reply is read until this many ```sql blocks, which run concurrently
+    max_parallel_queries = 1
 
     async def get_response(
         self, request: QueryRequest
@@ -119,8 +143,11 @@ class TrinoAgentBot(PoeBot):
         print("user_statement")
         print(user_statement)
 
+        cache_statuses = []
         for _ in range(10):  # intentionally error if exceed limits
-            current_bot_reply = ""
+            # the text between the ```sql blocks is kept, what follows the last
+            # block is neither shown nor fed back
+            reader = BlockReader("sql", self.max_parallel_queries)
             async for msg in stream_request(request, self.prompt_bot, request.api_key):
                 if isinstance(msg, MetaMessage):
                     continue
@@ -129,24 +156,77 @@ class TrinoAgentBot(PoeBot):
                 elif msg.is_replace_response:
                     yield self.replace_response_event(msg.text)
                 else:
-                    current_bot_reply += msg.text
-                    yield self.text_event(msg.text)
-                    if extract_code(current_bot_reply):
-                        # break when a Python code block is detected
+                    text = reader.feed(msg.text)
+                    if text:
+                        yield self.text_event(text)
+                    if reader.done:
                         break
 
-            query = extract_code(current_bot_reply)
-            print("query")
-            print(query)
-            if not query:
-                return
+            current_bot_reply = reader.get_reply()
+            queries = [code for _, code in reader.scanner.blocks]
+            if not queries and extract_code(current_bot_reply):
+                # a fence closed on the last line of the query
+                queries = [extract_code(current_bot_reply)]
+            print("queries")
+            print(queries)
+            if not queries:
+                break
 
             yield self.text_event("\n\n\n")
 
-            output = make_query(query)
+            start = time.perf_counter()
+            statuses = [None] * len(queries)
+            timings = []
+            if len(queries) == 1:
+                output_parts = []
+                async for text in stream_query(
+                    queries[0], self.max_output_rows, self.max_output_bytes, statuses, 0
+                ):
+                    output_parts.append(text)
+                    yield self.text_event(text)
+                output = "".join(output_parts)
+                timings.append(round(time.perf_counter() - start, 3))
+            else:
+                tasks = [
+                    asyncio.create_task(
+                        collect_query(
+                            query,
+                            self.max_output_rows,
+                            self.max_output_bytes,
+                            statuses,
+                            index,
+                        )
+                    )
+                    for index, query in enumerate(queries)
+                ]
+                outputs = []
+                try:
+                    # in order, as soon as each query and the ones before it are done
+                    for index, task in enumerate(tasks, 1):
+                        query_output, seconds = await task
+                        timings.append(round(seconds, 3))
+                        outputs.append(
+                            f"Query {index} ({seconds:.2f} s)\n\n{query_output}"
+                        )
+                        yield self.text_event(
+                            ("\n\n" if index > 1 else "") + outputs[-1]
+                        )
+                finally:
+                    for task in tasks:
+                        task.cancel()  # the client disconnected
+                output = "\n\n".join(outputs)
+            # in the order of the queries, whichever finished first
+            cache_statuses += statuses
+            print(
+                "trino_agent_queries",
+                len(queries),
+                "seconds",
+                timings,
+                "wall",
+                round(time.perf_counter() - start, 3),
+            )
             print("output")
             print(output)
-            yield self.text_event(output)
 
             yield self.text_event("\n\n\n")
 
@@ -159,6 +239,9 @@ class TrinoAgentBot(PoeBot):
             ]
             print(SIMULATED_USER_SUFFIX_PROMPT.format(output=output))
 
+        if cache_statuses:
+            yield self.data_event(json.dumps({"query_cache": cache_statuses}))
+
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
             server_bot_dependencies={self.prompt_bot: self.iteration_count},
@@ -172,4 +255,4 @@ class TrinoAgentBot(PoeBot):
 class TrinoAgentExBot(TrinoAgentBot):
     prompt_bot = "Claude-3.5-Sonnet-200k"
     iteration_count = 10
-
+    max_parallel_queries = 4
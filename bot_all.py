@@ -7,32 +7,123 @@ modal deploy bot_all.py && modal container list --json | jq -r '.[] | select(.["
 """
 
 from __future__ import annotations
+import asyncio
+import importlib
 import os
+import time
 
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 
-from bot_CafeMaid import CafeMaidBot
-from bot_ChineseStatement import ChineseStatementBot
-from bot_ChineseVocab import ChineseVocabBot
-from bot_EnglishDiffBot import EnglishDiffBot
-from bot_ImageRouter import ImageRouterBot
-from bot_JapaneseKana import JapaneseKanaBot
-from bot_KnowledgeTest import KnowledgeTestBot
-from bot_ModelRouter import ModelRouterBot
-from bot_PromotedAnswer import PromotedAnswerBot
-from bot_CmdLine import CmdLineBot
-from bot_RunPythonCode import RunPythonCodeBot
-from bot_PythonAgent import PythonAgentBot, PythonAgentExBot, LeetCodeAgentBot
-from bot_H1B import H1BBot  # NOTE: you need to make h1b.csv to build this (h1b.csv is not in the repository)
-from bot_ToolReasoner import ToolReasonerBot
-from bot_ResumeReview import ResumeReviewBot
-from bot_TesseractOCR import TesseractOCRBot
-from bot_tiktoken import TikTokenBot
-from bot_QwenTokenizer import QwenTokenizerBot
-from bot_TrinoAgent import TrinoAgentBot, TrinoAgentExBot
-from bot_RunTrinoQuery import RunTrinoQueryBot
-from bot_FlowchartPlotter import FlowChartPlotterBot
+# path -> (module, class)
+# The bot modules are only imported when their path receives the first request,
+# so the cold start only pays for the bots that are actually called.
+BOT_REGISTRY = {
+    "/CafeMaid": ("bot_CafeMaid", "CafeMaidBot"),
+    "/ChineseStatement": ("bot_ChineseStatement", "ChineseStatementBot"),
+    "/ChineseVocab": ("bot_ChineseVocab", "ChineseVocabBot"),
+    "/EnglishDiffBot": ("bot_EnglishDiffBot", "EnglishDiffBot"),
+    "/ImageRouter": ("bot_ImageRouter", "ImageRouterBot"),
+    "/JapaneseKana": ("bot_JapaneseKana", "JapaneseKanaBot"),
+    "/KnowledgeTest": ("bot_KnowledgeTest", "KnowledgeTestBot"),
+    "/ModelRouter": ("bot_ModelRouter", "ModelRouterBot"),
+    "/PromotedAnswer": ("bot_PromotedAnswer", "PromotedAnswerBot"),
+    "/CmdLine": ("bot_CmdLine", "CmdLineBot"),
+    "/RunPythonCode": ("bot_RunPythonCode", "RunPythonCodeBot"),
+    "/PythonAgent": ("bot_PythonAgent", "PythonAgentBot"),
+    "/PythonAgentEx": ("bot_PythonAgent", "PythonAgentExBot"),
+    # NOTE: you need to make h1b.csv to build this (h1b.csv is not in the repository)
+    "/H-1B": ("bot_H1B", "H1BBot"),
+    "/ToolReasoner": ("bot_ToolReasoner", "ToolReasonerBot"),
+    "/ResumeReview": ("bot_ResumeReview", "ResumeReviewBot"),
+    "/TesseractOCR": ("bot_TesseractOCR", "TesseractOCRBot"),
+    "/tiktoken": ("bot_tiktoken", "TikTokenBot"),
+    "/QwenTokenizer": ("bot_QwenTokenizer", "QwenTokenizerBot"),
+    "/TrinoAgent": ("bot_TrinoAgent", "TrinoAgentBot"),
+    "/TrinoAgentEx": ("bot_TrinoAgent", "TrinoAgentExBot"),
+    "/RunTrinoQuery": ("bot_RunTrinoQuery", "RunTrinoQueryBot"),
+    "/LeetCodeAgent": ("bot_PythonAgent", "LeetCodeAgentBot"),
+    "/FlowChartPlotter": ("bot_FlowchartPlotter", "FlowChartPlotterBot"),
+}
+
+# helper modules imported by the bots, which also have to be added to the image
+SHARED_MODULES = [
+    "attachment_upload",
+    "context_budget",
+    "fence_scanner",
+    "learner_state",
+    "output_stream",
+    "python_kernel",
+    "query_cache",
+    "response_cache",
+    "result_table",
+    "sandbox_pool",
+    "state_session",
+    "trino_pool",
+    "vocab_scheduler",
+    "word_store",
+]
+
+# path -> {"module": seconds spent importing, "init": seconds spent constructing}
+STARTUP_COSTS = {}
+
+
+def load_bot(path, access_key):
+    module_name, class_name = BOT_REGISTRY[path]
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)  # free if already imported
+    imported = time.perf_counter()
+    bot = getattr(module, class_name)(path=path, access_key=access_key)
+    STARTUP_COSTS[path] = {
+        "module": imported - start,
+        "init": time.perf_counter() - imported,
+    }
+    print("loaded", path, STARTUP_COSTS[path])
+    return bot
+
+
+def report_startup_costs():
+    lines = [f"{'path':<20} {'module (s)':>10} {'init (s)':>10}"]
+    for path, cost in sorted(
+        STARTUP_COSTS.items(), key=lambda item: -sum(item[1].values())
+    ):
+        lines.append(f"{path:<20} {cost['module']:>10.3f} {cost['init']:>10.3f}")
+    return "\n".join(lines)
+
+
+class LazyBot(fp.PoeBot):
+    """Serves a path from BOT_REGISTRY, loading the actual bot on the first request."""
+
+    def __init__(self, path, access_key):
+        super().__init__(path=path, access_key=access_key)
+        self._bot = None
+        self._lock = asyncio.Lock()
+
+    async def get_bot(self):
+        async with self._lock:
+            if self._bot is None:
+                # import in a thread so that other bots keep serving in the meantime
+                self._bot = await asyncio.get_running_loop().run_in_executor(
+                    None, load_bot, self.path, self.access_key
+                )
+        return self._bot
+
+    async def handle_query(self, request, context):
+        bot = await self.get_bot()
+        async for event in bot.handle_query(request, context):
+            yield event
+
+    async def handle_settings(self, settings_request, context):
+        bot = await self.get_bot()
+        return await bot.handle_settings(settings_request, context)
+
+    async def handle_report_feedback(self, feedback_request, context):
+        bot = await self.get_bot()
+        return await bot.handle_report_feedback(feedback_request, context)
+
+    async def handle_report_error(self, error_request, context):
+        bot = await self.get_bot()
+        return await bot.handle_report_error(error_request, context)
 
 
 REQUIREMENTS = [
@@ -99,6 +190,10 @@ image = (
         "tesseract-ocr-eng",
     )  # document processing
     .pip_install(*REQUIREMENTS)
+    .env({"TIKTOKEN_CACHE_DIR": "/root/tiktoken_cache"})
+    .run_commands(
+        "python -c \"import tiktoken; tiktoken.get_encoding('cl100k_base')\""
+    )  # PythonAgent (context budget), so the encoding is not downloaded at runtime
     .env(
         {
             "POE_ACCESS_KEY": os.environ["POE_ACCESS_KEY"],
@@ -119,10 +214,18 @@ image = (
     .add_local_dir("qwen_tokenizer/", "/root/qwen_tokenizer/", copy=True)  # QwenTokenizer
     .run_commands("unzip -o /root/qwen_tokenizer/tokenizer.json.zip -d /root/qwen_tokenizer/")  # QwenTokenizer
     .copy_local_file("chinese_sentences.txt", "/root/chinese_sentences.txt")  # ChineseStatement
+    .copy_local_file("statement_corpus.py", "/root/statement_corpus.py")  # ChineseStatement
+    .run_commands("cd /root && python statement_corpus.py")  # ChineseStatement (writes chinese_sentences.corpus)
     .copy_local_file("chinese_words.csv", "/root/chinese_words.csv")  # ChineseVocab
     .copy_local_file("japanese_kana.csv", "/root/japanese_kana.csv")  # JapaneseKana
+    .copy_local_file("kana_index.py", "/root/kana_index.py")  # JapaneseKana
+    .run_commands("cd /root && python kana_index.py")  # JapaneseKana (writes japanese_kana_index.json)
     .copy_local_file("mmlu.csv", "/root/mmlu.csv")  # KnowledgeTest
     .copy_local_file("h1b.csv", "/root/h1b.csv")  # H-1B  (NOTE: note included in repository)
+    # the bot modules are imported lazily, so they are not picked up by automount
+    .add_local_python_source(
+        *sorted({module for module, _ in BOT_REGISTRY.values()}), *SHARED_MODULES
+    )
 )
 app = App("wrapper-bot-poe")
 
@@ -134,31 +237,13 @@ def fastapi_app():
     # see https://creator.poe.com/docs/quick-start#configuring-the-access-credentials
     # app = fp.make_app(bot, access_key=POE_ACCESS_KEY, bot_name=<YOUR_BOT_NAME>)
     app = fp.make_app(
-        [
-            CafeMaidBot(path="/CafeMaid", access_key=POE_ACCESS_KEY),
-            ChineseStatementBot(path="/ChineseStatement", access_key=POE_ACCESS_KEY),
-            ChineseVocabBot(path="/ChineseVocab", access_key=POE_ACCESS_KEY),
-            EnglishDiffBot(path="/EnglishDiffBot", access_key=POE_ACCESS_KEY),
-            ImageRouterBot(path="/ImageRouter", access_key=POE_ACCESS_KEY),
-            JapaneseKanaBot(path="/JapaneseKana", access_key=POE_ACCESS_KEY),
-            KnowledgeTestBot(path="/KnowledgeTest", access_key=POE_ACCESS_KEY),
-            ModelRouterBot(path="/ModelRouter", access_key=POE_ACCESS_KEY),
-            PromotedAnswerBot(path="/PromotedAnswer", access_key=POE_ACCESS_KEY),
-            CmdLineBot(path="/CmdLine", access_key=POE_ACCESS_KEY),
-            RunPythonCodeBot(path="/RunPythonCode", access_key=POE_ACCESS_KEY),
-            PythonAgentBot(path="/PythonAgent", access_key=POE_ACCESS_KEY),
-            PythonAgentExBot(path="/PythonAgentEx", access_key=POE_ACCESS_KEY),
-            H1BBot(path="/H-1B", access_key=POE_ACCESS_KEY),
-            ToolReasonerBot(path="/ToolReasoner", access_key=POE_ACCESS_KEY),
-            ResumeReviewBot(path="/ResumeReview", access_key=POE_ACCESS_KEY),
-            TesseractOCRBot(path="/TesseractOCR", access_key=POE_ACCESS_KEY),
-            TikTokenBot(path="/tiktoken", access_key=POE_ACCESS_KEY),
-            QwenTokenizerBot(path="/QwenTokenizer", access_key=POE_ACCESS_KEY),
-            TrinoAgentBot(path="/TrinoAgent", access_key=POE_ACCESS_KEY),
-            TrinoAgentExBot(path="/TrinoAgentEx", access_key=POE_ACCESS_KEY),
-            RunTrinoQueryBot(path="/RunTrinoQuery", access_key=POE_ACCESS_KEY),
-            LeetCodeAgentBot(path="/LeetCodeAgent", access_key=POE_ACCESS_KEY),
-            FlowChartPlotterBot(path="/FlowChartPlotter", access_key=POE_ACCESS_KEY),
-        ],
+        [LazyBot(path=path, access_key=POE_ACCESS_KEY) for path in BOT_REGISTRY]
     )
     return app
+
+
+if __name__ == "__main__":
+    # python bot_all.py - imports every bot and reports the startup cost of each
+    for path in BOT_REGISTRY:
+        load_bot(path, os.environ["POE_ACCESS_KEY"])
+    print(report_startup_costs())
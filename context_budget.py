@@ -0,0 +1,117 @@
+"""
+
+Token budget for the conversation that PythonAgentBot sends to the prompt bot
+
+Each code iteration appends the reply of the model and a simulated user message with
+the output of the code, so the prompt grows with every iteration and every turn.
+Before each call, the conversation is compacted to the budget
+
+    request.query = compact_messages(request.query, self.context_token_budget)
+
+The first message (the system prompt), the latest bot message with code and the last
+message are kept whole. Earlier messages are truncated to their head and tail, oldest
+first, and are replaced by a note if that is still over the budget. If the kept
+messages alone are over the budget, the last message is truncated as well.
+
+Tokens are counted with the cl100k_base encoding of tiktoken. The prompt bots are
+not OpenAI models, so the count is an estimate and the budget should leave a margin.
+"""
+
+from __future__ import annotations
+
+import functools
+
+import tiktoken
+
+ENCODING_NAME = "cl100k_base"
+TRUNCATED_MESSAGE_TOKENS = 256
+OMITTED_MESSAGE = "(earlier message omitted)"
+
+
+class ApproximateEncoding:
+    """About four characters per token, if the tiktoken encoding cannot be loaded."""
+
+    def encode(self, text, disallowed_special=()):
+        return [text[i : i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+@functools.cache
+def get_encoding():
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:  # the encoding is downloaded on first use
+        print("could not load tiktoken encoding, approximating", e)
+        return ApproximateEncoding()
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def truncate_middle(text, max_tokens):
+    """Keeps the head and the tail of the text, within about max_tokens."""
+    encoding = get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    head = max_tokens * 3 // 4
+    tail = max_tokens - head
+    return (
+        encoding.decode(tokens[:head])
+        + f"\n... {len(tokens) - head - tail} tokens omitted ...\n"
+        + encoding.decode(tokens[len(tokens) - tail :])
+    )
+
+
+def get_pinned_indexes(messages):
+    pinned = {0, len(messages) - 1}
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].role == "bot" and "```" in messages[index].content:
+            pinned.add(index)
+            break
+    return pinned
+
+
+def compact_messages(
+    messages, budget, truncated_message_tokens=TRUNCATED_MESSAGE_TOKENS
+):
+    """Returns the messages, compacted to about budget tokens."""
+    counts = [count_tokens(message.content) for message in messages]
+    total = sum(counts)
+    if total <= budget:
+        return messages
+
+    original_total = total
+    messages = list(messages)
+    pinned = get_pinned_indexes(messages)
+    for compact in (
+        lambda content: truncate_middle(content, truncated_message_tokens),
+        lambda content: OMITTED_MESSAGE,
+    ):
+        for index, message in enumerate(messages):
+            if total <= budget:
+                break
+            if index in pinned:
+                continue
+            content = compact(message.content)
+            count = count_tokens(content)
+            if count < counts[index]:
+                messages[index] = message.model_copy(update={"content": content})
+                total -= counts[index] - count
+                counts[index] = count
+
+    if total > budget:
+        last = len(messages) - 1
+        content = truncate_middle(
+            messages[last].content,
+            max(budget - (total - counts[last]), truncated_message_tokens),
+        )
+        messages[last] = messages[last].model_copy(update={"content": content})
+        total += count_tokens(content) - counts[last]
+
+    print("context_compaction", "tokens", original_total, "->", total, "budget", budget)
+    return messages
@@ -0,0 +1,186 @@
+"""
+
+Incremental detection of code blocks in a streamed reply
+
+python fence_scanner.py benchmark  # scanner vs the regex on every chunk, 20k-token replies
+
+The agent bots stop reading the prompt bot as soon as a code block is complete. The
+reply used to be searched with regexes after every chunk, which is quadratic in the
+length of the reply. The scanner reads each chunk once and tracks whether it is
+inside a fence
+
+    scanner = FenceScanner("python")
+    async for msg in stream_request(...):
+        if scanner.feed(msg.text):
+            break  # a ```python block is complete
+
+A fence is opened by a line that starts with ``` followed by the language, and closed
+by a line that is only ```, so a ```python line inside a ```markdown block neither
+opens nor closes a block. A block is reported when its closing line ends, which is
+usually the chunk after the one the regexes stopped at. Blocks of other languages are
+tracked as well, but not reported. last_block_end is the number of characters fed up
+to the end of the closing line of the last block, so what follows can be cut off.
+
+BlockReader reads a reply until several blocks are closed, and holds back the text
+after a block until the next block opens
+
+    reader = BlockReader("sql", max_blocks=4)
+    async for msg in stream_request(...):
+        yield reader.feed(msg.text)  # the text that can be shown
+        if reader.done:
+            break
+    queries = [code for _, code in reader.scanner.blocks]
+"""
+
+from __future__ import annotations
+
+import random
+import re
+import sys
+import time
+
+FENCE = "```"
+
+
+class FenceScanner:
+    def __init__(self, *languages):
+        self.languages = set(languages)
+        self.line_parts = []  # the incomplete last line
+        self.language = None  # language of the open fence, None outside a fence
+        self.code_lines = []
+        self.blocks = []  # (language, code) of the closed blocks of self.languages
+        self.length = 0  # characters fed so far
+        self.last_block_end = None  # characters up to the end of the last closing line
+
+    def feed(self, text):
+        """Returns the blocks of self.languages that the text closes, [(language, code)]."""
+        closed = []
+        for index, piece in enumerate(text.split("\n")):
+            if index:  # the previous piece ended a line
+                self.length += 1
+                self.end_line(closed)
+            if piece:
+                self.line_parts.append(piece)
+                self.length += len(piece)
+        return closed
+
+    def end_line(self, closed):
+        line = "".join(self.line_parts)
+        self.line_parts = []
+        if self.language is None:
+            if line.startswith(FENCE):
+                self.language = line[len(FENCE) :].strip().lower()
+        elif line.rstrip() == FENCE:
+            if self.language in self.languages:
+                block = (self.language, "\n".join(self.code_lines))
+                closed.append(block)
+                self.blocks.append(block)
+                self.last_block_end = self.length
+            self.language = None
+            self.code_lines = []
+        else:
+            self.code_lines.append(line)
+
+
+class BlockReader:
+    def __init__(self, language, max_blocks):
+        self.scanner = FenceScanner(language)
+        self.max_blocks = max_blocks
+        self.reply = ""
+        self.shown = 0  # characters of the reply returned by feed
+        self.visible = 0  # characters of the reply that may be shown
+        self.done = False
+
+    def feed(self, text):
+        """Returns the text that can be shown, sets done once the reading should stop.
+
+        The reading stops after max_blocks blocks, or at a fence of another language
+        after a block, e.g. output made up by the prompt bot."""
+        # line by line, so that at most one block closes at a time
+        for line in re.findall(r"[^\n]*\n|[^\n]+", text):
+            self.reply += line
+            self.scanner.feed(line)
+            if (
+                not self.scanner.blocks
+                or self.scanner.language in self.scanner.languages
+            ):
+                # the text held back after a block is shown once the next block opens
+                self.visible = len(self.reply)
+            else:
+                self.visible = self.scanner.last_block_end
+                if (
+                    len(self.scanner.blocks) >= self.max_blocks
+                    or self.scanner.language is not None
+                ):
+                    self.done = True
+                    break
+        text = self.reply[self.shown : self.visible]
+        self.shown = self.visible
+        return text
+
+    def get_reply(self):
+        """The reply up to the end of the last block, what follows is dropped."""
+        if self.scanner.blocks:
+            return self.reply[: self.scanner.last_block_end]
+        return self.reply
+
+
+def extract_code_regex(text):
+    # PythonAgentBot.extract_code, which used to run after every chunk
+    pattern = r"\n```python([\s\S]*?)\n```"
+    matches = re.findall(pattern, "\n" + text)
+    if matches:
+        return "\n\n".join(matches)
+    pattern = r"```python([\s\S]*?)```"
+    return "\n\n".join(re.findall(pattern, "\n" + text))
+
+
+def make_benchmark_reply(num_tokens, seed=0):
+    """A reply of about num_tokens tokens of prose and ```bash blocks, ending in a
+    ```python block, as the list of chunks it is streamed in."""
+    rng = random.Random(seed)
+    words = "the data frame column value plot model query row result".split()
+    chunks = []
+    while len(chunks) < num_tokens:
+        if rng.random() < 0.01:
+            chunks += ["\n```", "bash", "\n", "ls", " -la", "\n```", "\n"]
+        else:
+            chunks.append(
+                " " + rng.choice(words) + ("\n" if rng.random() < 0.1 else "")
+            )
+    chunks += ["\n```", "python", "\n", "print", "(1)", "\n```", "\n", " done"]
+    return chunks
+
+
+def benchmark(num_tokens=20000, repeats=3):
+    chunks = make_benchmark_reply(num_tokens)
+
+    def regex():
+        reply = ""
+        for position, chunk in enumerate(chunks):
+            reply += chunk
+            if extract_code_regex(reply):
+                return position
+
+    def scanner():
+        fence_scanner = FenceScanner("python")
+        for position, chunk in enumerate(chunks):
+            if fence_scanner.feed(chunk):
+                return position
+
+    print(f"{len(chunks)} chunks, {len(''.join(chunks))} characters")
+    print(f"{'':>8} {'total (ms)':>11} {'per chunk (us)':>15}")
+    positions = {}
+    for name, detect in (("regex", regex), ("scanner", scanner)):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            positions[name] = detect()
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f"{name:>8} {elapsed * 1000:>11.1f} {elapsed / len(chunks) * 1e6:>15.2f}")
+    # the scanner waits for the end of the closing line, the next chunk here
+    assert positions["scanner"] == positions["regex"] + 1
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
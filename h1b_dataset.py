@@ -0,0 +1,250 @@
+"""
+
+Columnar copy of the H-1B dataset for H1BBot
+
+python h1b_dataset.py                       # writes h1b.parquet from h1b.csv
+python h1b_dataset.py /h1b.csv /h1b.parquet
+python h1b_dataset.py benchmark             # read_csv vs read_parquet, time and peak RSS
+python h1b_dataset.py statistics /h1b.parquet  # the value counts in the H1B system prompt
+
+Every script that H1BBot runs used to start with pd.read_csv('/h1b.csv'), which
+parses 2.5M rows of text and infers every type, up to code_iteration_limit times per
+message. The image now converts the CSV once, at build time, and the scripts start with
+
+    df = pd.read_parquet('/h1b.parquet')
+
+The Parquet file keeps only the COLUMNS listed in the system prompt. The dates are
+datetime64, YEAR and QUARTER are small integers, and the low-cardinality text columns
+are categoricals, stored dictionary-encoded, so each distinct value is decoded once.
+Categoricals compare with == and support .str like the text columns. A script that
+passes columns=[...] reads only those columns from the file.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+CSV_PATH = "h1b.csv"
+PARQUET_PATH = "h1b.parquet"
+
+COLUMNS = [
+    "CASE_NUMBER",
+    "CASE_STATUS",
+    "RECEIVED_DATE",
+    "DECISION_DATE",
+    "ORIGINAL_CERT_DATE",
+    "VISA_CLASS",
+    "JOB_TITLE",
+    "SOC_TITLE",
+    "FULL_TIME_POSITION",
+    "BEGIN_DATE",
+    "END_DATE",
+    "EMPLOYER_NAME",
+    "AGENT_REPRESENTING_EMPLOYER",
+    "LAWFIRM_NAME_BUSINESS_NAME",
+    "SECONDARY_ENTITY",
+    "SECONDARY_ENTITY_BUSINESS_NAME",
+    "WORKSITE_STATE",
+    "WAGE_RATE_OF_PAY_FROM",
+    "WAGE_RATE_OF_PAY_TO",
+    "WAGE_UNIT_OF_PAY",
+    "YEAR",
+    "QUARTER",
+]
+
+CATEGORY_COLUMNS = [
+    "CASE_STATUS",
+    "VISA_CLASS",
+    "SOC_TITLE",
+    "FULL_TIME_POSITION",
+    "AGENT_REPRESENTING_EMPLOYER",
+    "SECONDARY_ENTITY",
+    "WORKSITE_STATE",
+    "WAGE_UNIT_OF_PAY",
+]
+
+DATE_COLUMNS = [
+    "RECEIVED_DATE",
+    "DECISION_DATE",
+    "ORIGINAL_CERT_DATE",
+    "BEGIN_DATE",
+    "END_DATE",
+]
+
+DTYPES = {
+    **{column: "category" for column in CATEGORY_COLUMNS},
+    "WAGE_RATE_OF_PAY_FROM": "float64",
+    "WAGE_RATE_OF_PAY_TO": "float64",
+    "YEAR": "int16",
+    "QUARTER": "int8",
+}
+
+
+def read_typed_csv(csv_path=CSV_PATH):
+    df = pd.read_csv(csv_path, usecols=COLUMNS, dtype=DTYPES)
+    for column in DATE_COLUMNS:
+        df[column] = pd.to_datetime(df[column], format="ISO8601", errors="raise")
+    return df[COLUMNS]
+
+
+def write_parquet(csv_path=CSV_PATH, parquet_path=PARQUET_PATH):
+    df = read_typed_csv(csv_path)
+    # row groups of 256k rows, so that a filter on a few columns stays in cache
+    df.to_parquet(parquet_path, index=False, row_group_size=256 * 1024)
+    return df
+
+
+def print_statistics(parquet_path=PARQUET_PATH):
+    """Prints the five most common values of each column, as listed in the prompt."""
+    df = pd.read_parquet(parquet_path)
+    for column in df.columns:
+        print(
+            str(df[column].value_counts().head(5)).replace(
+                "dtype: int64", "type: " + str(type(df[column][0]))
+            )
+        )
+        print()
+
+
+def make_benchmark_csv(csv_path, num_rows=500_000, seed=0):
+    """A CSV with the columns and the most common values of h1b.csv."""
+    rng = np.random.default_rng(seed)
+
+    def choice(values):
+        return rng.choice(np.array(values, dtype=object), num_rows)
+
+    def dates(start, days):
+        offsets = rng.integers(0, days, num_rows)
+        return (pd.Timestamp(start) + pd.to_timedelta(offsets, "D")).astype(str)
+
+    states = "CA TX NY WA NJ IL MA GA PA FL VA NC MI OH MN".split()
+    employers = [f"EMPLOYER {i} LLC" for i in range(50_000)]
+    titles = [f"SOFTWARE ENGINEER {i}" for i in range(20_000)]
+    df = pd.DataFrame(
+        {
+            "CASE_NUMBER": [
+                f"I-200-{n // 100000:05d}-{n % 1000000:06d}"
+                for n in rng.integers(0, 10**10, num_rows)
+            ],
+            "CASE_STATUS": choice(
+                ["Certified"] * 90
+                + ["Certified - Withdrawn"] * 6
+                + ["Withdrawn", "Denied"] * 2
+            ),
+            "RECEIVED_DATE": dates("2020-10-01", 1200),
+            "DECISION_DATE": dates("2020-10-08", 1200),
+            "ORIGINAL_CERT_DATE": np.where(
+                rng.random(num_rows) < 0.95, None, dates("2020-05-01", 1200)
+            ),
+            "VISA_CLASS": choice(
+                ["H-1B"] * 97 + ["E-3 Australian", "H-1B1 Chile", "H-1B1 Singapore"]
+            ),
+            "JOB_TITLE": choice(titles),
+            "SOC_TITLE": choice([f"Software Developers {i}" for i in range(800)]),
+            "FULL_TIME_POSITION": choice(["Y"] * 98 + ["N"] * 2),
+            "BEGIN_DATE": dates("2020-10-01", 1200),
+            "END_DATE": dates("2023-09-30", 1200),
+            "EMPLOYER_NAME": choice(employers),
+            "AGENT_REPRESENTING_EMPLOYER": choice(["Yes", "No", "Y", "N"]),
+            "LAWFIRM_NAME_BUSINESS_NAME": choice(
+                [f"LAW FIRM {i} LLP" for i in range(5000)]
+            ),
+            "SECONDARY_ENTITY": choice(["No", "Yes", "N", "Y"]),
+            "SECONDARY_ENTITY_BUSINESS_NAME": np.where(
+                rng.random(num_rows) < 0.8, None, choice(employers)
+            ),
+            "WORKSITE_STATE": choice(states),
+            "WAGE_RATE_OF_PAY_FROM": rng.integers(50, 250, num_rows) * 1000.0,
+            "WAGE_RATE_OF_PAY_TO": np.where(
+                rng.random(num_rows) < 0.5,
+                np.nan,
+                rng.integers(60, 300, num_rows) * 1000.0,
+            ),
+            "WAGE_UNIT_OF_PAY": choice(["Year"] * 94 + ["Hour"] * 6),
+            "YEAR": rng.integers(2020, 2024, num_rows),
+            "QUARTER": rng.integers(1, 5, num_rows),
+        }
+    )
+    df.to_csv(csv_path, index=False)
+
+
+def get_peak_rss():
+    # VmHWM, unlike ru_maxrss, does not carry over the peak of the parent across exec
+    with open("/proc/self/status") as f:
+        return int(re.search(r"VmHWM:\s+(\d+) kB", f.read()).group(1)) * 1024
+
+
+def measure(kind, path):
+    """Loads the dataset as a script in the sandbox would, in this process."""
+    baseline = get_peak_rss()
+    start = time.perf_counter()
+    if kind == "csv":
+        df = pd.read_csv(path)
+    elif kind == "parquet":
+        df = pd.read_parquet(path)
+    else:  # a script that reads only the columns it needs
+        df = pd.read_parquet(path, columns=["VISA_CLASS"])
+    # the test message, "How many h1b1 were issued?"
+    count = int(df["VISA_CLASS"].str.contains("h-1b1", case=False).sum())
+    elapsed = time.perf_counter() - start
+    peak = get_peak_rss() - baseline
+    return {"seconds": elapsed, "rss_mb": peak / 1e6, "count": count}
+
+
+def benchmark(num_rows=500_000):
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = CSV_PATH
+        if not os.path.exists(csv_path):
+            csv_path = os.path.join(directory, "h1b.csv")
+            make_benchmark_csv(csv_path, num_rows)
+        parquet_path = os.path.join(directory, "h1b.parquet")
+        start = time.perf_counter()
+        df = write_parquet(csv_path, parquet_path)
+        print(
+            f"{len(df)} rows, conversion {time.perf_counter() - start:.1f} s,"
+            f" csv {os.path.getsize(csv_path) / 1e6:.0f} MB,"
+            f" parquet {os.path.getsize(parquet_path) / 1e6:.0f} MB"
+        )
+        # each load runs in a fresh process, as each script does in the sandbox
+        print(f"{'':>16} {'load (s)':>9} {'peak RSS (MB)':>14}")
+        results = {}
+        for kind, path in (
+            ("csv", csv_path),
+            ("parquet", parquet_path),
+            ("parquet columns", parquet_path),
+        ):
+            output = subprocess.run(
+                [sys.executable, __file__, "measure", kind, path],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results[kind] = json.loads(output)
+            print(
+                f"{kind:>16} {results[kind]['seconds']:>9.2f}"
+                f" {results[kind]['rss_mb']:>14.0f}"
+            )
+        assert len({result["count"] for result in results.values()}) == 1
+        assert results["parquet"]["seconds"] < results["csv"]["seconds"]
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    elif sys.argv[1:2] == ["statistics"]:
+        print_statistics(*sys.argv[2:])
+    elif sys.argv[1:2] == ["measure"]:
+        print(json.dumps(measure(*sys.argv[2:])))
+    else:
+        csv_path, parquet_path = sys.argv[1:] or (CSV_PATH, PARQUET_PATH)
+        df = write_parquet(csv_path, parquet_path)
+        print("wrote", parquet_path, len(df), "rows")
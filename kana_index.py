@@ -0,0 +1,183 @@
+"""
+
+Question index for JapaneseKanaBot
+
+python kana_index.py            # writes japanese_kana_index.json from japanese_kana.csv
+python kana_index.py benchmark  # compares build times at 400, 4k and 40k rows
+
+Two questions are related if an answer or wrong option of one is the question of the
+other. Instead of comparing every pair of rows, the index looks up each answer in a
+map from question value to question tuples, so building it is linear in the rows.
+
+The index is written to a JSON artifact that is baked into the image. The artifact
+stores the hash of the CSV it was built from, and is rebuilt if the CSV has changed.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+CSV_PATH = "japanese_kana.csv"
+INDEX_PATH = "japanese_kana_index.json"
+
+
+def read_records(csv_path=CSV_PATH):
+    with open(csv_path, newline="") as f:
+        return [{k: v for k, v in row.items() if v} for row in csv.DictReader(f)]
+
+
+def get_csv_hash(csv_path=CSV_PATH):
+    with open(csv_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_kana_index(records):
+    """Returns (correct answers, wrong answers, related question tuples) per question tuple."""
+    question_tuple_to_correct_answers = defaultdict(list)
+    question_tuple_to_wrong_answers = defaultdict(list)
+    question_tuple_to_question_tuple = defaultdict(set)
+
+    question_to_question_tuples = defaultdict(list)
+    for row in records:
+        question_to_question_tuples[row["question"]].append(
+            (row["question"], row["type"], row["class"])
+        )
+
+    for row in records:
+        question_tuple = row["question"], row["type"], row["class"]
+        for k, v in row.items():
+            if "answer" in k:
+                question_tuple_to_correct_answers[question_tuple].append(v)
+            if "wrong" in k:
+                question_tuple_to_wrong_answers[question_tuple].append(v)
+            if "answer" in k or "wrong" in k:
+                for question_tuple_related in question_to_question_tuples.get(v, []):
+                    question_tuple_to_question_tuple[question_tuple].add(
+                        question_tuple_related
+                    )
+                    question_tuple_to_question_tuple[question_tuple_related].add(
+                        question_tuple
+                    )
+
+    return (
+        question_tuple_to_correct_answers,
+        question_tuple_to_wrong_answers,
+        question_tuple_to_question_tuple,
+    )
+
+
+def build_kana_index_pairwise(records):
+    # the original O(n^2) scan, kept for the benchmark
+    question_tuple_to_question_tuple = defaultdict(set)
+    for row1 in records:
+        for row2 in records:
+            for k1, v1 in row1.items():
+                if "answer" in k1 or "wrong" in k1:
+                    if v1 == row2["question"]:
+                        question_tuple_to_question_tuple[
+                            row1["question"], row1["type"], row1["class"]
+                        ].add((row2["question"], row2["type"], row2["class"]))
+                        question_tuple_to_question_tuple[
+                            row2["question"], row2["type"], row2["class"]
+                        ].add((row1["question"], row1["type"], row1["class"]))
+    return question_tuple_to_question_tuple
+
+
+def save_kana_index(index, csv_hash, index_path=INDEX_PATH):
+    correct_answers, wrong_answers, related = index
+    question_tuples = list(correct_answers)
+    question_tuple_to_index = {
+        question_tuple: i for i, question_tuple in enumerate(question_tuples)
+    }
+    # related questions are stored as positions in question_tuples
+    artifact = {
+        "csv_hash": csv_hash,
+        "question_tuples": question_tuples,
+        "correct_answers": [correct_answers[q] for q in question_tuples],
+        "wrong_answers": [wrong_answers.get(q, []) for q in question_tuples],
+        "related": [
+            sorted(question_tuple_to_index[r] for r in related.get(q, ()))
+            for q in question_tuples
+        ],
+    }
+    with open(index_path, "w") as f:
+        json.dump(artifact, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_kana_index(csv_path=CSV_PATH, index_path=INDEX_PATH):
+    """Loads the artifact, or builds the index if the artifact is missing or stale."""
+    csv_hash = get_csv_hash(csv_path)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            artifact = json.load(f)
+        if artifact["csv_hash"] == csv_hash:
+            question_tuples = [tuple(q) for q in artifact["question_tuples"]]
+            correct_answers = defaultdict(
+                list, zip(question_tuples, artifact["correct_answers"])
+            )
+            wrong_answers = defaultdict(
+                list,
+                (
+                    (q, w)
+                    for q, w in zip(question_tuples, artifact["wrong_answers"])
+                    if w
+                ),
+            )
+            related = defaultdict(set)
+            for q, indices in zip(question_tuples, artifact["related"]):
+                if indices:
+                    related[q] = {question_tuples[i] for i in indices}
+            return correct_answers, wrong_answers, related
+        print("kana index is stale, rebuilding")
+    return build_kana_index(read_records(csv_path))
+
+
+def make_benchmark_records(records, num_rows):
+    # copies of the kana table with suffixed values, so that relations stay within a copy
+    benchmark_records = []
+    copy = 0
+    while len(benchmark_records) < num_rows:
+        for row in records:
+            benchmark_records.append(
+                {
+                    k: (
+                        f"{v}{copy}"
+                        if k == "question" or "answer" in k or "wrong" in k
+                        else v
+                    )
+                    for k, v in row.items()
+                }
+            )
+        copy += 1
+    return benchmark_records[:num_rows]
+
+
+def benchmark(max_pairwise_rows=4000):
+    records = read_records()
+    print(f"{'rows':>8} {'linear (s)':>12} {'pairwise (s)':>14}")
+    for num_rows in (400, 4000, 40000):
+        benchmark_records = make_benchmark_records(records, num_rows)
+        start = time.perf_counter()
+        related = build_kana_index(benchmark_records)[2]
+        linear = time.perf_counter() - start
+        if num_rows <= max_pairwise_rows:
+            start = time.perf_counter()
+            assert build_kana_index_pairwise(benchmark_records) == related
+            pairwise = f"{time.perf_counter() - start:>14.3f}"
+        else:
+            pairwise = f"{'skipped':>14}"
+        print(f"{num_rows:>8} {linear:>12.4f} {pairwise}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        save_kana_index(build_kana_index(read_records()), get_csv_hash())
+        print("wrote", INDEX_PATH)
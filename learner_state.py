@@ -0,0 +1,317 @@
+"""
+
+Compact per-user learner state for the tutoring bots
+
+A learner state holds a few float32 fields (e.g. attempts and failures) for every
+item in an ItemIndex. It is stored in modal.Dict as one record under key
+
+    header (magic, VERSION, number of fields, item-set hash, number of items), then
+    a float32 array of shape (fields, items)
+
+An answer in JapaneseKana also updates the questions of the same type and class,
+which are spread over the whole item set, so the dense state is not split: for its
+418 questions it is a single 3.4 kB record, read in the round trip of the
+StateSession (the keys come from get_keys) and written back if it changed
+
+    learner_state = await load_learner_state(my_dict, item_index, state, key, initial_values)
+    learner_state["attempts"][index] += 1
+    store_learner_state(state, key, learner_state)
+
+SparseLearnerState stores the same fields only for the items that were touched, as
+uint32 item positions followed by the float32 fields. It is meant for large item sets
+where a user only ever sees a small part, like the HSK word list. A review changes a
+single item, so the sparse state is stored in chunks of CHUNK_ITEMS items under key,
+key-1, key-2, ... with the header at the start of chunk 0, and only the chunks whose
+bytes changed are written back.
+
+When the item set changes (e.g. rows are added to the CSV), the stored hash no longer
+matches. The item keys of every item set are kept in the Dict under their hash, so the
+stored values can be carried over to the new item set by key instead of being dropped.
+A header that does not match the class, the version or the fields, or chunks of the
+wrong length, raise ValueError in decode, and load_learner_state starts over instead.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import struct
+
+import numpy as np
+
+VERSION = 1
+HEADER = struct.Struct("<4sBB8sI")  # magic, version, fields, item hash, items
+
+
+class ItemIndex:
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = list(keys)
+        self.key_to_index = {key: index for index, key in enumerate(self.keys)}
+        self.hash = hashlib.sha256("\n".join(self.keys).encode()).digest()[:8]
+        self.registered = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_items_key(self, item_hash=None):
+        return f"{self.name}-items-{(item_hash or self.hash).hex()}"
+
+    async def register(self, modal_dict):
+        # keep the item keys so that states written now can be migrated later
+        if not self.registered:
+            await modal_dict.put.aio(self.get_items_key(), self.keys)
+            self.registered = True
+
+
+def read_header(encoded):
+    return HEADER.unpack_from(encoded, 0)
+
+
+class ChunkedState:
+    MAGIC = None
+    HAS_INDICES = False
+    CHUNK_ITEMS = None
+
+    def __init__(self, item_index, fields, indices, arrays):
+        self.item_index = item_index
+        self.fields = list(fields)
+        self.indices = indices  # positions in item_index of the stored items, if sparse
+        self.arrays = arrays
+        self.stored_chunks = []  # the chunks as they are in the Dict
+
+    def __getitem__(self, field):
+        return self.arrays[field]
+
+    @classmethod
+    def get_chunk_keys(cls, key, num_items):
+        num_chunks = max(1, -(-num_items // cls.CHUNK_ITEMS))
+        return [key] + [f"{key}-{chunk}" for chunk in range(1, num_chunks)]
+
+    @classmethod
+    def read_chunks(cls, chunks):
+        """Returns (item positions or None, float32 array of shape (fields, items))."""
+        _, _, num_fields, _, num_items = read_header(chunks[0])
+        indices = []
+        values = [[] for _ in range(num_fields)]
+        for chunk_number, chunk in enumerate(chunks):
+            count = min(cls.CHUNK_ITEMS, num_items - chunk_number * cls.CHUNK_ITEMS)
+            offset = HEADER.size if chunk_number == 0 else 0
+            if len(chunk) != offset + 4 * count * (num_fields + cls.HAS_INDICES):
+                raise ValueError(f"chunk {chunk_number} has {len(chunk)} bytes")
+            if cls.HAS_INDICES:
+                indices.append(
+                    np.frombuffer(chunk, dtype="<u4", count=count, offset=offset)
+                )
+                offset += 4 * count
+            for field_values in values:
+                field_values.append(
+                    np.frombuffer(chunk, dtype="<f4", count=count, offset=offset)
+                )
+                offset += 4 * count
+        return (
+            np.concatenate(indices) if cls.HAS_INDICES else None,
+            np.array([np.concatenate(field_values) for field_values in values]),
+        )
+
+    def get_num_items(self):
+        return len(self.item_index) if self.indices is None else len(self.indices)
+
+    @classmethod
+    def check_header(cls, item_index, fields, header):
+        magic, version, num_fields, item_hash, num_items = header
+        if (magic, version, num_fields) != (cls.MAGIC, VERSION, len(fields)):
+            raise ValueError(
+                f"cannot decode {magic} version {version} with {num_fields} fields"
+            )
+        if item_hash != item_index.hash:
+            raise ValueError(f"the state was written for item set {item_hash.hex()}")
+        if not cls.HAS_INDICES and num_items != len(item_index):
+            raise ValueError(f"the state has {num_items} items")
+
+    @classmethod
+    def decode(cls, item_index, fields, chunks):
+        header = read_header(chunks[0])
+        cls.check_header(item_index, fields, header)
+        indices, values = cls.read_chunks(chunks)
+        state = cls(
+            item_index,
+            fields,
+            indices,
+            {field: values[i] for i, field in enumerate(fields)},
+        )
+        state.stored_chunks = list(chunks)
+        return state
+
+    def encode_chunks(self):
+        num_items = self.get_num_items()
+        header = HEADER.pack(
+            self.MAGIC, VERSION, len(self.fields), self.item_index.hash, num_items
+        )
+        chunks = []
+        for start in range(0, max(num_items, 1), self.CHUNK_ITEMS):
+            items = slice(start, start + self.CHUNK_ITEMS)
+            parts = [header] if start == 0 else []
+            if self.indices is not None:
+                parts.append(self.indices[items].tobytes())
+            parts += [self.arrays[field][items].tobytes() for field in self.fields]
+            chunks.append(b"".join(parts))
+        return chunks
+
+    def get_changed_chunks(self, key):
+        """Returns {chunk key: chunk} of the chunks that differ from the stored ones."""
+        chunks = self.encode_chunks()
+        changed = {
+            chunk_key: chunk
+            for chunk_number, (chunk_key, chunk) in enumerate(
+                zip(self.get_chunk_keys(key, self.get_num_items()), chunks)
+            )
+            if chunk_number >= len(self.stored_chunks)
+            or self.stored_chunks[chunk_number] != chunk
+        }
+        self.stored_chunks = chunks
+        return changed
+
+
+class LearnerState(ChunkedState):
+    MAGIC = b"LRNS"
+    # one record, the number of items is a uint32 in the header
+    CHUNK_ITEMS = 2**32 - 1
+
+    @classmethod
+    def get_keys(cls, key, item_index):
+        """The keys to read when the session opens: the record."""
+        return cls.get_chunk_keys(key, len(item_index))
+
+    @classmethod
+    def new(cls, item_index, initial_values):
+        """initial_values maps each field to its initial value for every item"""
+        return cls(
+            item_index,
+            initial_values,
+            None,
+            {
+                field: np.full(len(item_index), value, dtype="<f4")
+                for field, value in initial_values.items()
+            },
+        )
+
+    def migrate_from(self, chunks, old_keys):
+        """Copies the values of the items that are still present from another item set."""
+        _, old_values = self.read_chunks(chunks)
+        if old_values.shape[1] != len(old_keys):
+            raise ValueError(
+                f"{old_values.shape[1]} items stored for {len(old_keys)} keys"
+            )
+        old_positions, new_positions = [], []
+        for old_position, key in enumerate(old_keys):
+            if key in self.item_index.key_to_index:
+                old_positions.append(old_position)
+                new_positions.append(self.item_index.key_to_index[key])
+        for i, field in enumerate(self.fields):
+            self[field][new_positions] = old_values[i, old_positions]
+
+
+class SparseLearnerState(ChunkedState):
+    MAGIC = b"LRNP"
+    HAS_INDICES = True
+    # an item takes 4 bytes per field plus its position, and a review changes one
+    CHUNK_ITEMS = 16
+    PREFETCH_CHUNKS = 8
+
+    def __len__(self):
+        return len(self.indices)
+
+    @classmethod
+    def get_keys(cls, key, item_index):
+        """The keys to read when the session opens: the first PREFETCH_CHUNKS chunks,
+        which may not exist yet. The others are read by load_learner_state once the
+        header gives the number of items."""
+        return cls.get_chunk_keys(key, cls.PREFETCH_CHUNKS * cls.CHUNK_ITEMS)
+
+    @classmethod
+    def new(cls, item_index, initial_values):
+        """initial_values maps each field to the value of items that were never set"""
+        return cls(
+            item_index,
+            initial_values,
+            np.zeros(0, dtype="<u4"),
+            {field: np.zeros(0, dtype="<f4") for field in initial_values},
+        )
+
+    def get_position(self, index):
+        positions = np.flatnonzero(self.indices == index)
+        return int(positions[0]) if len(positions) else None
+
+    def set(self, index, **values):
+        """Sets the fields of one item, adding the item if it was never set."""
+        position = self.get_position(index)
+        if position is None:
+            self.indices = np.append(self.indices, np.uint32(index))
+            for field in self.fields:
+                self.arrays[field] = np.append(self.arrays[field], np.float32(0))
+            position = len(self.indices) - 1
+        for field, value in values.items():
+            self.arrays[field][position] = value
+
+    def migrate_from(self, chunks, old_keys):
+        """Keeps the items that are still present in the current item set."""
+        old_indices, old_values = self.read_chunks(chunks)
+        old_positions, new_indices = [], []
+        for old_position, old_index in enumerate(old_indices):
+            key = old_keys[old_index]
+            if key in self.item_index.key_to_index:
+                old_positions.append(old_position)
+                new_indices.append(self.item_index.key_to_index[key])
+        self.indices = np.array(new_indices, dtype="<u4")
+        for i, field in enumerate(self.fields):
+            self.arrays[field] = old_values[i, old_positions].copy()
+
+
+async def load_learner_state(
+    modal_dict, item_index, state, key, initial_values, state_class=LearnerState
+):
+    """Reads a stored state from a StateSession, migrating it if it was written for
+    another item set. The key must have been loaded with state_class.get_keys."""
+    first_chunk = state.get(key)
+    if first_chunk is None:
+        return state_class.new(item_index, initial_values)
+    header = read_header(first_chunk)
+    magic, version, num_fields, item_hash, num_items = header
+    chunk_keys = state_class.get_chunk_keys(key, num_items)
+    await state.load_more(chunk_keys)  # a sparse state may have more chunks
+    chunks = [state.get(chunk_key) for chunk_key in chunk_keys]
+    if None in chunks:
+        print(item_index.name, "learner state is missing chunks, starting over")
+        return state_class.new(item_index, initial_values)
+    if (magic, version, num_fields) != (
+        state_class.MAGIC,
+        VERSION,
+        len(initial_values),
+    ):
+        print(item_index.name, "cannot read learner state", magic, version, num_fields)
+        return state_class.new(item_index, initial_values)
+    try:
+        if item_hash == item_index.hash:
+            return state_class.decode(item_index, initial_values, chunks)
+        state_object = state_class.new(item_index, initial_values)
+        old_keys = await modal_dict.get.aio(item_index.get_items_key(item_hash))
+        if old_keys is not None:
+            state_object.migrate_from(chunks, old_keys)
+            print(item_index.name, "migrated learner state from", item_hash.hex())
+        else:
+            print(
+                item_index.name, "could not migrate learner state from", item_hash.hex()
+            )
+        return state_object
+    except ValueError as e:  # e.g. chunks written with another CHUNK_ITEMS
+        print(item_index.name, "cannot read learner state", e)
+        return state_class.new(item_index, initial_values)
+
+
+def store_learner_state(state, key, learner_state):
+    """Writes the chunks that changed since the state was loaded to the StateSession."""
+    changed = learner_state.get_changed_chunks(key)
+    state.add_keys(changed)
+    for chunk_key, chunk in changed.items():
+        state[chunk_key] = chunk
+    return changed
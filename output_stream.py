@@ -0,0 +1,138 @@
+"""
+
+Streaming of sandbox output to the chat
+
+The stdout and stderr of a sandbox process are read as they are produced, and stdout
+is forwarded to the chat while the code runs
+
+    async for text in stream_output(merge_streams({"stdout": ..., "stderr": ...}), ...):
+        yield PartialResponse(text=text)
+
+Each stream is kept in an OutputBuffer, which holds the first head_size and the last
+tail_size characters and only counts the rest, so a runaway print does not grow the
+memory of the bot. Once a process has written kill_size characters, it is stopped.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+
+HEAD_SIZE = 4000
+TAIL_SIZE = 1000
+KILL_SIZE = 1_000_000
+
+
+class OutputBuffer:
+    def __init__(self, head_size=HEAD_SIZE, tail_size=TAIL_SIZE):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = []
+        self.head_length = 0
+        self.tail = deque()  # chunks after the head, the oldest are dropped
+        self.tail_length = 0
+        self.total = 0
+
+    def write(self, text):
+        """Returns the part of the text that is in the head."""
+        self.total += len(text)
+        in_head = text[: max(0, self.head_size - self.head_length)]
+        if in_head:
+            self.head.append(in_head)
+            self.head_length += len(in_head)
+        rest = text[len(in_head) :]
+        if rest:
+            self.tail.append(rest)
+            self.tail_length += len(rest)
+            while self.tail_length - len(self.tail[0]) >= self.tail_size:
+                self.tail_length -= len(self.tail.popleft())
+        return in_head
+
+    @property
+    def omitted(self):
+        return self.total - self.head_length - min(self.tail_length, self.tail_size)
+
+    def get_rest(self):
+        """Returns what comes after the head, with a note on the omitted characters."""
+        tail = "".join(self.tail)[-self.tail_size :]
+        if self.omitted:
+            return f"\n... {self.omitted} characters omitted ...\n{tail}"
+        return tail
+
+    def getvalue(self):
+        return "".join(self.head) + self.get_rest()
+
+
+async def merge_streams(streams):
+    """Yields (name, text) from several async iterators, in the order they arrive."""
+    queue = asyncio.Queue()
+    done = object()
+
+    async def pump(name, chunks):
+        try:
+            async for chunk in chunks:
+                await queue.put((name, chunk))
+            await queue.put((name, done))
+        except BaseException as e:
+            await queue.put((name, e))
+
+    tasks = [
+        asyncio.create_task(pump(name, chunks)) for name, chunks in streams.items()
+    ]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            name, chunk = await queue.get()
+            if chunk is done:
+                remaining -= 1
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                yield name, chunk
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def stream_output(events, output, error, kill=None, kill_size=KILL_SIZE):
+    """Yields the chat text for (stream, text) events.
+
+    stdout is streamed in an output block up to the head of the output buffer, and
+    stderr is shown in an error block at the end. kill is awaited once the process
+    has written kill_size characters, and the events are not read further.
+    """
+    in_output_block = False
+    try:
+        async for stream, text in events:
+            if stream == "stdout":
+                text = output.write(text)
+                if text:
+                    if not in_output_block:
+                        in_output_block = True
+                        yield "\n\n```output\n"
+                    yield text
+            elif stream == "stderr":
+                error.write(text)
+            if kill is not None and output.total + error.total > kill_size:
+                await kill()
+                error.write(
+                    f"\nThe process was stopped after {kill_size} characters of output.\n"
+                )
+                break
+    finally:
+        if hasattr(events, "aclose"):
+            await events.aclose()
+
+    rest = output.get_rest()
+    if rest:
+        if not in_output_block:
+            in_output_block = True
+            yield "\n\n```output\n"
+        yield rest
+    if in_output_block:
+        yield ("" if output.getvalue().endswith("\n") else "\n") + "```\n\n"
+    if error.total:
+        error_text = error.getvalue()
+        if not error_text.endswith("\n"):
+            error_text += "\n"
+        yield f"\n\n```error\n{error_text}```\n\n"
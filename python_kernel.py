@@ -0,0 +1,472 @@
+"""
+
+Persistent Python kernels for PythonAgentBot
+
+python python_kernel.py benchmark  # turn latency with a DataFrame in the namespace, locally
+
+Each conversation runs its code in a kernel, a Python process in a leased sandbox
+that keeps its variables in memory between runs. Nothing is pickled between turns,
+so the latency of a turn does not depend on the size of the namespace.
+
+    kernels = KernelManager(pool)
+    async for stream, text in kernels.run(volume_name, conversation_id, code):
+        ...  # stream is "stdout" or "stderr", yielded as the code prints
+
+The kernel reads one JSON command per line from stdin
+
+    {"op": "run", "code": "...", "token": "..."}
+    {"op": "snapshot", "token": "..."}
+
+and after each command writes "\\n<token>\\n" to stdout and "\\n<token> <status>\\n" to
+stderr, so the output of each run can be separated on both streams.
+
+A kernel that is idle for idle_timeout, or the least recently used kernel when there
+are max_kernels, is evicted. On eviction the namespace is written to
+/cache/<conversation_id>.dill with dill.dump_session, and the sandbox is returned to
+the pool. The next kernel of the conversation loads the snapshot when it starts.
+If a kernel dies or a run exceeds run_timeout, the sandbox is terminated and the
+conversation continues from its last snapshot.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import shlex
+import time
+import uuid
+
+from output_stream import KILL_SIZE, merge_streams
+
+# runs inside the sandbox, everything except _kernel_main is the user's namespace
+KERNEL_SOURCE = """\
+def _kernel_main():
+    import json, os, sys, traceback, __main__
+
+    snapshot_path = sys.argv[1]
+    output_limit = int(sys.argv[2])
+    if os.path.exists(snapshot_path):
+        try:
+            import dill
+            with open(snapshot_path, "rb") as f:
+                dill.load_session(f)
+        except Exception:
+            pass
+
+    # user code must not read the commands
+    commands = sys.stdin
+    sys.stdin = open(os.devnull)
+
+    class OutputLimitExceeded(BaseException):
+        pass
+
+    class LimitedStream:
+        # stops the code once it has written output_limit characters in a run
+        written = 0
+
+        def __init__(self, stream):
+            self.stream = stream
+
+        def write(self, text):
+            LimitedStream.written += len(text)
+            if LimitedStream.written > output_limit:
+                raise OutputLimitExceeded()
+            return self.stream.write(text)
+
+        def __getattr__(self, name):
+            return getattr(self.stream, name)
+
+    for line in commands:
+        command = json.loads(line)
+        status = 0
+        LimitedStream.written = 0
+        sys.stdout = LimitedStream(sys.__stdout__)
+        sys.stderr = LimitedStream(sys.__stderr__)
+        try:
+            if command["op"] == "run":
+                exec(compile(command["code"], "<code>", "exec"), __main__.__dict__)
+            elif command["op"] == "snapshot":
+                import dill
+                with open(snapshot_path, "wb") as f:
+                    dill.dump_session(f)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except OutputLimitExceeded:
+            sys.__stderr__.write(
+                "\\nThe code was stopped after %d characters of output.\\n" % output_limit
+            )
+            status = 1
+        except BaseException:
+            # without the frame of _kernel_main
+            error_type, error, error_traceback = sys.exc_info()
+            traceback.print_exception(
+                error_type, error, error_traceback.tb_next, file=sys.__stderr__
+            )
+            status = 1
+        sys.__stdout__.write("\\n" + command["token"] + "\\n")
+        sys.__stdout__.flush()
+        sys.__stderr__.write("\\n" + command["token"] + " " + str(status) + "\\n")
+        sys.__stderr__.flush()
+
+_kernel_main()
+"""
+
+
+class KernelDied(Exception):
+    pass
+
+
+class TokenReader:
+    """Reads a kernel stream up to the token written after each command."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks.__aiter__()
+        self.buffer = ""
+        self.token_line = None  # the rest of the token line, after the last read
+
+    async def read(self, token):
+        """Yields the text before the token."""
+        marker = "\n" + token
+        while True:
+            position = self.buffer.find(marker)
+            if position != -1:
+                end = self.buffer.find("\n", position + len(marker))
+                if end != -1:
+                    if position:
+                        yield self.buffer[:position]
+                    self.token_line = self.buffer[position + len(marker) : end].strip()
+                    self.buffer = self.buffer[end + 1 :]
+                    return
+            elif self.buffer:
+                # a newline at the end of the buffer may be the start of the token
+                held = self.buffer.rfind("\n", max(0, len(self.buffer) - len(marker)))
+                if held == -1 or not marker.startswith(self.buffer[held:]):
+                    held = len(self.buffer)
+                if held:
+                    yield self.buffer[:held]
+                    self.buffer = self.buffer[held:]
+            try:
+                self.buffer += await self.chunks.__anext__()
+            except StopAsyncIteration:
+                if self.buffer:
+                    yield self.buffer
+                    self.buffer = ""
+                raise KernelDied()
+
+
+async def collect_events(events):
+    return [event async for event in events]
+
+
+class PythonKernel:
+    def __init__(self, pool, volume_name, session_name, output_limit):
+        self.lease = pool.lease(volume_name)
+        self.output_limit = output_limit
+        self.snapshot_path = f"/cache/{session_name}.dill"
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+        self.alive = False
+        self.closed = False
+
+    async def start(self):
+        sandbox = await self.lease.__aenter__()
+        try:
+            self.process = await sandbox.exec.aio(
+                "bash",
+                "-c",
+                "cd /cache && exec python -u -c "
+                f"{shlex.quote(KERNEL_SOURCE)} {shlex.quote(self.snapshot_path)} "
+                f"{self.output_limit}",
+            )
+        except BaseException as e:
+            await self.lease.__aexit__(type(e), e, e.__traceback__)
+            self.closed = True
+            raise
+        self.stdout = TokenReader(self.process.stdout)
+        self.stderr = TokenReader(self.process.stderr)
+        self.alive = True
+
+    async def send(self, command):
+        """Yields (stream, text) of the command as it runs, then ("status", status)."""
+        token = uuid.uuid4().hex
+        self.process.stdin.write(json.dumps({**command, "token": token}) + "\n")
+        await self.process.stdin.drain.aio()
+        async for event in merge_streams(
+            {"stdout": self.stdout.read(token), "stderr": self.stderr.read(token)}
+        ):
+            yield event
+        self.last_used = time.time()
+        yield "status", int(self.stderr.token_line)
+
+    async def close(self, error=None):
+        """Returns the sandbox to the pool, or terminates it if there was an error."""
+        if self.closed:
+            return
+        self.closed = True
+        self.alive = False
+        if error is None:
+            try:
+                self.process.stdin.write_eof()
+                await self.process.stdin.drain.aio()
+                await asyncio.wait_for(self.process.wait.aio(), timeout=30)
+            except Exception as e:
+                error = e
+        if error is None:
+            await self.lease.__aexit__(None, None, None)
+        else:
+            try:
+                await self.lease.__aexit__(type(error), error, error.__traceback__)
+            except BaseException as e:
+                if e is not error:
+                    raise
+
+
+class KernelManager:
+    def __init__(
+        self,
+        pool,
+        idle_timeout=600,
+        max_kernels=8,
+        run_timeout=300,
+        snapshot_timeout=60,
+        output_limit=KILL_SIZE,
+    ):
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.max_kernels = max_kernels
+        self.run_timeout = run_timeout
+        self.snapshot_timeout = snapshot_timeout
+        self.output_limit = output_limit
+        self.kernels = {}  # session name -> PythonKernel
+        self.evicting = {}  # session name -> PythonKernel writing its snapshot
+        self.background_tasks = set()
+
+    async def get_kernel(self, volume_name, session_name):
+        if session_name in self.evicting:
+            # the next kernel loads the snapshot, so it waits for it to be written
+            async with self.evicting[session_name].lock:
+                pass
+        kernel = self.kernels.get(session_name)
+        if kernel is None or kernel.closed:
+            if len(self.kernels) >= self.max_kernels:
+                session_name_lru = min(
+                    self.kernels, key=lambda name: self.kernels[name].last_used
+                )
+                await self.evict(session_name_lru)
+            kernel = self.kernels.get(session_name)
+        if kernel is None or kernel.closed:
+            kernel = PythonKernel(
+                self.pool, volume_name, session_name, self.output_limit
+            )
+            self.kernels[session_name] = kernel
+            self.schedule(self.evict_when_idle(session_name, kernel))
+        return kernel
+
+    async def run(self, volume_name, session_name, code):
+        """Yields (stream, text) as the code runs, stream is "stdout" or "stderr".
+
+        The kernel stops the code once it has written output_limit characters.
+        """
+        kernel = await self.get_kernel(volume_name, session_name)
+        async with kernel.lock:
+            start = time.perf_counter()
+            if not kernel.alive:
+                await kernel.start()
+            events = kernel.send({"op": "run", "code": code})
+            status = None
+            try:
+                while True:
+                    remaining = self.run_timeout - (time.perf_counter() - start)
+                    stream, text = await asyncio.wait_for(
+                        events.__anext__(), timeout=max(0, remaining)
+                    )
+                    if stream == "status":
+                        status = text
+                    else:
+                        yield stream, text
+            except StopAsyncIteration:
+                pass
+            except asyncio.TimeoutError as e:
+                await self.discard(session_name, kernel, e)
+                yield "stderr", f"Execution timed out after {self.run_timeout} seconds."
+            except KernelDied as e:
+                await self.discard(session_name, kernel, e)
+                yield "stderr", "\nThe Python process has exited."
+            finally:
+                await events.aclose()
+            print(
+                "kernel_run",
+                session_name,
+                "status",
+                status,
+                "seconds",
+                round(time.perf_counter() - start, 3),
+            )
+
+    async def kill(self, session_name):
+        """Terminates the kernel, e.g. when it writes output beyond its limit."""
+        kernel = self.kernels.get(session_name)
+        if kernel is not None:
+            await self.discard(session_name, kernel, KernelDied("killed"))
+
+    async def discard(self, session_name, kernel, error):
+        if self.kernels.get(session_name) is kernel:
+            del self.kernels[session_name]
+        await kernel.close(error)
+
+    async def evict(self, session_name):
+        kernel = self.kernels.pop(session_name)
+        self.evicting[session_name] = kernel
+        try:
+            await self.snapshot_and_close(session_name, kernel)
+        finally:
+            if self.evicting.get(session_name) is kernel:
+                del self.evicting[session_name]
+
+    async def snapshot_and_close(self, session_name, kernel):
+        async with kernel.lock:
+            if not kernel.alive:
+                await kernel.close()
+                return
+            try:
+                start = time.perf_counter()
+                events = await asyncio.wait_for(
+                    collect_events(kernel.send({"op": "snapshot"})),
+                    timeout=self.snapshot_timeout,
+                )
+                status = events.pop()[1]
+                error = "".join(text for stream, text in events if stream == "stderr")
+                print(
+                    "kernel_snapshot",
+                    session_name,
+                    "status",
+                    status,
+                    "seconds",
+                    round(time.perf_counter() - start, 3),
+                )
+                if status:
+                    print(error)
+            except (asyncio.TimeoutError, KernelDied) as e:
+                print("kernel_snapshot", session_name, "failed", repr(e))
+                await kernel.close(e)
+                return
+            await kernel.close()
+
+    async def evict_when_idle(self, session_name, kernel):
+        while self.kernels.get(session_name) is kernel:
+            idle = time.time() - kernel.last_used
+            if idle >= self.idle_timeout and not kernel.lock.locked():
+                await self.evict(session_name)
+                return
+            await asyncio.sleep(max(1, self.idle_timeout - idle))
+
+    def schedule(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+# one kernel manager per sandbox pool
+KERNEL_MANAGERS = {}
+
+
+def get_kernel_manager(pool, **kwargs):
+    if id(pool) not in KERNEL_MANAGERS:
+        KERNEL_MANAGERS[id(pool)] = KernelManager(pool, **kwargs)
+    return KERNEL_MANAGERS[id(pool)]
+
+
+# code with dill.load_session before and dill.dump_session after, as every turn was
+# run before the kernels
+DILL_SESSION_CODE = """\
+import dill, os
+if os.path.exists("session.dill"):
+    dill.load_session("session.dill")
+
+{code}
+
+dill.dump_session("session.dill")
+"""
+
+
+def benchmark(turns=5):
+    """Turn latency with a DataFrame in the namespace, run locally without sandboxes."""
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    async def read_chunks(stream):
+        while chunk := await stream.read(65536):
+            yield chunk.decode()
+
+    async def measure_kernel(setup, code):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-u",
+            "-c",
+            KERNEL_SOURCE,
+            "session.dill",
+            str(KILL_SIZE),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout = TokenReader(read_chunks(process.stdout))
+        stderr = TokenReader(read_chunks(process.stderr))
+        times = []
+        for turn_code in [setup] + [code] * turns:
+            token = uuid.uuid4().hex
+            start = time.perf_counter()
+            process.stdin.write(
+                (
+                    json.dumps({"op": "run", "code": turn_code, "token": token}) + "\n"
+                ).encode()
+            )
+            await process.stdin.drain()
+            await collect_events(
+                merge_streams(
+                    {"stdout": stdout.read(token), "stderr": stderr.read(token)}
+                )
+            )
+            times.append(time.perf_counter() - start)
+        process.stdin.close()
+        await process.wait()
+        return times[1:]
+
+    def measure_dill(setup, code):
+        times = []
+        for turn_code in [setup] + [code] * turns:
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", DILL_SESSION_CODE.format(code=turn_code)],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            times.append(time.perf_counter() - start)
+        os.remove("session.dill")
+        return times[1:]
+
+    code = "print(len(df))"
+    print(f"{'rows':>10} {'dill per turn (s)':>18} {'kernel per turn (s)':>20}")
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        for rows in (10**4, 10**5, 10**6, 10**7):
+            setup = (
+                "import numpy as np, pandas as pd\n"
+                f"df = pd.DataFrame({{'a': np.arange({rows}), 'b': np.ones({rows})}})\n"
+                "df['c'] = df['a'].astype(str)"
+            )
+            dill_times = measure_dill(setup, code)
+            kernel_times = asyncio.run(measure_kernel(setup, code))
+            print(
+                f"{rows:>10} {sum(dill_times) / turns:>18.3f} "
+                f"{sum(kernel_times) / turns:>20.4f}"
+            )
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
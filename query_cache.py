@@ -0,0 +1,299 @@
+"""
+
+Cache of the output of self-contained Trino queries
+
+python query_cache.py benchmark  # repeated demo queries, with and without the cache
+
+TrinoAgentBot has the model demonstrate each keyword on a table defined in the query
+itself, WITH t (a, b) AS (VALUES ...). Many users ask about the same functions, and the
+model writes nearly the same queries, so the cluster ran them again and again.
+
+The output of such a query is cached, keyed on a fingerprint of the SQL
+
+    cache_key, chunks = cache.get(query, max_rows, max_bytes)
+    if chunks is None:
+        ...  # run the query
+        cache.put(cache_key, chunks)
+
+The fingerprint drops comments, collapses whitespace, uppercases everything outside
+of quotes and sorts the literals of IN (...) lists. The rows of VALUES keep their
+order, as it shows in the output.
+
+Only queries that read no tables and call no nondeterministic function are cached:
+every relation in a FROM or JOIN must be a subquery, UNNEST, VALUES or a name defined
+in the WITH clause. cache_key is None for the other queries. The cache is an LRU of
+max_entries outputs in the process, and an output expires ttl_seconds after it was
+stored.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import re
+import sys
+import time
+from collections import OrderedDict
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<quoted>"(?:[^"]|"")*")
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<symbol><>|!=|<=|>=|\|\||=>|->|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+READ_ONLY_STARTS = {"SELECT", "WITH", "VALUES"}
+
+UNCACHEABLE_WORDS = {
+    # nondeterministic functions
+    "RANDOM",
+    "RAND",
+    "UUID",
+    "SHUFFLE",
+    "NOW",
+    "CURRENT_DATE",
+    "CURRENT_TIME",
+    "CURRENT_TIMESTAMP",
+    "CURRENT_TIMEZONE",
+    "LOCALTIME",
+    "LOCALTIMESTAMP",
+    "CURRENT_USER",
+    "CURRENT_CATALOG",
+    "CURRENT_SCHEMA",
+    "CURRENT_GROUPS",
+    "TABLESAMPLE",
+    # statements that are not plain reads
+    "INSERT",
+    "UPDATE",
+    "DELETE",
+    "MERGE",
+    "CREATE",
+    "DROP",
+    "ALTER",
+    "CALL",
+    "EXECUTE",
+    "TABLE",
+}
+
+# a FROM clause ends at these keywords, at its own depth
+FROM_CLAUSE_ENDS = {
+    "WHERE",
+    "GROUP",
+    "HAVING",
+    "WINDOW",
+    "ORDER",
+    "LIMIT",
+    "OFFSET",
+    "FETCH",
+    "UNION",
+    "INTERSECT",
+    "EXCEPT",
+}
+
+TABLE_FREE_RELATIONS = {"(", "UNNEST", "LATERAL", "VALUES"}
+
+
+def tokenize(query):
+    """Returns the tokens of the query, without spaces and comments, uppercased
+    outside of quotes."""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(query):
+        kind = match.lastgroup
+        if kind in ("space", "comment"):
+            continue
+        token = match.group()
+        tokens.append(token.upper() if kind in ("word", "symbol") else token)
+    return tokens
+
+
+def is_literal(token):
+    return token[0] == "'" or token[0].isdigit() or token[0] == "."
+
+
+def sort_in_lists(tokens):
+    """Sorts the literals of IN (...) lists that contain only literals."""
+    tokens = list(tokens)
+    for start in range(len(tokens) - 1):
+        if tokens[start] != "IN" or tokens[start + 1] != "(":
+            continue
+        end = start + 2
+        while end < len(tokens) and tokens[end] != ")":
+            end += 1
+        values = tokens[start + 2 : end : 2]
+        commas = tokens[start + 3 : end : 2]
+        if values and all(map(is_literal, values)) and set(commas) <= {","}:
+            tokens[start + 2 : end : 2] = sorted(values)
+    return tokens
+
+
+def get_fingerprint(query):
+    return " ".join(sort_in_lists(tokenize(query)))
+
+
+def get_cte_names(tokens):
+    """Names defined as name [(columns)] AS ( after WITH or a comma."""
+    names = set()
+    for index, token in enumerate(tokens[:-1]):
+        if index == 0 or tokens[index - 1] not in ("WITH", "RECURSIVE", ","):
+            continue
+        after = index + 1
+        if tokens[after] == "(":
+            while after < len(tokens) and tokens[after] != ")":
+                after += 1
+            after += 1
+        if tokens[after : after + 2] == ["AS", "("]:
+            names.add(token)
+    return names
+
+
+def get_relations(tokens):
+    """Returns the first token of each relation of the FROM clauses and JOINs."""
+    relations = []
+    depth = 0
+    from_depths = []  # depths of the FROM clauses being read
+    expect_relation = False
+    for token in tokens:
+        if expect_relation:
+            relations.append(token)
+            expect_relation = False
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            if from_depths and from_depths[-1] == depth:
+                from_depths.pop()
+            depth -= 1
+        elif token == "FROM":
+            from_depths.append(depth)
+            expect_relation = True
+        elif token == "JOIN":
+            expect_relation = True
+        elif from_depths and from_depths[-1] == depth:
+            if token == ",":
+                expect_relation = True
+            elif token in FROM_CLAUSE_ENDS:
+                from_depths.pop()
+    return relations
+
+
+def is_cacheable(tokens):
+    """Whether the query is a read of no table with a deterministic result."""
+    if not tokens or tokens[0] not in READ_ONLY_STARTS:
+        return False
+    if UNCACHEABLE_WORDS.intersection(tokens):
+        return False
+    allowed = TABLE_FREE_RELATIONS | get_cte_names(tokens)
+    return all(relation in allowed for relation in get_relations(tokens))
+
+
+class QueryCache:
+    def __init__(self, max_entries=1024, ttl_seconds=24 * 3600):
+        self.entries = OrderedDict()  # cache key -> (expires_at, chunks), oldest first
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"hit": 0, "miss": 0, "expired": 0, "uncacheable": 0}
+
+    def get_cache_key(self, query, *options):
+        """Returns None if the output of the query may not be cached."""
+        tokens = tokenize(query)
+        if not is_cacheable(tokens):
+            return None
+        fingerprint = " ".join(sort_in_lists(tokens))
+        return hashlib.sha256(repr((fingerprint, options)).encode()).hexdigest()
+
+    def get(self, query, *options):
+        """Returns (cache_key, chunks), chunks is None on a miss.
+
+        The options, such as the row and byte caps, are part of the key."""
+        cache_key = self.get_cache_key(query, *options)
+        if cache_key is None:
+            self.record("uncacheable", cache_key)
+            return None, None
+        entry = self.entries.get(cache_key)
+        if entry is None:
+            self.record("miss", cache_key)
+            return cache_key, None
+        expires_at, chunks = entry
+        if expires_at < time.time():
+            del self.entries[cache_key]
+            self.record("expired", cache_key)
+            return cache_key, None
+        self.entries.move_to_end(cache_key)
+        self.record("hit", cache_key)
+        return cache_key, chunks
+
+    def put(self, cache_key, chunks):
+        self.entries[cache_key] = (time.time() + self.ttl_seconds, chunks)
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def record(self, status, cache_key):
+        self.stats[status] += 1
+        print(
+            "query_cache",
+            status,
+            (cache_key or "")[:12],
+            "entries",
+            len(self.entries),
+            self.stats,
+        )
+
+
+def benchmark(num_users=20, query_seconds=0.3):
+    """num_users ask about the same keyword, and the model writes the query in
+    slightly different ways each time."""
+    from result_table import stream_table
+    from trino_benchmark import StandInTrinoServer
+    from trino_pool import TrinoPool
+
+    server = StandInTrinoServer()
+    variants = [
+        f"""WITH t (a, b) AS (VALUES (1, NULL), (2, 'x'))
+        SELECT a, COALESCE(b, 'none') AS b FROM t WHERE a IN (1, 2) AND sleep({query_seconds})""",
+        f"""with t (a, b) as (values (1, null), (2, 'x'))
+        select a, coalesce(b, 'none') as b
+        from t
+        where a in (2, 1) and sleep({query_seconds})  -- NVL is COALESCE""",
+    ]
+    assert get_fingerprint(variants[0]) == get_fingerprint(variants[1])
+    # a query that reads a table is never cached
+    assert QueryCache().get_cache_key("SELECT * FROM tpch.sf1.nation") is None
+
+    async def answer(pool, cache, query):
+        cache_key, chunks = cache.get(query) if cache else (None, None)
+        if chunks is not None:
+            return "".join(chunks)
+        chunks = [text async for text in stream_table(pool, query)]
+        if cache_key is not None:
+            cache.put(cache_key, chunks)
+        return "".join(chunks)
+
+    async def measure(cache):
+        pool = TrinoPool(server.connect, max_size=4)
+        start = time.perf_counter()
+        outputs = []
+        for index in range(num_users):
+            outputs.append(await answer(pool, cache, variants[index % len(variants)]))
+        elapsed = time.perf_counter() - start
+        return elapsed, pool.stats["finished"], outputs
+
+    print(f"{num_users} users, {len(variants)} ways of writing the same query")
+    print(f"{'':>9} {'total (s)':>10} {'queries run':>12}")
+    results = {}
+    for name, cache in (("no cache", None), ("cache", QueryCache())):
+        elapsed, num_queries, outputs = asyncio.run(measure(cache))
+        results[name] = outputs
+        print(f"{name:>9} {elapsed:>10.2f} {num_queries:>12}")
+    assert results["cache"] == results["no cache"]
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
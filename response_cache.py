@@ -0,0 +1,167 @@
+"""
+
+Cache of deterministic (temperature 0) bot responses
+
+The tutoring bots grade recurring answers ("ai4 love") with temperature 0 calls.
+Those responses are cached, keyed on the bot name, the normalized messages, the
+temperature and the logit_bias, in two tiers
+
+    in-process: an LRU of the most recent responses
+    shared:     a modal.Dict, where each entry expires after a TTL
+
+    cache = ResponseCache("ChineseVocab", Dict.from_name("dict-response-cache"))
+    async for msg in cache.stream_request(request, "Llama-3-8b-Groq"):
+        yield msg
+
+A response is stored as the list of text chunks it was streamed in, and a hit is
+replayed chunk by chunk as PartialResponse, so the user sees the same stream.
+
+modal.Dict has no eviction, so the shared tier is direct-mapped: a key is stored in
+one of num_slots slots, and a newer response overwrites the slot. The shared tier
+never holds more than num_slots entries of at most max_entry_bytes each.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+import fastapi_poe as fp
+from fastapi_poe.types import PartialResponse
+
+
+def normalize_content(content):
+    # full-width and half-width input, extra spaces and newlines give the same key
+    content = unicodedata.normalize("NFKC", content)
+    return re.sub(r"\s+", " ", content).strip()
+
+
+def get_cache_key(request, bot_name):
+    messages = []
+    for message in request.query:
+        if isinstance(message, dict):  # some bots build the query from dicts
+            role, content = message["role"], message["content"]
+        else:
+            role, content = message.role, message.content
+        messages.append([role, normalize_content(content)])
+    payload = [
+        bot_name,
+        messages,
+        request.temperature,
+        sorted((request.logit_bias or {}).items()),
+    ]
+    return hashlib.sha256(
+        json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        name,
+        modal_dict=None,
+        max_local_entries=1024,
+        num_slots=65536,
+        ttl_seconds=7 * 24 * 3600,
+        max_entry_bytes=16384,
+    ):
+        self.name = name
+        self.modal_dict = modal_dict
+        self.local = OrderedDict()  # cache key -> list of chunks, oldest first
+        self.max_local_entries = max_local_entries
+        self.num_slots = num_slots
+        self.ttl_seconds = ttl_seconds
+        self.max_entry_bytes = max_entry_bytes
+        self.stats = {}  # bot name -> {"local": hits, "shared": hits, "miss": misses}
+
+    def get_slot_key(self, cache_key):
+        return f"{self.name}-response-cache-{int(cache_key[:8], 16) % self.num_slots}"
+
+    def put_local(self, cache_key, chunks):
+        self.local[cache_key] = chunks
+        self.local.move_to_end(cache_key)
+        while len(self.local) > self.max_local_entries:
+            self.local.popitem(last=False)
+
+    async def get(self, cache_key):
+        """Returns (chunks, tier), or (None, "miss")."""
+        if cache_key in self.local:
+            self.local.move_to_end(cache_key)
+            return self.local[cache_key], "local"
+        if self.modal_dict is None:
+            return None, "miss"
+        entry = await self.modal_dict.get.aio(self.get_slot_key(cache_key))
+        if (
+            entry is None
+            or entry["key"] != cache_key
+            or entry["expires_at"] < time.time()
+        ):
+            return None, "miss"
+        self.put_local(cache_key, entry["chunks"])
+        return entry["chunks"], "shared"
+
+    async def put(self, cache_key, chunks):
+        self.put_local(cache_key, chunks)
+        if self.modal_dict is None:
+            return
+        if sum(len(chunk.encode()) for chunk in chunks) > self.max_entry_bytes:
+            return
+        await self.modal_dict.put.aio(
+            self.get_slot_key(cache_key),
+            {
+                "key": cache_key,
+                "chunks": chunks,
+                "expires_at": time.time() + self.ttl_seconds,
+            },
+        )
+
+    def record(self, bot_name, tier):
+        stats = self.stats.setdefault(bot_name, {"local": 0, "shared": 0, "miss": 0})
+        stats[tier] += 1
+        lookups = sum(stats.values())
+        print(
+            self.name,
+            "response_cache",
+            bot_name,
+            tier,
+            "hit_rate",
+            round((lookups - stats["miss"]) / lookups, 3),
+            stats,
+        )
+
+    def get_hit_rates(self):
+        return {
+            bot_name: (sum(stats.values()) - stats["miss"]) / sum(stats.values())
+            for bot_name, stats in self.stats.items()
+        }
+
+    async def stream_request(self, request, bot_name):
+        """fp.stream_request, with temperature 0 responses served from the cache."""
+        if request.temperature != 0:
+            async for msg in fp.stream_request(request, bot_name, request.access_key):
+                yield msg
+            return
+
+        cache_key = get_cache_key(request, bot_name)
+        chunks, tier = await self.get(cache_key)
+        self.record(bot_name, tier)
+        if chunks is not None:
+            for chunk in chunks:
+                yield PartialResponse(text=chunk)
+            return
+
+        chunks = []
+        async for msg in fp.stream_request(request, bot_name, request.access_key):
+            # replaces and other events are not replayed, so the response is not cached
+            if msg.is_replace_response or msg.is_suggested_reply:
+                chunks = None
+            if chunks is not None:
+                chunks.append(msg.text)
+            yield msg
+        # only complete responses are stored, an interrupted stream never gets here
+        if chunks:
+            await self.put(cache_key, chunks)
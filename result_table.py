@@ -0,0 +1,140 @@
+"""
+
+Markdown tables of Trino results, streamed as the rows arrive
+
+python result_table.py benchmark  # fetchall and concatenation vs streaming, large result
+
+RunTrinoQueryBot used to fetch every row of the result and build the table in one
+string, so a query without a LIMIT held millions of rows in memory before the user
+saw anything. The rows are now fetched in batches and each batch is rendered and sent
+as it arrives
+
+    async for text in stream_table(get_trino_pool(), query, max_rows, max_bytes):
+        yield self.text_event(text)
+
+The header comes first, as soon as the columns are known. The table stops at max_rows
+rows or max_bytes bytes, whichever comes first. The query is then cancelled on the
+server and a footer says how many rows were left out, as a lower bound if the server
+had more to send.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sys
+import time
+import tracemalloc
+
+MAX_ROWS = 1000
+MAX_BYTES = 100_000
+BATCH_SIZE = 500
+
+
+def format_header(columns):
+    header = " | " + "|".join(column.name for column in columns) + " | "
+    return header + "\n" + " | " + " | ".join("-" for _ in columns) + " | "
+
+
+def format_row(row):
+    return "\n" + " | " + " | ".join(str(value) for value in row) + " | "
+
+
+async def stream_table(
+    pool,
+    query,
+    max_rows=MAX_ROWS,
+    max_bytes=MAX_BYTES,
+    batch_size=BATCH_SIZE,
+    timeout=None,
+):
+    """Yields the header, the rows of each batch, and a footer if rows were left out."""
+    batches = pool.stream(query, batch_size, timeout)
+    num_rows = 0
+    num_bytes = 0
+    try:
+        async for columns, rows in batches:
+            if num_bytes == 0:
+                header = format_header(columns or [])
+                num_bytes += len(header.encode())
+                yield header
+            lines = []
+            for index, row in enumerate(rows):
+                line = format_row(row)
+                size = len(line.encode())
+                if num_rows == max_rows or num_bytes + size > max_bytes:
+                    if lines:
+                        yield "".join(lines)
+                    left_out = len(rows) - index
+                    if len(rows) == batch_size:  # the server had more rows
+                        yield f"\n\nat least {left_out} more rows truncated"
+                    else:
+                        yield f"\n\n{left_out} more rows truncated"
+                    return
+                lines.append(line)
+                num_rows += 1
+                num_bytes += size
+            if lines:
+                yield "".join(lines)
+    finally:
+        await batches.aclose()  # cancels the query if it has more rows
+
+
+def benchmark(num_rows=200_000, max_rows=MAX_ROWS):
+    from trino_benchmark import StandInTrinoServer
+    from trino_pool import TrinoPool, fetch_all
+
+    server = StandInTrinoServer(page_size=10_000)
+    query = f"SELECT * FROM t WHERE rows({num_rows})"
+
+    def format_output(columns, rows) -> str:
+        # the bots used to render the whole result this way
+        output = " | " + "|".join(column.name for column in columns) + " | "
+        output += "\n" + " | " + " | ".join("-" for _ in columns) + " | "
+        for row in rows:
+            output += "\n" + " | " + " | ".join(str(value) for value in row) + " | "
+        return output
+
+    async def fetch_and_format(pool):
+        columns, rows = await pool.run(fetch_all, query)
+        yield format_output(columns, rows)
+
+    async def measure(render):
+        pool = TrinoPool(server.connect, max_size=2)
+        tracemalloc.start()
+        start = time.perf_counter()
+        first = None
+        output = []
+        async for text in render(pool):
+            if first is None:
+                first = time.perf_counter() - start
+            output.append(text)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        await asyncio.sleep(0.2)  # the cancellation is sent in the background
+        return first, elapsed, peak, "".join(output)
+
+    print(f"SELECT of {num_rows} rows, table capped at {max_rows} rows")
+    print(
+        f"{'':>17} {'first byte (s)':>15} {'total (s)':>10}"
+        f" {'peak memory (MB)':>17} {'table (KB)':>11}"
+    )
+    for name, render in (
+        ("fetchall, concat", fetch_and_format),
+        ("stream", lambda pool: stream_table(pool, query, max_rows)),
+    ):
+        first, elapsed, peak, output = asyncio.run(measure(render))
+        print(
+            f"{name:>17} {first:>15.3f} {elapsed:>10.3f}"
+            f" {peak / 1e6:>17.1f} {len(output) / 1e3:>11.1f}"
+        )
+    print("footer:", output.rsplit("\n", 1)[-1])
+    print("queries cancelled on the server", len(server.cancelled))
+    assert output.count("\n | ") == max_rows + 1
+    assert len(server.cancelled) == 1
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
@@ -0,0 +1,236 @@
+"""
+
+Pool of warm sandboxes for the code execution bots
+
+Creating a sandbox on the execution image (torch, tensorflow, transformers, spacy)
+is a cold start. Instead, sandboxes are kept running idle and leased for each run
+
+    pool = get_sandbox_pool(IMAGE_EXEC, "PythonAgent")
+    async with pool.lease(get_volume_name(request.user_id)) as sb:
+        process = await sb.exec.aio("bash", "-c", "cd /cache && python script.py")
+
+A sandbox only ever serves one user. Modal mounts a NetworkFileSystem when the
+sandbox is created and cannot mount it later, so the user's volume is mounted when
+the sandbox is created, and idle sandboxes are kept per volume. After a lease, the
+pool creates sandboxes in the background until min_size are idle for the volume.
+
+The pool never holds more than max_size sandboxes. When it is full, the oldest idle
+sandbox of another volume is terminated, or the lease waits for one to be returned.
+Sandboxes idle for longer than idle_ttl are terminated.
+
+Each lease prints whether it was warm or cold and how long it waited.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+import modal
+import numpy as np
+
+# a sandbox is not leased again this close to its timeout
+SANDBOX_TIMEOUT_MARGIN = 120
+
+
+def get_volume_name(user_id, prefix="vol"):
+    # a bot that keeps its files apart from the other bots passes its own prefix
+    return f"{prefix}-{user_id[::-1][:32][::-1]}"
+
+
+class SandboxPool:
+    def __init__(
+        self,
+        image,
+        name,
+        min_size=1,
+        max_size=16,
+        idle_ttl=300,
+        sandbox_timeout=3600,
+        app=None,
+    ):
+        self.image = image
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.sandbox_timeout = sandbox_timeout
+        self.app = app  # only needed outside a Modal container, e.g. for a benchmark
+        self.idle = defaultdict(list)  # volume name -> [(sandbox, created, idle since)]
+        self.size = 0  # sandboxes created and not terminated, leased or idle
+        self.returned = asyncio.Condition()
+        self.filling = set()  # volume names with a background fill running
+        self.background_tasks = set()
+        self.stats = {"warm": 0, "cold": 0}
+        self.lease_waits = deque(maxlen=1000)  # seconds, of the most recent leases
+
+    async def create(self, volume_name):
+        nfs = modal.NetworkFileSystem.from_name(volume_name, create_if_missing=True)
+        # the sandbox idles until it is terminated, code runs with sb.exec
+        return await modal.Sandbox.create.aio(
+            "sleep",
+            "infinity",
+            image=self.image,
+            network_file_systems={"/cache": nfs},
+            timeout=self.sandbox_timeout,
+            app=self.app,
+        )
+
+    async def terminate(self, sandbox):
+        self.size -= 1
+        async with self.returned:
+            self.returned.notify()
+        try:
+            await sandbox.terminate.aio()
+        except Exception as e:
+            print(self.name, "could not terminate sandbox", e)
+
+    def is_usable(self, created, idle_since, now):
+        return (
+            now - idle_since < self.idle_ttl
+            and now - created < self.sandbox_timeout - SANDBOX_TIMEOUT_MARGIN
+        )
+
+    async def prune(self):
+        now = time.time()
+        for volume_name in list(self.idle):
+            idle = self.idle[volume_name]
+            self.idle[volume_name] = [
+                entry for entry in idle if self.is_usable(entry[1], entry[2], now)
+            ]
+            for sandbox, created, idle_since in idle:
+                if not self.is_usable(created, idle_since, now):
+                    await self.terminate(sandbox)
+            if not self.idle[volume_name]:
+                del self.idle[volume_name]
+
+    async def evict_other(self, volume_name):
+        """Terminates the longest idle sandbox of another volume, if any."""
+        candidates = [
+            (idle_since, other)
+            for other, idle in self.idle.items()
+            if other != volume_name
+            for _, _, idle_since in idle
+        ]
+        if not candidates:
+            return False
+        _, other = min(candidates)
+        sandbox, _, _ = self.idle[other].pop(0)
+        if not self.idle[other]:
+            del self.idle[other]
+        await self.terminate(sandbox)
+        return True
+
+    async def acquire(self, volume_name):
+        """Returns (sandbox, created, whether the sandbox was warm)."""
+        while True:
+            await self.prune()
+            if self.idle.get(volume_name):
+                sandbox, created, _ = self.idle[volume_name].pop()
+                return sandbox, created, True
+            if self.size < self.max_size or await self.evict_other(volume_name):
+                break
+            async with self.returned:
+                try:
+                    await asyncio.wait_for(self.returned.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass  # checks again, in case the notification was missed
+        self.size += 1
+        try:
+            sandbox = await self.create(volume_name)
+        except BaseException:
+            self.size -= 1
+            raise
+        return sandbox, time.time(), False
+
+    async def release(self, volume_name, sandbox, created):
+        self.idle[volume_name].append((sandbox, created, time.time()))
+        async with self.returned:
+            self.returned.notify()
+        # the sandbox is terminated after idle_ttl even if there is no further lease
+        self.schedule(self.prune_later())
+
+    async def prune_later(self):
+        await asyncio.sleep(self.idle_ttl + 1)
+        await self.prune()
+
+    async def fill(self, volume_name):
+        try:
+            while (
+                len(self.idle.get(volume_name, [])) < self.min_size
+                and self.size < self.max_size
+            ):
+                self.size += 1
+                try:
+                    sandbox = await self.create(volume_name)
+                except BaseException:
+                    self.size -= 1
+                    raise
+                await self.release(volume_name, sandbox, time.time())
+        except Exception as e:
+            print(self.name, "could not fill sandbox pool", e)
+        finally:
+            self.filling.discard(volume_name)
+
+    def schedule(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def schedule_fill(self, volume_name):
+        if volume_name not in self.filling:
+            self.filling.add(volume_name)
+            self.schedule(self.fill(volume_name))
+
+    @asynccontextmanager
+    async def lease(self, volume_name):
+        start = time.perf_counter()
+        sandbox, created, warm = await self.acquire(volume_name)
+        lease_wait = time.perf_counter() - start
+        self.stats["warm" if warm else "cold"] += 1
+        self.lease_waits.append(lease_wait)
+        print(
+            self.name,
+            "sandbox_lease",
+            "warm" if warm else "cold",
+            "wait",
+            round(lease_wait, 3),
+            self.get_stats(),
+        )
+        self.schedule_fill(volume_name)
+        try:
+            yield sandbox
+        except BaseException:
+            # the run may have been interrupted, so the sandbox is not reused
+            await self.terminate(sandbox)
+            raise
+        else:
+            await self.release(volume_name, sandbox, created)
+
+    async def close(self):
+        """Terminates the idle sandboxes, e.g. at the end of a benchmark."""
+        for task in list(self.background_tasks):
+            task.cancel()
+        for volume_name in list(self.idle):
+            for sandbox, _, _ in self.idle.pop(volume_name):
+                await self.terminate(sandbox)
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "size": self.size,
+            "lease_wait_p50": round(float(np.percentile(self.lease_waits, 50)), 3),
+            "lease_wait_p99": round(float(np.percentile(self.lease_waits, 99)), 3),
+        }
+
+
+# one pool per execution image, shared by the bots that use the image
+SANDBOX_POOLS = {}
+
+
+def get_sandbox_pool(image, name, **kwargs):
+    if id(image) not in SANDBOX_POOLS:
+        SANDBOX_POOLS[id(image)] = SandboxPool(image, name, **kwargs)
+    return SANDBOX_POOLS[id(image)]
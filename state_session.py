@@ -0,0 +1,122 @@
+"""
+
+Per-request view over a modal.Dict
+
+All the keys a request needs are read in one round trip when the session opens.
+Reads and writes during the request are served from memory, and only the keys that
+were changed are written back when the session closes.
+
+    async with StateSession(my_dict, [key_a, key_b]) as state:
+        if key_a not in state:
+            state[key_a] = 0
+        state[key_b] = state[key_a] + 1
+
+modal.Dict has no multi-key get, so the reads are issued concurrently and count as
+a single round trip. Writes go out in a single update(), deletions with pop().
+Keys whose names depend on a loaded value can be read later with load_more().
+"""
+
+from __future__ import annotations
+
+import asyncio
+
+_MISSING = object()
+
+
+class StateSession:
+    def __init__(self, modal_dict, keys, name="state_session"):
+        self.modal_dict = modal_dict
+        self.keys = list(keys)
+        self.name = name
+        self.values = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.remote_calls = 0  # individual Dict operations
+        self.round_trips = 0  # sequential waits on the Dict
+
+    async def load(self):
+        self.values = {}
+        await self._read(self.keys)
+
+    async def _read(self, keys):
+        values = await asyncio.gather(
+            *(self.modal_dict.get.aio(key, _MISSING) for key in keys)
+        )
+        self.remote_calls += len(keys)
+        self.round_trips += 1
+        for key, value in zip(keys, values):
+            if value is not _MISSING:
+                self.values[key] = value
+
+    async def load_more(self, keys):
+        """Reads the keys that were not loaded yet, in one more round trip."""
+        keys = [key for key in keys if key not in self.keys]
+        if keys:
+            self.keys += keys
+            await self._read(keys)
+
+    def add_keys(self, keys):
+        """Adds keys that are only written, e.g. new ones, without reading them."""
+        self.keys += [key for key in keys if key not in self.keys]
+
+    async def flush(self):
+        updates = {key: self.values[key] for key in self.dirty}
+        calls = []
+        if updates:
+            calls.append(self.modal_dict.update.aio(updates))
+        for key in self.deleted:
+            calls.append(self.modal_dict.pop.aio(key, None))
+        if calls:
+            await asyncio.gather(*calls)
+            self.remote_calls += len(calls)
+            self.round_trips += 1
+        self.dirty.clear()
+        self.deleted.clear()
+
+    async def __aenter__(self):
+        await self.load()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # state changed before an error is still written, as it would have been
+        # with direct writes to the Dict
+        await self.flush()
+        print(
+            self.name,
+            "remote_calls",
+            self.remote_calls,
+            "round_trips",
+            self.round_trips,
+        )
+
+    def _check_key(self, key):
+        if key not in self.keys:
+            raise KeyError(f"{key} was not loaded in this session")
+
+    def __contains__(self, key):
+        self._check_key(key)
+        return key in self.values
+
+    def __getitem__(self, key):
+        self._check_key(key)
+        return self.values[key]
+
+    def get(self, key, default=None):
+        self._check_key(key)
+        return self.values.get(key, default)
+
+    def __setitem__(self, key, value):
+        self._check_key(key)
+        self.values[key] = value
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def pop(self, key, default=None):
+        self._check_key(key)
+        if key in self.values:
+            self.deleted.add(key)
+            self.dirty.discard(key)
+        return self.values.pop(key, default)
+
+    def __delitem__(self, key):
+        self.pop(key)
@@ -0,0 +1,283 @@
+"""
+
+Compiled HSK sentence corpus for ChineseStatementBot
+
+python statement_corpus.py            # writes chinese_sentences.corpus from chinese_sentences.txt
+python statement_corpus.py benchmark  # compares parsing the text with loading the corpus
+
+Every sentence in chinese_sentences.txt comes with its context, the headings above it
+(e.g. "A.1.1 词类", "【一 01】方位名词..."). Sentences under the same headings share
+one context, so contexts are interned and each sentence refers to its context by id.
+
+The corpus is a single binary file, memory-mapped at startup
+
+    header:  magic, VERSION, text hash, and the length of each section
+    level_offsets:      uint32, sentences of level l are [offsets[l - 1], offsets[l])
+    sentence_strings:   uint32, string id of each sentence
+    sentence_contexts:  uint32, context id of each sentence
+    context_offsets:    uint32, strings of context c are context_strings[offsets[c]:offsets[c + 1]]
+    context_strings:    uint32, string id of each heading in the contexts
+    string_offsets:     uint32, string s is string_data[offsets[s]:offsets[s + 1]]
+    string_data:        UTF-8 text of every distinct sentence and heading
+
+The corpus stores the hash of the text it was built from, and is rebuilt in memory if
+the text has changed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+TEXT_PATH = "chinese_sentences.txt"
+CORPUS_PATH = "chinese_sentences.corpus"
+
+MAGIC = b"HSKS"
+VERSION = 1
+# magic, version, text hash, levels, sentences, contexts, context strings, strings
+HEADER = struct.Struct("<4sB3x8sIIIII")
+
+pattern = r"A\.\d\s"  # e.g. "A.1 "
+
+
+def parse_sentences(lines):
+    """Returns a list of (statement, context) per level, where context is a list of headings."""
+    level_to_statements_and_context = []
+
+    context = {}
+
+    for line in lines:
+        line = line.strip()
+        if re.match(pattern, line):
+            level_to_statements_and_context.append([])
+            continue
+        if line == "":
+            continue
+        if "A." in line:
+            depth = line.count(".")
+            context[f"{depth}"] = line
+            context.pop("【", None)
+            context.pop("（", None)
+            for nex_depth in range(depth + 1, 10):
+                context.pop(f"{nex_depth}", None)
+            continue
+        if "【" in line:
+            context["【"] = line
+            context.pop("（", None)
+            continue
+        if "（" in line:
+            context["（"] = line
+            continue
+
+        # statement matching
+        if "。" not in line and "？" not in line:
+            continue
+        if "甲" in line or "乙" in line:
+            continue
+        if "/" in line:
+            continue
+        if len(line) > 50:
+            continue
+
+        level_to_statements_and_context[-1].append(
+            (line.strip(), list(context.values()))
+        )
+
+    return level_to_statements_and_context
+
+
+def get_text_hash(text_path=TEXT_PATH):
+    with open(text_path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()[:8]
+
+
+def build_corpus(level_to_statements_and_context, text_hash):
+    """Returns the encoded corpus."""
+    string_to_id = {}
+    context_to_id = {}
+
+    def intern_string(string):
+        return string_to_id.setdefault(string, len(string_to_id))
+
+    level_offsets = [0]
+    sentence_strings = []
+    sentence_contexts = []
+    context_offsets = [0]
+    context_strings = []
+    for statements_and_context in level_to_statements_and_context:
+        for statement, context in statements_and_context:
+            context = tuple(context)
+            if context not in context_to_id:
+                context_to_id[context] = len(context_to_id)
+                context_strings.extend(intern_string(heading) for heading in context)
+                context_offsets.append(len(context_strings))
+            sentence_strings.append(intern_string(statement))
+            sentence_contexts.append(context_to_id[context])
+        level_offsets.append(len(sentence_strings))
+
+    encoded_strings = [string.encode() for string in string_to_id]
+    string_offsets = np.cumsum([0] + [len(s) for s in encoded_strings])
+
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        text_hash,
+        len(level_to_statements_and_context),
+        len(sentence_strings),
+        len(context_to_id),
+        len(context_strings),
+        len(string_to_id),
+    )
+    sections = [
+        level_offsets,
+        sentence_strings,
+        sentence_contexts,
+        context_offsets,
+        context_strings,
+        string_offsets,
+    ]
+    return b"".join(
+        [header]
+        + [np.asarray(section, dtype="<u4").tobytes() for section in sections]
+        + encoded_strings
+    )
+
+
+class StatementCorpus:
+    def __init__(self, data):
+        self.data = data  # bytes or mmap
+        (
+            magic,
+            version,
+            self.text_hash,
+            num_levels,
+            num_sentences,
+            num_contexts,
+            num_context_strings,
+            num_strings,
+        ) = HEADER.unpack_from(data, 0)
+        assert (magic, version) == (MAGIC, VERSION)
+
+        offset = HEADER.size
+        sections = []
+        for count in (
+            num_levels + 1,
+            num_sentences,
+            num_sentences,
+            num_contexts + 1,
+            num_context_strings,
+            num_strings + 1,
+        ):
+            sections.append(
+                np.frombuffer(data, dtype="<u4", count=count, offset=offset)
+            )
+            offset += 4 * count
+        (
+            self.level_offsets,
+            self.sentence_strings,
+            self.sentence_contexts,
+            self.context_offsets,
+            self.context_strings,
+            self.string_offsets,
+        ) = sections
+        self.string_data_offset = offset
+
+    @classmethod
+    def open(cls, corpus_path=CORPUS_PATH):
+        with open(corpus_path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @property
+    def num_levels(self):
+        return len(self.level_offsets) - 1
+
+    def __len__(self):
+        return len(self.sentence_strings)
+
+    def get_string(self, string_id):
+        start = self.string_data_offset + int(self.string_offsets[string_id])
+        end = self.string_data_offset + int(self.string_offsets[string_id + 1])
+        return bytes(self.data[start:end]).decode()
+
+    def get_level_range(self, level):
+        """Returns the sentence ids of the level, one indexed."""
+        return range(int(self.level_offsets[level - 1]), int(self.level_offsets[level]))
+
+    def get(self, sentence_id):
+        """Returns (statement, context), as in parse_sentences."""
+        context_id = self.sentence_contexts[sentence_id]
+        start = self.context_offsets[context_id]
+        end = self.context_offsets[context_id + 1]
+        return (
+            self.get_string(self.sentence_strings[sentence_id]),
+            [self.get_string(s) for s in self.context_strings[start:end]],
+        )
+
+    def sample(self, level):
+        return self.get(random.choice(self.get_level_range(level)))
+
+
+def load_corpus(text_path=TEXT_PATH, corpus_path=CORPUS_PATH):
+    """Maps the corpus, or builds it in memory if the corpus is missing or stale."""
+    text_hash = get_text_hash(text_path)
+    if os.path.exists(corpus_path):
+        corpus = StatementCorpus.open(corpus_path)
+        if corpus.text_hash == text_hash:
+            return corpus
+        print("statement corpus is stale, rebuilding")
+    with open(text_path) as f:
+        return StatementCorpus(build_corpus(parse_sentences(f), text_hash))
+
+
+def benchmark(repeats=20):
+    def measure(load):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = load()
+        elapsed = (time.perf_counter() - start) / repeats
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, elapsed, retained, peak
+
+    def parse():
+        with open(TEXT_PATH) as f:
+            return parse_sentences(f.readlines())
+
+    parsed, parse_time, parse_retained, parse_peak = measure(parse)
+    corpus, load_time, load_retained, load_peak = measure(load_corpus)
+    # the corpus returns the same sentences and contexts as parsing the text
+    assert [
+        [corpus.get(i) for i in corpus.get_level_range(level)]
+        for level in range(1, corpus.num_levels + 1)
+    ] == parsed
+
+    print(f"sentences {len(corpus)}, file {os.path.getsize(CORPUS_PATH)} bytes")
+    print(f"{'':>8} {'time (ms)':>10} {'retained (KB)':>14} {'peak (KB)':>10}")
+    for name, elapsed, retained, peak in (
+        ("parse", parse_time, parse_retained, parse_peak),
+        ("corpus", load_time, load_retained, load_peak),
+    ):
+        print(
+            f"{name:>8} {elapsed * 1000:>10.2f} {retained / 1024:>14.1f} {peak / 1024:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        with open(TEXT_PATH) as f:
+            encoded = build_corpus(parse_sentences(f), get_text_hash())
+        with open(CORPUS_PATH, "wb") as f:
+            f.write(encoded)
+        print("wrote", CORPUS_PATH)
@@ -0,0 +1,50 @@
+"""
+
+Artifacts manifest of PythonAgentBot, against an in-memory NetworkFileSystem
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+from bot_PythonAgent import PythonAgentBot
+
+
+class MemoryFileSystem:
+    def __init__(self, files):
+        self.files = dict(files)
+
+        async def read_file(path):
+            if path not in self.files:
+                raise FileNotFoundError(path)
+            yield self.files[path]
+
+        async def remove_file(path):
+            del self.files[path]
+
+        self.read_file = SimpleNamespace(aio=read_file)
+        self.remove_file = SimpleNamespace(aio=remove_file)
+
+
+def test_manifest_is_read_once():
+    nfs = MemoryFileSystem({".artifacts/c.json": json.dumps(["plot.png"]).encode()})
+    bot = PythonAgentBot()
+
+    async def main():
+        # the next run fails before the wrapper runs, and writes no manifest
+        return (
+            await bot.get_artifacts(nfs, "c"),
+            await bot.get_artifacts(nfs, "c"),
+        )
+
+    assert asyncio.run(main()) == (["plot.png"], [])
+
+
+def test_manifest_over_the_size_cap_lists_nothing():
+    nfs = MemoryFileSystem({".artifacts/c.json": b"[" + b" " * 100 + b"]"})
+    bot = PythonAgentBot()
+    bot.max_artifact_bytes = 50
+    assert asyncio.run(bot.get_artifacts(nfs, "c")) == []
+    assert nfs.files == {}
@@ -0,0 +1,70 @@
+"""
+
+CmdLineBot stops a command after command_timeout, with a stubbed sandbox pool
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import fastapi_poe as fp
+
+import bot_CmdLine
+
+
+async def stream_forever(first_line):
+    yield first_line
+    await asyncio.Event().wait()
+
+
+class StubPool:
+    def __init__(self):
+        self.terminated = []
+        self.released = []
+
+    @contextlib.asynccontextmanager
+    async def lease(self, volume_name):
+        sandbox = SimpleNamespace(exec=SimpleNamespace(aio=self.exec))
+        try:
+            yield sandbox
+        except BaseException:
+            self.terminated.append(sandbox)
+            raise
+        else:
+            self.released.append(sandbox)
+
+    async def exec(self, *args, **kwargs):
+        async def wait():
+            await asyncio.Event().wait()
+
+        return SimpleNamespace(
+            stdout=stream_forever("started\n"),
+            stderr=stream_forever(""),
+            wait=SimpleNamespace(aio=wait),
+        )
+
+
+def test_command_over_the_timeout_is_reported_and_its_sandbox_terminated():
+    pool = StubPool()
+    bot = bot_CmdLine.CmdLineBot()
+    bot.command_timeout = 0.2
+    bot.get_sandbox_pool = lambda: pool
+    request = fp.QueryRequest(
+        version="1.0",
+        type="query",
+        query=[fp.ProtocolMessage(role="user", content="sleep 1000")],
+        user_id="u",
+        conversation_id="c",
+        message_id="m",
+    )
+
+    async def main():
+        return "".join([event.text async for event in bot.get_response(request)])
+
+    reply = asyncio.run(asyncio.wait_for(main(), timeout=5))
+
+    assert "started\n" in reply
+    assert "Command timed out after 0.2 seconds." in reply
+    assert len(pool.terminated) == 1 and not pool.released
@@ -0,0 +1,115 @@
+"""
+
+The code execution handlers share one event loop with every other bot in bot_all.py
+
+The sandbox and the volume are stubbed. Their synchronous calls sleep in the calling
+thread, as the Modal client does while it waits on the server, and their .aio calls
+sleep on the event loop. Two handler calls run at once while a ticker checks that the
+loop is never held up.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+
+import fastapi_poe as fp
+
+import bot_RunPythonCode
+
+CALL_SECONDS = 0.2
+TICK_SECONDS = 0.01
+
+
+class StubCall:
+    def __init__(self, make_result=lambda: None):
+        self.make_result = make_result
+
+    def __call__(self, *args, **kwargs):
+        time.sleep(CALL_SECONDS)
+        return self.make_result()
+
+    async def aio(self, *args, **kwargs):
+        await asyncio.sleep(CALL_SECONDS)
+        return self.make_result()
+
+
+async def stream_lines(lines):
+    for line in lines:
+        await asyncio.sleep(CALL_SECONDS / len(lines))
+        yield line
+
+
+class StubSandbox:
+    def __init__(self):
+        self.stdout = stream_lines(["Hello\n", "World!\n"])
+        self.stderr = stream_lines([])
+        self.returncode = 0
+        self.wait = StubCall()
+        self.terminate = StubCall()
+
+    create = StubCall(lambda: StubSandbox())
+
+
+class StubNetworkFileSystem:
+    write_file = StubCall()
+
+    from_name = staticmethod(lambda *args, **kwargs: StubNetworkFileSystem())
+
+
+def make_request(index):
+    message = fp.ProtocolMessage(role="user", content='```python\nprint("Hello")\n```')
+    return fp.QueryRequest(
+        version="1.0",
+        type="query",
+        query=[message],
+        user_id=f"u{index}",
+        conversation_id=f"c{index}",
+        message_id=f"m{index}",
+    )
+
+
+async def run_concurrently(bot, num_calls):
+    lags = []
+    stop = asyncio.Event()
+
+    async def tick():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(TICK_SECONDS)
+            lags.append(time.perf_counter() - start - TICK_SECONDS)
+
+    async def call(index):
+        return "".join(
+            [
+                json.loads(event.data)["text"]
+                async for event in bot.get_response(make_request(index))
+                if getattr(event, "event", None) == "text"
+            ]
+        )
+
+    ticker = asyncio.create_task(tick())
+    start = time.perf_counter()
+    replies = await asyncio.gather(*(call(index) for index in range(num_calls)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    return replies, elapsed, max(lags)
+
+
+def test_run_python_code_does_not_block_the_loop(monkeypatch):
+    monkeypatch.setattr(bot_RunPythonCode, "Sandbox", StubSandbox)
+    monkeypatch.setattr(
+        bot_RunPythonCode.modal, "NetworkFileSystem", StubNetworkFileSystem
+    )
+    bot = bot_RunPythonCode.RunPythonCodeBot()
+
+    replies, elapsed, max_lag = asyncio.run(run_concurrently(bot, num_calls=2))
+
+    for reply in replies:
+        assert "Hello\nWorld!\n" in reply
+    # the two calls overlap: write, create, output and wait take 4 calls each
+    assert elapsed < 6 * CALL_SECONDS
+    # a blocking call would hold up the ticker for a whole CALL_SECONDS
+    assert max_lag < CALL_SECONDS / 2
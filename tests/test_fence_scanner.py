@@ -0,0 +1,50 @@
+"""
+
+BlockReader on the replies of TrinoAgentExBot, streamed in chunks of several sizes
+"""
+
+from __future__ import annotations
+
+import pytest
+
+from fence_scanner import BlockReader
+
+Q1 = "```sql\nSELECT 1\n```\n"
+Q2 = "```sql\nSELECT 2\n```\n"
+
+
+def read(reply, max_blocks, chunk_size):
+    reader = BlockReader("sql", max_blocks)
+    shown = ""
+    for start in range(0, len(reply), chunk_size):
+        shown += reader.feed(reply[start : start + chunk_size])
+        if reader.done:
+            break
+    return reader, shown
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_two_blocks_with_prose_between_are_both_read(chunk_size):
+    reply = f"Here:\n{Q1}This one also works:\n\n{Q2}Both return one row."
+    reader, shown = read(reply, 4, chunk_size)
+
+    assert [code for _, code in reader.scanner.blocks] == ["SELECT 1", "SELECT 2"]
+    # the prose after the last block is neither shown nor fed back
+    assert shown == reader.get_reply() == f"Here:\n{Q1}This one also works:\n\n{Q2}"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_reading_stops_at_max_blocks(chunk_size):
+    reader, shown = read(f"{Q1}And\n{Q2}", 1, chunk_size)
+
+    assert [code for _, code in reader.scanner.blocks] == ["SELECT 1"]
+    assert reader.done and shown == Q1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_reading_stops_at_made_up_output(chunk_size):
+    reply = f"{Q1}Output:\n```\n| 1 |\n```\n{Q2}"
+    reader, shown = read(reply, 4, chunk_size)
+
+    assert [code for _, code in reader.scanner.blocks] == ["SELECT 1"]
+    assert reader.done and shown == Q1
@@ -0,0 +1,105 @@
+"""
+
+TrinoPool against the stand-in server of trino_benchmark.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from trino_benchmark import StandInTrinoServer
+from trino_pool import QueryTimeout, TrinoPool
+
+
+@pytest.fixture
+def server():
+    server = StandInTrinoServer()
+    yield server
+    server.shutdown()
+
+
+async def wait_for_cancellations(server, count, timeout=5):
+    # the cancellations are sent from a thread, after the handler has moved on
+    deadline = time.perf_counter() + timeout
+    while len(server.cancelled) < count and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def test_at_most_max_size_queries_run_at_once(server):
+    connections = []
+
+    def connect():
+        connections.append(server.connect())
+        return connections[-1]
+
+    async def main():
+        pool = TrinoPool(connect, max_size=2)
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[pool.execute("SELECT * FROM t WHERE sleep(0.3)") for _ in range(4)]
+        )
+        return results, time.perf_counter() - start, pool
+
+    results, elapsed, pool = asyncio.run(main())
+
+    assert [rows for _, rows in results] == [[[0, "row 0"]]] * 4
+    # two waves of two queries
+    assert 0.6 <= elapsed < 1.2
+    assert len(connections) == 2
+    assert pool.stats["finished"] == 4
+
+
+def test_timeout_cancels_the_query_on_the_server(server):
+    async def main():
+        pool = TrinoPool(server.connect, max_size=2, query_timeout=0.3)
+        start = time.perf_counter()
+        with pytest.raises(QueryTimeout):
+            await pool.execute("SELECT * FROM t WHERE sleep(30)")
+        elapsed = time.perf_counter() - start
+        await wait_for_cancellations(server, 1)
+        return elapsed, pool
+
+    elapsed, pool = asyncio.run(main())
+
+    assert elapsed < 1
+    assert len(server.cancelled) == 1
+    assert pool.stats["timeout"] == 1
+
+
+def test_client_cancel_cancels_the_query_on_the_server(server):
+    async def main():
+        pool = TrinoPool(server.connect, max_size=2)
+        task = asyncio.create_task(pool.execute("SELECT * FROM t WHERE sleep(30)"))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await wait_for_cancellations(server, 1)
+        # the slot is free again for the next query
+        _, rows = await pool.execute("SELECT * FROM t WHERE rows(3)")
+        return rows, pool
+
+    rows, pool = asyncio.run(main())
+
+    assert len(server.cancelled) == 1
+    assert pool.stats["cancelled"] == 1
+    assert rows[-1] == [2, "row 2"]
+
+
+def test_closing_a_stream_cancels_the_query_on_the_server(server):
+    async def main():
+        pool = TrinoPool(server.connect, max_size=2)
+        stream = pool.stream("SELECT * FROM t WHERE rows(5000)", batch_size=100)
+        _, rows = await stream.__anext__()
+        await stream.aclose()
+        await wait_for_cancellations(server, 1)
+        return rows, pool
+
+    rows, pool = asyncio.run(main())
+
+    assert len(rows) == 100
+    assert len(server.cancelled) == 1
+    assert pool.stats["closed"] == 1
@@ -0,0 +1,232 @@
+"""
+
+Stand-in Trino server, for the benchmarks and tests of trino_pool.py
+
+python trino_benchmark.py  # concurrency, timeout and cancellation of TrinoPool
+
+StandInTrinoServer speaks enough of the Trino protocol for the trino client, so the
+pool, the streamed result tables and the query cache can be measured without a
+cluster
+
+    server = StandInTrinoServer()
+    pool = TrinoPool(server.connect, max_size=4)
+
+It is not part of the bots and is not added to their image.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import trino
+
+from trino_pool import QueryTimeout, TrinoPool, fetch_all
+
+
+class StandInTrinoServer:
+    """A local server that speaks enough of the Trino protocol for the benchmark.
+
+    A query returns rows(n) rows (1 by default), in pages of page_size, after
+    sleep(seconds). A query that contains "fail" returns a user error.
+    """
+
+    def __init__(self, page_size=1000):
+        self.page_size = page_size
+        self.queries = {}  # query id -> {"sql", "ready_at", "next_row"}
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def connect(self):
+        return trino.dbapi.connect(
+            host="127.0.0.1", port=self.port, http_scheme="http", user="benchmark"
+        )
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def get_response(self, query_id, page):
+        query = self.queries[query_id]
+        base = {
+            "id": query_id,
+            "infoUri": f"http://127.0.0.1:{self.port}/ui/{query_id}",
+        }
+        next_uri = f"http://127.0.0.1:{self.port}/v1/statement/{query_id}/{page + 1}"
+        if "fail" in query["sql"]:
+            return {
+                **base,
+                "stats": {"state": "FAILED"},
+                "error": {
+                    "errorType": "USER_ERROR",
+                    "errorName": "SYNTAX_ERROR",
+                    "errorCode": 1,
+                    "message": "line 1:1: mismatched input",
+                },
+            }
+        if time.time() < query["ready_at"]:
+            time.sleep(min(0.05, query["ready_at"] - time.time()))
+            return {**base, "stats": {"state": "RUNNING"}, "nextUri": next_uri}
+        match = re.search(r"rows\((\d+)\)", query["sql"])
+        num_rows = int(match.group(1)) if match else 1
+        start = query["next_row"]
+        query["next_row"] = min(start + self.page_size, num_rows)
+        response = {
+            **base,
+            "stats": {"state": "RUNNING"},
+            "columns": [
+                {
+                    "name": "n",
+                    "type": "bigint",
+                    "typeSignature": {"rawType": "bigint", "arguments": []},
+                },
+                {
+                    "name": "name",
+                    "type": "varchar",
+                    "typeSignature": {
+                        "rawType": "varchar",
+                        "arguments": [{"kind": "LONG", "value": 2147483647}],
+                    },
+                },
+            ],
+            "data": [[i, f"row {i}"] for i in range(start, query["next_row"])],
+        }
+        if query["next_row"] < num_rows:
+            response["nextUri"] = next_uri
+        else:
+            response["stats"] = {"state": "FINISHED"}
+        return response
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, response):
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                sql = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                match = re.search(r"sleep\(([\d.]+)\)", sql)
+                query_id = uuid.uuid4().hex
+                with server.lock:
+                    server.queries[query_id] = {
+                        "sql": sql,
+                        "ready_at": time.time() + float(match.group(1) if match else 0),
+                        "next_row": 0,
+                    }
+                self.send_json(
+                    {
+                        "id": query_id,
+                        "infoUri": f"http://127.0.0.1:{server.port}/ui/{query_id}",
+                        "nextUri": f"http://127.0.0.1:{server.port}/v1/statement/{query_id}/0",
+                        "stats": {"state": "QUEUED"},
+                    }
+                )
+
+            def do_GET(self):
+                _, _, _, query_id, page = self.path.split("/")
+                if query_id in server.cancelled:
+                    self.send_error(410)
+                    return
+                self.send_json(server.get_response(query_id, max(1, int(page))))
+
+            def do_DELETE(self):
+                query_id = self.path.split("/")[3]
+                with server.lock:
+                    server.cancelled.add(query_id)
+                self.send_response(204)
+                self.end_headers()
+
+        return Handler
+
+
+async def measure_loop_lag(stop, interval=0.01):
+    """Returns how late each tick of the event loop was, in seconds, until stop is set."""
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+    return lags
+
+
+def benchmark(num_queries=8, query_seconds=0.5, max_size=4):
+    server = StandInTrinoServer()
+    query = f"SELECT * FROM t WHERE sleep({query_seconds})"
+
+    async def measure(run_queries):
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(measure_loop_lag(stop))
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        await run_queries()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        return elapsed, np.array(await lag_task)
+
+    async def shared_cursor():
+        # as the bots used to: one cursor, called from the event loop
+        cursor = server.connect().cursor()
+        for _ in range(num_queries):
+            fetch_all(cursor, query)
+
+    async def pooled():
+        pool = TrinoPool(server.connect, max_size=max_size)
+        await asyncio.gather(*[pool.execute(query) for _ in range(num_queries)])
+
+    print(f"{num_queries} queries of {query_seconds} s, pool of {max_size}")
+    print(f"{'':>14} {'total (s)':>10} {'loop lag max (ms)':>18}")
+    for name, run_queries in (("shared cursor", shared_cursor), ("pool", pooled)):
+        elapsed, lags = asyncio.run(measure(run_queries))
+        print(f"{name:>14} {elapsed:>10.2f} {lags.max() * 1000:>18.1f}")
+    assert elapsed < num_queries * query_seconds / max_size + 1
+
+    async def timeout_and_cancel():
+        pool = TrinoPool(server.connect, max_size=max_size, query_timeout=0.5)
+        start = time.perf_counter()
+        try:
+            await pool.execute("SELECT * FROM t WHERE sleep(30)")
+        except QueryTimeout as e:
+            print("timeout after", round(time.perf_counter() - start, 2), "s:", e)
+        task = asyncio.create_task(pool.execute("SELECT * FROM t WHERE sleep(30)"))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            print("cancelled")
+        await asyncio.sleep(0.5)  # the cancellations are sent in the background
+        try:
+            await pool.execute("SELECT fail")
+        except trino.exceptions.TrinoUserError as e:
+            print("user error:", e.message)
+        assert (await pool.execute("SELECT * FROM t WHERE rows(2500)"))[1][-1] == [
+            2499,
+            "row 2499",
+        ]
+        return pool
+
+    pool = asyncio.run(timeout_and_cancel())
+    print("queries cancelled on the server", len(server.cancelled), pool.stats)
+    assert len(server.cancelled) == 2
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark()
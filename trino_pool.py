@@ -0,0 +1,187 @@
+"""
+
+Pool of Trino connections for TrinoAgentBot and RunTrinoQueryBot
+
+python trino_benchmark.py  # concurrency, timeout and cancellation against a stand-in server
+
+The Trino client is blocking. Queries run in the threads of the pool, so that the
+event loop keeps serving the other bots, and each query has its own cursor on a
+connection that no other query is using at the same time
+
+    pool = get_trino_pool()
+    columns, rows = await pool.execute(query)
+
+or, for results that may be large, in batches of rows
+
+    async for columns, rows in pool.stream(query, batch_size):
+        ...
+
+At most max_size queries run at once, the others wait for a connection. A query that
+runs for longer than query_timeout raises QueryTimeout. On a timeout, or when the
+handler is cancelled because the client disconnected, the query is cancelled on the
+server and its connection is closed, as it is when a stream is closed before its
+last batch.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import trino
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def connect_from_env():
+    return trino.dbapi.connect(
+        host=os.environ["TRINO_HOST_URL"],
+        port=443,
+        http_scheme="https",
+        auth=trino.auth.BasicAuthentication(
+            os.environ["TRINO_USERNAME"], os.environ["TRINO_PASSWORD"]
+        ),
+    )
+
+
+def fetch_all(cursor, query):
+    cursor.execute(query)
+    return cursor.description, cursor.fetchall()
+
+
+class TrinoPool:
+    def __init__(self, connect=connect_from_env, max_size=8, query_timeout=60):
+        self.connect = connect
+        self.max_size = max_size
+        self.query_timeout = query_timeout
+        self.idle = []  # connections without a running query
+        self.slots = asyncio.Semaphore(max_size)
+        # a cancelled query keeps its thread until the server has stopped it
+        self.executor = ThreadPoolExecutor(
+            max_workers=2 * max_size, thread_name_prefix="trino"
+        )
+        self.stats = {
+            "finished": 0,
+            "failed": 0,
+            "timeout": 0,
+            "cancelled": 0,
+            "closed": 0,
+        }
+
+    def close_query(self, connection, cursor):
+        try:
+            cursor.cancel()
+        except Exception as e:  # e.g. the query had not been sent yet
+            print("could not cancel trino query", repr(e))
+        connection.close()
+
+    def record(self, status, start):
+        self.stats[status] += 1
+        print(
+            "trino_query",
+            status,
+            "seconds",
+            round(time.perf_counter() - start, 3),
+            self.stats,
+        )
+
+    async def run(self, function, *args, timeout=None):
+        """Returns function(cursor, *args), run in a thread of the pool."""
+        timeout = self.query_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else self.connect()
+            cursor = connection.cursor()
+            start = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, function, cursor, *args),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                loop.run_in_executor(None, self.close_query, connection, cursor)
+                self.record("timeout", start)
+                raise QueryTimeout(
+                    f"The query did not finish within {timeout} seconds."
+                ) from None
+            except asyncio.CancelledError:
+                loop.run_in_executor(None, self.close_query, connection, cursor)
+                self.record("cancelled", start)
+                raise
+            except Exception:
+                # the query failed on the server, the connection can be reused
+                self.idle.append(connection)
+                self.record("failed", start)
+                raise
+            self.idle.append(connection)
+            self.record("finished", start)
+            return result
+
+    async def execute(self, query, timeout=None):
+        """Returns (columns, rows)."""
+        return await self.run(fetch_all, query, timeout=timeout)
+
+    async def stream(self, query, batch_size=1000, timeout=None):
+        """Yields (columns, rows) with batch_size rows, then a last shorter batch.
+
+        The timeout applies to the whole query. Closing the generator before the last
+        batch cancels the query on the server.
+        """
+        timeout = self.query_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else self.connect()
+            cursor = connection.cursor()
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, cursor.execute, query), timeout
+                )
+                while True:
+                    rows = await asyncio.wait_for(
+                        loop.run_in_executor(
+                            self.executor, cursor.fetchmany, batch_size
+                        ),
+                        deadline - loop.time(),
+                    )
+                    if len(rows) < batch_size:
+                        break
+                    yield cursor.description, rows
+            except asyncio.TimeoutError:
+                loop.run_in_executor(None, self.close_query, connection, cursor)
+                self.record("timeout", start)
+                raise QueryTimeout(
+                    f"The query did not finish within {timeout} seconds."
+                ) from None
+            except asyncio.CancelledError:
+                loop.run_in_executor(None, self.close_query, connection, cursor)
+                self.record("cancelled", start)
+                raise
+            except GeneratorExit:
+                # the caller has all the rows it wants
+                loop.run_in_executor(None, self.close_query, connection, cursor)
+                self.record("closed", start)
+                raise
+            except Exception:
+                self.idle.append(connection)
+                self.record("failed", start)
+                raise
+            self.idle.append(connection)
+            self.record("finished", start)
+        # the query is done, the slot is not held while the caller reads the batch
+        yield cursor.description, rows
+
+
+TRINO_POOL = None
+
+
+def get_trino_pool(**kwargs):
+    global TRINO_POOL
+    if TRINO_POOL is None:
+        TRINO_POOL = TrinoPool(**kwargs)
+    return TRINO_POOL
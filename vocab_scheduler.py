@@ -0,0 +1,173 @@
+"""
+
+Spaced-repetition scheduler for ChineseVocabBot
+
+python vocab_scheduler.py benchmark [users] [reviews]  # defaults to 10000 users x 1000 reviews
+
+Each user has a SparseLearnerState over the HSK word list with the due time, interval
+and ease factor of every word they have reviewed. Words are graded SM-2 style.
+
+The next word is the most overdue reviewed word at or below the user's level, found
+with an argmin over the user's reviewed words. If nothing is due, a word the user has
+not seen is sampled from the level. Neither depends on the size of the word list.
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+
+import numpy as np
+
+from learner_state import ItemIndex, SparseLearnerState, read_header
+
+# due times are stored as float32 hours since this epoch (2024-01-01 UTC)
+SCHEDULER_EPOCH = 1704067200
+
+SCHEDULE_INITIAL_VALUES = {"due": 0.0, "interval": 0.0, "ease": 2.5}
+
+MINIMUM_EASE = 1.3
+RELEARN_INTERVAL_HOURS = 0.25
+FIRST_INTERVAL_HOURS = 24.0
+
+# number of uniform draws before falling back to sampling from the unseen words
+NEW_WORD_ATTEMPTS = 8
+
+
+def get_current_hours(now=None):
+    return ((time.time() if now is None else now) - SCHEDULER_EPOCH) / 3600
+
+
+class VocabScheduler:
+    def __init__(self, word_store, name="ChineseVocab"):
+        self.word_store = word_store
+        self.word_levels = word_store.columns["level"]
+        # some words are listed under several levels
+        self.item_index = ItemIndex(
+            name,
+            [
+                "\t".join(map(str, word))
+                for word in zip(
+                    word_store.columns["traditional"],
+                    word_store.columns["simplified"],
+                    word_store.columns["numerical_pinyin"],
+                    word_store.columns["level"],
+                )
+            ],
+        )
+
+    def new_schedule(self):
+        return SparseLearnerState.new(self.item_index, SCHEDULE_INITIAL_VALUES)
+
+    def next_word(self, schedule, level, hours):
+        """Returns (word index, whether the word is a review)."""
+        if len(schedule):
+            due = schedule["due"]
+            eligible = self.word_levels[schedule.indices] <= level
+            if eligible.any():
+                position = int(np.argmin(np.where(eligible, due, np.inf)))
+                if due[position] <= hours:
+                    return int(schedule.indices[position]), True
+        return self.sample_new_word(schedule, level), False
+
+    def sample_new_word(self, schedule, level):
+        for _ in range(NEW_WORD_ATTEMPTS):
+            index = self.word_store.sample(level)
+            if schedule.get_position(index) is None:
+                return index
+        # the level is mostly seen, sample from the remaining words
+        weights = np.ones(len(self.word_store))
+        weights[schedule.indices] = 0
+        return self.word_store.sample(level, weights=weights)
+
+    def review(self, schedule, index, quality, hours):
+        """Grades a word with quality from 0 (forgotten) to 5 (perfect)."""
+        position = schedule.get_position(index)
+        if position is None:
+            interval = 0.0
+            ease = SCHEDULE_INITIAL_VALUES["ease"]
+        else:
+            interval = float(schedule["interval"][position])
+            ease = float(schedule["ease"][position])
+
+        if quality < 3:
+            interval = RELEARN_INTERVAL_HOURS
+            ease = max(MINIMUM_EASE, ease - 0.2)
+        else:
+            if interval < FIRST_INTERVAL_HOURS:
+                interval = FIRST_INTERVAL_HOURS
+            else:
+                interval = interval * ease
+            ease = max(
+                MINIMUM_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02)
+            )
+        schedule.set(index, due=hours + interval, interval=interval, ease=ease)
+
+
+def benchmark(num_users=10000, num_reviews=1000):
+    import pandas as pd
+
+    from word_store import WordStore
+
+    scheduler = VocabScheduler(WordStore(pd.read_csv("chinese_words.csv")))
+    rng = np.random.default_rng(0)
+    request_times = []
+    written_sizes = []
+    payload_sizes = []
+    start = time.perf_counter()
+    for _ in range(num_users):
+        stored = {}  # the user's chunks in the Dict
+        level = 1
+        hours = 0.0
+        # the user reviews in sessions, with a gap between sessions
+        for review_count in range(num_reviews):
+            hours += 0.05 if review_count % 20 else float(rng.integers(8, 48))
+            request_start = time.perf_counter()
+            # what a request does: decode, pick, grade, write the changed chunks
+            if stored:
+                num_items = read_header(stored["schedule"])[-1]
+                schedule = SparseLearnerState.decode(
+                    scheduler.item_index,
+                    SCHEDULE_INITIAL_VALUES,
+                    [
+                        stored[key]
+                        for key in SparseLearnerState.get_chunk_keys(
+                            "schedule", num_items
+                        )
+                    ],
+                )
+            else:
+                schedule = scheduler.new_schedule()
+            index, _ = scheduler.next_word(schedule, level, hours)
+            quality = 5 if rng.random() < 0.7 else 1
+            scheduler.review(schedule, index, quality, hours)
+            changed = schedule.get_changed_chunks("schedule")
+            stored.update(changed)
+            request_times.append(time.perf_counter() - request_start)
+            written_sizes.append(sum(map(len, changed.values())))
+            if rng.random() < 0.1:
+                level = min(7, max(1, level + (1 if quality == 5 else -1)))
+        payload_sizes.append(sum(map(len, schedule.stored_chunks)))
+    total = time.perf_counter() - start
+
+    request_times = np.array(request_times) * 1e6
+    print(f"users {num_users}, reviews per user {num_reviews}, total {total:.1f} s")
+    print(
+        "per request (us): "
+        f"p50 {np.percentile(request_times, 50):.1f}, "
+        f"p99 {np.percentile(request_times, 99):.1f}, "
+        f"max {request_times.max():.1f}"
+    )
+    print(
+        "written per request (bytes): "
+        f"mean {np.mean(written_sizes):.0f}, max {np.max(written_sizes)}"
+    )
+    print(
+        "payload after all reviews (bytes): "
+        f"mean {np.mean(payload_sizes):.0f}, max {np.max(payload_sizes)}"
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(*map(int, sys.argv[2:4]))
@@ -0,0 +1,56 @@
+"""
+
+Struct-of-arrays store for chinese_words.csv
+
+Each column is kept as a NumPy array, and the eligible (not excluded) words of each
+level are kept as an array of row indices. Sampling a word is a random position in
+the level's index array, and only the sampled row is turned into a dict.
+
+    store = WordStore(pd.read_csv("chinese_words.csv"))
+    word_info = store.get_record(store.sample(level=1))
+
+Weighted sampling takes one weight per row of the CSV (e.g. lower for words the user
+has already seen), so the per-level index arrays do not have to be rebuilt.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+
+class WordStore:
+    def __init__(self, df, rng=None):
+        self.column_names = list(df.columns)
+        self.columns = {column: df[column].to_numpy() for column in df.columns}
+        self.rng = rng or np.random.default_rng()
+        levels = self.columns["level"]
+        eligible = ~self.columns["exclude"].astype(bool)
+        self.level_to_indices = {
+            int(level): np.flatnonzero((levels == level) & eligible)
+            for level in np.unique(levels)
+        }
+
+    def __len__(self):
+        return len(self.columns["level"])
+
+    def get_record(self, index):
+        # same values as df.iloc[index].to_dict(), with Python scalars
+        record = {}
+        for column in self.column_names:
+            value = self.columns[column][index]
+            record[column] = value.item() if isinstance(value, np.generic) else value
+        return record
+
+    def sample(self, level, weights=None):
+        """Returns the row index of a random eligible word of the level.
+
+        weights, if given, has one non-negative weight per row of the store.
+        """
+        indices = self.level_to_indices[level]
+        if weights is None:
+            return int(indices[self.rng.integers(len(indices))])
+        level_weights = weights[indices]
+        total = level_weights.sum()
+        if total <= 0:
+            return int(indices[self.rng.integers(len(indices))])
+        return int(self.rng.choice(indices, p=level_weights / total))